@@ -0,0 +1,208 @@
+from results import MEASURES, measures_frame, measure_values, analytic_measures, subset_se
+from bootstrap import BootPlan, WEIGHTED, outer_sample
+from design import AuditData
+from helpers import if_mean
+from profiling import as_profiler
+import scipy.sparse as sp
+import numpy as np
+
+
+#maximum number of cells of the per-row sufficient statistics built at once by wls_stats
+_MAX_CELLS = 2**24
+
+
+def ci_ols(data, X, Z, W, Y, x0, x1, rep, nboot = 100, random_state = None, resample = "index", inference = "bootstrap", subset_size = None, profiler = None):
+    """
+    Use linear regressions to decompose the causal effects: y is regressed on Z (for te, ett, ctfse) and on Z and W (for nde, ctfde, nie, ctfie)
+    separately in each level of the protected attribute, and the effects are the averaged differences of the two fits.
+    Every inner bootstrap sample refits the regressions exactly, in closed form from weighted sufficient statistics computed for a whole block of samples at once.
+    Gives the same measure table as ci_crf, in a fraction of its time.
+
+    :data:(dataframe or AuditData) if a dataframe, the columns of Z and W must be numeric.
+    :X:(array) scalar giving the name of the protected attribute. Must be one of the entries of data.columns
+    :Z:(array) vector giving the names of all confounders. Must be one of the entries of data.columns
+    :W:(array) vector giving the names of all mediators. Must be one of the entries of data.columns
+    :Y:(array) scalar giving the name of the outcome, or a list of names. Must be one of the entries of data.columns
+    :x0:(string) scalar values giving the two levels of the binary protected attribute.
+    :x1:(string) scalar values giving the two levels of the binary protected attribute.
+    :rep:(integer) scalar index input from the outter bootstrap loop
+    :nboot:(integer) scalar determining the number of inner bootstrap repetitions.
+    :random_state:(None, integer, SeedSequence or Generator) source of all the randomness of this repetition. If None, the global np.random state is used.
+    :resample:("index", "weight", "poisson" or "dirichlet") see ci_crf. With "poisson" and "dirichlet", every inner sample refits the regressions with replicate weights drawn around those of the outter repetition.
+    :inference:("bootstrap" or "analytic") see ci_crf. The analytic standard errors account for the estimation of the regressions.
+    :subset_size:(integer, float or None) bag of little bootstraps, see ci_crf. The regressions are then refitted on every multinomial reweighting of the subset.
+    :profiler:(None, profiling.Profiler or function) see ci_crf. The stages are outer_sample, wls (the refits of all the inner bootstrap samples, measures included) or measures (analytic).
+
+    :return:(dataframe) This df inclused all types of causal effects. value=calculated measure, boot=row number/bootstrap id, measure=meas (name of the calculated measure)
+    """
+    values = ols_measures(data=data, X=X, Z=Z, W=W, Y=Y, x0=x0, x1=x1, rep=rep, nboot=nboot, random_state=random_state, resample=resample, inference=inference, subset_size=subset_size, profiler=profiler)
+    outcomes = data.outcomes if isinstance(data, AuditData) else Y
+    if inference == "analytic":
+        return measures_frame(values[0], rep, outcomes = outcomes, se = values[1])
+    return measures_frame(values, rep, outcomes = outcomes)
+
+
+def ols_measures(data, X, Z, W, Y, x0, x1, rep, nboot = 100, random_state = None, resample = "index", inference = "bootstrap", subset_size = None, profiler = None):
+    """
+    Same as ci_ols, but return the measures as an array instead of a dataframe (see crf_measures for the shapes).
+    """
+    if not isinstance(data, AuditData):
+        data = AuditData.from_frame(data, X, Z, W, Y, x0)
+    has_z, has_w = data.n_z > 0, data.n_w > 0
+    #a missing or infinite value would spread through the sufficient statistics and turn every measure into nan
+    for name, values in (("outcome", data.y), ("features", data.features)):
+        if not np.all(np.isfinite(values)):
+            raise ValueError("method 'OLS' needs finite values, got missing or infinite values in the %s" % (name,))
+
+    profiler = as_profiler(profiler)
+    with profiler.stage("outer_sample", rep):
+        samp = outer_sample(data, rep, random_state = random_state, resample = resample, n_seeds = 0, subset_size = subset_size)
+    t, y, expand = samp["t"], samp["y"], samp["expand"]
+    design = np.column_stack([np.ones(len(t)), samp["features"]])
+
+    if inference == "analytic":
+        if resample in WEIGHTED:
+            raise ValueError("inference 'analytic' does not support resample %r" % (resample,))
+        if expand is not None:
+            design, t, y = design[expand], t[expand], y[expand]
+        with profiler.stage("measures", rep):
+            values, se = _analytic_values(design, t, y, data.n_z, has_z, has_w, data.multi)
+        return values, subset_se(se, len(t), data.n)
+    if inference != "bootstrap":
+        raise ValueError("inference must be 'bootstrap' or 'analytic', got %r" % (inference,))
+
+    #the inner bootstrap resamples the rows of the outter sample, with "weight" its counts are folded onto the distinct rows the statistics are built from.
+    #every inner sample draws n rows, also from a subset of the data. With replicate weights, its (dense) weights are drawn around those of the outter sample
+    n = len(t) if expand is None else len(expand)
+    weighted = resample in WEIGHTED
+    plan = BootPlan(group0 = (t if expand is None else t[expand]) == 0, nboot = nboot, seed = samp["plan_seed"], lazy = True, size = data.n,
+                    scheme = resample if weighted else "multinomial", weight = samp["weight"] if weighted else None)
+    fold = None if expand is None else sp.csr_matrix((np.ones(n), (np.arange(n), expand)), shape = (n, len(t)))
+
+    values = np.empty((data.n_y, nboot, len(MEASURES)))
+    with profiler.stage("wls", rep):
+        for start, block in plan.chunks():
+            counts = plan.weights(block)
+            if fold is not None:
+                counts = counts @ fold
+            G, R = wls_stats(design, t, y, counts)
+            m = _boot_means(G, R, data.n_z, has_z, has_w)
+            for j in range(data.n_y):
+                values[j, start:start + block.shape[0]] = measure_values({k: v[j] for k, v in m.items()}, block.shape[0], has_z, has_w)
+
+    return values if data.multi else values[0]
+
+
+def wls_stats(design, t, y, counts):
+    """
+    Sufficient statistics of the weighted least squares fits of y on design within each group of t, for several weightings of the rows at once
+
+    :design:(2-d array) (n x p) regressors, the first column being the constant
+    :t:(1-d array) group of each row, 0 or 1
+    :y:(2-d array) (n x n_y) outcomes
+    :counts:(2-d array or sparse matrix) (nb x n) weight of each row in each of the nb weightings, e.g. the counts of bootstrap samples (see BootPlan.weights)
+    :return1:(4-d array) G, (2 x nb x p x p), G[g, b] = sum of counts[b] * d d' over the rows d of group g
+    :return2:(4-d array) R, (2 x nb x p x n_y), R[g, b] = sum of counts[b] * d y' over the rows of group g
+    """
+    n, p = design.shape
+    n_y = y.shape[1]
+    iu, ju = np.triu_indices(p)
+    q = len(iu) + p * n_y
+    counts = np.asarray(counts) if isinstance(counts, np.ndarray) else sp.csc_matrix(counts)
+    nb = counts.shape[0]
+
+    #every row contributes the upper triangle of d d' and d y', the products with counts are done by blocks of rows to bound the memory
+    stats = np.zeros((2, nb, q))
+    step = max(_MAX_CELLS // q, 1)
+    for a in range(0, n, step):
+        b = min(a + step, n)
+        d = design[a:b]
+        s = np.concatenate([d[:, iu] * d[:, ju], (d[:, :, None] * y[a:b, None, :]).reshape(b - a, -1)], axis = 1)
+        c = counts[:, a:b]
+        for g in (0, 1):
+            rows = t[a:b] == g
+            stats[g] += c[:, rows] @ s[rows]
+
+    G = np.empty((2, nb, p, p))
+    G[:, :, iu, ju] = stats[:, :, :len(iu)]
+    G[:, :, ju, iu] = stats[:, :, :len(iu)]
+    R = stats[:, :, len(iu):].reshape(2, nb, p, n_y)
+    return G, R
+
+
+def _solve(G, R):
+    #pseudo-inverse, so that collinear regressors (e.g. a dummy constant in a bootstrap sample) still give the least squares fit
+    return np.linalg.pinv(G, hermitian = True) @ R
+
+
+def _boot_means(G, R, n_z, has_z, has_w):
+    """
+    Turn the statistics of wls_stats into the bootstrap means expected by results.measure_values: the means of y over each group,
+    and the effects (difference of the two group fits) averaged over all rows and over the rows of group 0.
+
+    :return:(dictionary) "all", "id0", "id1", each a (n_y x nb x n_cols) array laid out as in measure_values
+    """
+    N = G[:, :, 0, 0]
+    y_mean = R[:, :, 0, :] / N[:, :, None]
+    d_all = (G[0, :, 0, :] + G[1, :, 0, :]) / (N[0] + N[1])[:, None]
+    d_id0 = G[0, :, 0, :] / N[0][:, None]
+
+    cols = {"all": [], "id0": [y_mean[0]], "id1": [y_mean[1]]}
+    for fitted, k in ((has_z, 1 + n_z), (has_w, G.shape[-1])):
+        if not fitted:
+            continue
+        beta = _solve(G[:, :, :k, :k], R[:, :, :k, :])
+        delta = beta[1] - beta[0]
+        cols["all"].append(np.einsum("bp,bpy->by", d_all[:, :k], delta))
+        cols["id0"].append(np.einsum("bp,bpy->by", d_id0[:, :k], delta))
+
+    return {name: np.stack(v, axis = -1).transpose(1, 0, 2) if len(v) > 0 else np.empty((y_mean.shape[2], y_mean.shape[1], 0)) for name, v in cols.items()}
+
+
+def _analytic_values(design, t, y, n_z, has_z, has_w, multi):
+    """
+    Estimate every measure and its standard error from influence functions, without inner bootstrap.
+    The influence functions of the effects include the estimation of the regression coefficients.
+
+    :design:(2-d array) (n x p) constant, Z and W of the rows of the outter sample
+    :t:(1-d array) treatment
+    :y:(2-d array) outcomes, one column per outcome
+    :return:(tuple) estimates and standard errors, each (1 x len(MEASURES)) or (n_outcomes x 1 x len(MEASURES)) if multi
+    """
+    idx = {"id0": t == 0, "id1": t == 1}
+    fits = [k for fitted, k in ((has_z, 1 + n_z), (has_w, design.shape[1])) if fitted]
+
+    values = np.empty((y.shape[1], 1, len(MEASURES)))
+    se = np.empty((y.shape[1], 1, len(MEASURES)))
+    for j in range(y.shape[1]):
+        terms = {"y_id0": if_mean(y[:,j], idx["id0"]), "y_id1": if_mean(y[:,j], idx["id1"])}
+        effects = [_if_effect(design[:, :k], t, y[:, j], idx["id0"]) for k in fits]
+        if has_z:
+            terms["te_all"], terms["te_id0"] = effects[0]
+        if has_w:
+            terms["med_all"], terms["med_id0"] = effects[-1]
+        values[j, 0], se[j, 0] = analytic_measures(terms, has_z, has_w)
+
+    return (values, se) if multi else (values[0], se[0])
+
+
+def _if_effect(d, t, y, id0):
+    """
+    Difference of the least squares fits of y on d in the two groups of t, averaged over all rows and over the rows id0, with the influence functions of both averages
+    """
+    n = len(t)
+    beta, if_beta = [], []
+    for g in (0, 1):
+        rows = t == g
+        G_inv = np.linalg.pinv(d[rows].T @ d[rows], hermitian = True)
+        b = G_inv @ (d[rows].T @ y[rows])
+        beta.append(b)
+        if_beta.append(n * np.where(rows, y - d @ b, 0)[:, None] * (d @ G_inv))
+    delta, if_delta = beta[1] - beta[0], if_beta[1] - if_beta[0]
+
+    res = []
+    for rows in (np.ones(n, dtype = bool), id0):
+        d_bar = d[rows].mean(axis = 0)
+        influence = np.where(rows, (d - d_bar) @ delta, 0) * n / rows.sum() + if_delta @ d_bar
+        res.append((d_bar @ delta, influence))
+    return res
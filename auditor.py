@@ -0,0 +1,213 @@
+"""
+Fit once, audit many times: FairnessAuditor fits the causal forests of an audit once, keeps them with the encoders of the data (on disk too, see save and cache_dir),
+and computes the measure table of the training data or of new data (e.g. the next month) from their predictions, without refitting.
+"""
+from causal_forest import crf_predict, effect_measures
+from decompositions import _segment_codes, _max_mc_error
+from design import AuditData
+from results import MeasureStore
+from checkpoint import seed_state, write_file
+from profiling import as_profiler
+from helpers import index_dtype
+from bootstrap import subset_rows
+import econml
+import hashlib
+import joblib
+import json
+import os
+import numpy as np
+
+
+class FairnessAuditor:
+    """
+    Decompose the causal effects with causal forests (as fairness_cookbook with method "causal_forest"), in two steps: fit encodes the data and fits the forests of every outter repetition,
+    score turns their predictions into the measures.
+
+    On the data the forests were fitted on, score uses their out-of-bag predictions, and gives the measures of fairness_cookbook with the same seed, for any nboot2, inference or segments.
+    On other data, encoded by the encoders learnt at fit time, no row was seen by any tree: score uses the predictions of the forests of every outter repetition on all its rows,
+    so that the spread of the measures reflects both the refits of the outter repetitions and the inner bootstrap of the new rows.
+
+        auditor = FairnessAuditor("sex", Z, W, "salary", "female", "male", nboot1 = 10, seed = 1, cache_dir = "audits").fit(data)
+        res, res_summary = auditor.score(data)                 #in-sample, as fairness_cookbook
+        res, res_summary = auditor.score(next_month, nboot2 = 500)
+        auditor.save("auditor.joblib")
+
+    :X, Z, W, Y, x0, x1:(see fairness_cookbook)
+    :nboot1:(integer) number of outter repetitions, each with its own forests. Default 1.
+    :if_auto_dummy, encoding, seed, resample, subset_size, compact:(see fairness_cookbook) the seed is drawn at random if None, and recorded in seed_.
+    :crf_*:(see fairness_cookbook) crf_n_jobs is the number of threads of the forests of a repetition (-1, all cores).
+    :cache_dir:(string or None) directory of a content-addressed cache of fitted forests: fit loads them from there when the same encoded data (see AuditData.fingerprint)
+        was already fitted with the same parameters and seed, instead of refitting. A cache hit thus needs a seed. Default None (no cache).
+
+    Attributes set by fit: encoders_ (the Z and W CategoricalEncoder, None if the data was numeric), columns_ and n_z_ (layout of the design matrix), outcomes_, n_ (rows of the training data),
+    fingerprint_ (of the encoded training data), seed_ (SeedSequence), reps_ (one dictionary per outter repetition: forests, a list of ("te" or "med", outcome index, forest),
+    rows, the rows of the training data in its outter sample, crf_te and crf_med, their out-of-bag predictions, plan_seed, and weight, the replicate weights of the rows with resample "poisson" or "dirichlet") 
+    and cache_hit_ (whether fit loaded them from cache_dir).
+    """
+
+    def __init__(self, X, Z, W, Y, x0, x1, nboot1 = 1, if_auto_dummy = True, encoding = "dummy",
+                 crf_n_estimators = 100,
+                 crf_criterion = "het",
+                 crf_min_samples_leaf = 5,
+                 crf_max_features = "sqrt",
+                 crf_honest = True,
+                 crf_max_samples = 0.5,
+                 crf_min_samples_split = 2,
+                 crf_min_balancedness_tol = 0.45,
+                 crf_inference = False,
+                 crf_n_jobs = -1,
+                 crf_concurrent = True,
+                 crf_oob_batch = 2**16,
+                 seed = None,
+                 resample = "index",
+                 subset_size = None,
+                 compact = False,
+                 cache_dir = None):
+        self.X, self.Z, self.W, self.Y, self.x0, self.x1 = X, Z, W, Y, x0, x1
+        self.nboot1 = nboot1
+        self.if_auto_dummy = if_auto_dummy
+        self.encoding = encoding
+        self.crf_params = dict(n_estimators = crf_n_estimators, criterion = crf_criterion, min_samples_leaf = crf_min_samples_leaf, max_features = crf_max_features, honest = crf_honest,
+                               max_samples = crf_max_samples, min_samples_split = crf_min_samples_split, min_balancedness_tol = crf_min_balancedness_tol, inference = crf_inference, n_jobs = crf_n_jobs)
+        self.crf_concurrent = crf_concurrent
+        self.crf_oob_batch = crf_oob_batch
+        self.seed = seed
+        self.resample = resample
+        self.subset_size = subset_size
+        self.compact = compact
+        self.cache_dir = cache_dir
+
+    def _encode(self, data, encoders = None):
+        if isinstance(data, AuditData):
+            return data
+        dtype = np.float32 if self.compact else np.float64
+        if encoders is None:
+            return AuditData.from_frame(data, self.X, self.Z, self.W, self.Y, self.x0, dtype = dtype, encode = self.if_auto_dummy, encoding = self.encoding)
+        return AuditData.from_frame(data, self.X, self.Z, self.W, self.Y, self.x0, dtype = dtype, encoders = encoders)
+
+    def cache_key(self, fingerprint):
+        """
+        :fingerprint:(string) fingerprint of the encoded training data (see AuditData.fingerprint)
+        :return:(string) name of the fitted forests in cache_dir: a hash of the data, of the parameters that change the fits (not crf_n_jobs, crf_concurrent nor crf_oob_batch), of the seed and of the EconML version
+        """
+        params = {k: v for k, v in self.crf_params.items() if k != "n_jobs"}
+        key = dict(data = fingerprint, crf = params, nboot1 = self.nboot1, seed = seed_state(self.seed_), resample = self.resample, subset_size = self.subset_size,
+                   compact = self.compact, columns = [str(c) for c in (self.X, self.x0, self.x1)], econml = econml.__version__)
+        return hashlib.blake2b(json.dumps(key, sort_keys = True, default = repr).encode(), digest_size = 20).hexdigest()
+
+    def fit(self, data, profiler = None):
+        """
+        Encode the data and fit the two forests of every outter repetition (or load them from cache_dir)
+
+        :data:(dataframe or AuditData)
+        :profiler:(None, profiling.Profiler or function) see fairness_cookbook
+        :return:(FairnessAuditor) self
+        """
+        profiler = as_profiler(profiler)
+        with profiler.stage("encode"):
+            audit = self._encode(data)
+        self.seed_ = self.seed if isinstance(self.seed, np.random.SeedSequence) else np.random.SeedSequence(np.random.randint(np.iinfo(np.int32).max) if self.seed is None else self.seed)
+        self.encoders_, self.columns_, self.n_z_ = audit.encoders, audit.columns, audit.n_z
+        self.outcomes_, self.multi_, self.n_ = audit.outcomes, audit.multi, audit.n
+        self.fingerprint_ = audit.fingerprint()
+
+        path = None if self.cache_dir is None else os.path.join(self.cache_dir, self.cache_key(self.fingerprint_) + ".joblib")
+        self.cache_hit_ = path is not None and os.path.exists(path)
+        if self.cache_hit_:
+            self.reps_ = joblib.load(path)
+            return self
+
+        #the outter repetitions draw the same samples and seeds as those of fairness_cookbook
+        rep_seeds = self.seed_.spawn(self.nboot1)
+        self.reps_ = []
+        for r in range(self.nboot1):
+            forests = []
+            with profiler.stage("rep", r):
+                _, _, crf_te, crf_med, plan_seed, rows, weight = crf_predict(audit, r, self.crf_params, random_state = rep_seeds[r], resample = self.resample, subset_size = self.subset_size,
+                                                                             profiler = profiler, concurrent = self.crf_concurrent, oob_batch = self.crf_oob_batch, forests = forests)
+            if self.compact:
+                crf_te, crf_med = [v.astype(np.float32) for v in crf_te], [v.astype(np.float32) for v in crf_med]
+            self.reps_.append(dict(forests = forests, rows = rows.astype(index_dtype(audit.n)), crf_te = crf_te, crf_med = crf_med, plan_seed = plan_seed, weight = weight))
+
+        if path is not None:
+            os.makedirs(self.cache_dir, exist_ok = True)
+            _dump(self.reps_, path)
+        return self
+
+    def _predict(self, audit, rep):
+        #predictions of the forests of one outter repetition on all the rows of audit, by blocks of rows
+        features = np.asarray(audit.features, dtype = np.float64)
+        batch = audit.n if self.crf_oob_batch is None else self.crf_oob_batch
+        preds = {"te": [], "med": []}
+        for name, _, forest in rep["forests"]:
+            x = features[:, :self.n_z_] if name == "te" else features
+            pred = np.concatenate([forest.predict(x[a:a + batch]).ravel() for a in range(0, max(audit.n, 1), batch)])
+            preds[name].append(pred.astype(np.float32) if self.compact else pred)
+        return preds["te"], preds["med"]
+
+    def score(self, data, nboot2 = 100, inference = "bootstrap", segments = None, return_store = False, profiler = None):
+        """
+        Compute the measures from the fitted forests, without refitting
+
+        :data:(dataframe or AuditData) the training data (recognised by its fingerprint), or new data with the same columns, encoded by encoders_
+        :nboot2:(integer) number of inner bootstrap samples of every outter repetition
+        :inference, segments, return_store, profiler:(see fairness_cookbook)
+        :return1:(dataframe or MeasureStore) measures of every inner bootstrap sample, as fairness_cookbook
+        :return2:(dataframe) their summary, as fairness_cookbook. Its attrs also record whether the data was the training data ("in_sample").
+        """
+        if not hasattr(self, "reps_"):
+            raise ValueError("the FairnessAuditor is not fitted, call fit first")
+        profiler = as_profiler(profiler)
+        with profiler.stage("encode"):
+            audit = self._encode(data, self.encoders_)
+        if list(audit.columns) != list(self.columns_):
+            raise ValueError("data is encoded into other columns than the training data: %s instead of %s" % (list(audit.columns), list(self.columns_)))
+        in_sample = audit.fingerprint() == self.fingerprint_
+        codes, segment_names = _segment_codes(data, segments, audit.n)
+
+        analytic = inference == "analytic"
+        store = MeasureStore(self.nboot1, 1 if analytic else nboot2, outcomes = self.outcomes_ if self.multi_ else None, with_se = analytic,
+                             between = True if self.subset_size is None else subset_rows(self.subset_size, self.n_) / self.n_, segments = segment_names)
+        has_z, has_w = audit.n_z > 0, audit.n_w > 0
+        for r, rep in enumerate(self.reps_):
+            with profiler.stage("rep", r):
+                if in_sample:
+                    rows, crf_te, crf_med, weight = rep["rows"], rep["crf_te"], rep["crf_med"], rep.get("weight")
+                else:
+                    with profiler.stage("crf_predict", r):
+                        crf_te, crf_med = self._predict(audit, rep)
+                    #no row of the new data was weighted by the fits, its inner weights are drawn around 1
+                    rows, weight = np.arange(audit.n), None
+                values = effect_measures(audit.t[rows], audit.y[rows], crf_te, crf_med, rep["plan_seed"], rows, audit.n, has_z, has_w, audit.multi,
+                                         nboot = nboot2, inference = inference, segments = codes, compact = self.compact, profiler = profiler, rep = r, resample = self.resample, weight = weight)
+            if analytic:
+                store.write(r, values[0], se = values[1])
+            else:
+                store.write(r, values)
+        store.stop_reason = "max_reps"
+
+        with profiler.stage("summary"):
+            res_summary = store.summary()
+            res_summary.attrs.update(n_reps = self.nboot1, stop_reason = "max_reps", mc_error = _max_mc_error(store, None), in_sample = in_sample)
+        return (store if return_store else store.to_frame()), res_summary
+
+    def save(self, path):
+        """
+        Write the fitted auditor (encoders and forests) to path, compressed
+        """
+        _dump(self, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        :path:(string) file written by save
+        :return:(FairnessAuditor)
+        """
+        auditor = joblib.load(path)
+        if not isinstance(auditor, cls):
+            raise ValueError("%r does not hold a FairnessAuditor" % (path,))
+        return auditor
+
+
+def _dump(value, path):
+    write_file(path, lambda f: joblib.dump(value, f, compress = 3), binary = True)
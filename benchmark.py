@@ -0,0 +1,163 @@
+"""
+Time and memory of the stages of an audit on data simulated by simulate.simulate_scm, at several scales, with the error of the estimates against the true effects.
+The results are written to a JSON file, to compare versions or the speed and accuracy of the different methods and modes:
+
+    python benchmark.py --sizes 10000 100000 1000000 --out benchmark.json
+
+The encodings of a high-cardinality categorical column (fit time against the stability and error of the estimates) are compared with e.g.
+
+    python benchmark.py --sizes 20000 --stages encoding --z-levels 2000 --nboot1 5
+"""
+from simulate import simulate_scm
+from helpers import auto_dummy, msd_one, msd_two, msd_three
+from encoders import ENCODINGS
+from design import AuditData
+from bootstrap import BootPlan
+from causal_forest import ci_crf
+from decompositions import fairness_cookbook
+import argparse
+import json
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+import numpy as np
+
+X, Z, W, Y, x0, x1 = "x", ["z_num", "z_cat"], ["w_num", "w_cat"], "y", "x0", "x1"
+STAGES = ["auto_dummy", "encode", "boot_plan", "msd", "ci_crf", "fairness_cookbook", "encoding"]
+METHODS = ["causal_forest", "medDML", "OLS"]
+
+
+def measure(fun, *args, memory=True, **kwargs):
+    """
+    :fun:(function) called with *args and **kwargs
+    :memory:(True/False) whether to run fun a second time under tracemalloc for its peak memory (tracing slows down the many small allocations of some models, so it is not timed)
+    :return:(tuple) output of fun, seconds it took, and peak memory (MB) allocated while it ran, as traced by tracemalloc (numpy arrays included), None if not memory
+    """
+    start = time.perf_counter()
+    out = fun(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    if not memory:
+        return out, seconds, None
+    
+    tracemalloc.start()
+    try:
+        fun(*args, **kwargs)
+        peak = tracemalloc.get_traced_memory()[1] / 2**20
+    finally:
+        tracemalloc.stop()
+    return out, seconds, peak
+
+
+def _errors(summary, truth):
+    #estimate - truth and std of each measure, nan as None to keep the file valid JSON
+    res = {}
+    for key, values in (("error", summary[("value", "mean")] - truth), ("std", summary[("value", "std")])):
+        res[key] = {m: (None if np.isnan(v) else float(v)) for m, v in values.items()}
+    return res
+
+
+def _rep_std(res):
+    #spread of the estimates of the outter repetitions (the refits), without the inner bootstrap
+    spread = res.groupby(["measure", "rep"])["value"].mean().groupby("measure").std()
+    return {"rep_std": {m: (None if np.isnan(v) else float(v)) for m, v in spread.items()}}
+
+
+def _meta(params):
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd = os.path.dirname(os.path.abspath(__file__)), capture_output = True, text = True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "commit": commit, "python": platform.python_version(), "numpy": np.__version__,
+            "platform": platform.platform(), "cpu_count": os.cpu_count(), "params": params}
+
+
+def run_benchmark(sizes = (10000, 100000, 1000000), stages = STAGES, methods = METHODS, nboot1 = 1, nboot2 = 100, crf_n_estimators = 100, n_jobs = 1, seed = 0, memory = True, out = None, compact = False,
+                  z_levels = 10, encodings = ENCODINGS[:-1], **kwargs):
+    """
+    Run the stages on simulated data of each size
+
+    :sizes:(list) numbers of rows
+    :stages:(list) stages to run, among STAGES:
+        "auto_dummy" (encoding of the categorical columns as the notebook does), "encode" (AuditData.from_frame), "boot_plan" (stored inner bootstrap indexes),
+        "msd" (msd_one, msd_two and msd_three on the plan), "ci_crf" (one outter repetition), "fairness_cookbook" (end to end, once per method),
+        "encoding" (fairness_cookbook with the causal forests, once per encoding of the categorical columns: its time, number of features, and the spread of the estimates over the nboot1 refits in rep_std)
+    :methods:(list) methods of fairness_cookbook to run
+    :nboot1, nboot2, crf_n_estimators, n_jobs:(see fairness_cookbook)
+    :seed:(integer) seed of the simulated data and of the audits
+    :memory:(True/False) whether to record the peak memory of each stage, at the cost of running it twice (see measure)
+    :out:(string or None) path of the JSON file the results are written to
+    :compact:(True/False) run every stage on the reduced-precision data path (float32 design and inner bootstrap means, see fairness_cookbook compact). Default False.
+    :z_levels:(integer) number of levels of the categorical confounder z_cat of the simulated data (see simulate_scm), e.g. in the thousands to compare the encodings on a high-cardinality column. Default 10.
+    :encodings:(list) encodings run by the stage "encoding", see encoders.CategoricalEncoder. Default all but "auto".
+    :kwargs:(dictionary) other parameters of fairness_cookbook (e.g. subset_size, inference), also recorded in the file
+    :return:(dictionary) "meta" (version, machine and parameters) and "results" (one record per stage, size and method (or encoding): seconds, peak_mb, and for the estimating stages error and std of each measure)
+    """
+    params = dict(sizes = list(sizes), stages = list(stages), methods = list(methods), nboot1 = nboot1, nboot2 = nboot2, crf_n_estimators = crf_n_estimators, n_jobs = n_jobs, seed = seed, memory = memory, compact = compact,
+                  z_levels = z_levels, encodings = list(encodings), **kwargs)
+    report = {"meta": _meta(params), "results": []}
+
+    def record(stage, n, seconds, peak, method = None, **extra):
+        report["results"].append(dict(stage = stage, n = int(n), method = method, seconds = seconds, peak_mb = peak, **extra))
+        print("%-18s %-14s n=%-9d %9.3fs %10s MB" % (stage, method or "", n, seconds, "-" if peak is None else "%.1f" % peak), flush = True)
+
+    for n in sizes:
+        data, truth = simulate_scm(n, z_levels = z_levels, seed = seed)
+        dtype = np.float32 if compact else np.float64
+        audit = AuditData.from_frame(data, X, Z, W, Y, x0, dtype = dtype, encode = True)
+
+        if "auto_dummy" in stages:
+            _, seconds, peak = measure(auto_dummy, data, np.array(Z + W), compact = compact, memory = memory)
+            record("auto_dummy", n, seconds, peak)
+        if "encode" in stages:
+            _, seconds, peak = measure(AuditData.from_frame, data, X, Z, W, Y, x0, dtype = dtype, encode = True, memory = memory)
+            record("encode", n, seconds, peak)
+        if "boot_plan" in stages or "msd" in stages:
+            plan, seconds, peak = measure(BootPlan, audit.t == 0, nboot2, seed, compact = compact, memory = memory)
+            if "boot_plan" in stages:
+                record("boot_plan", n, seconds, peak)
+        if "msd" in stages:
+            y = audit.y[:, 0]
+            msd = lambda: (msd_one(y, "id0", "y_id0", plan), msd_two(y, "id1", -y, "id0", "tv", plan), msd_three(y, "all", y, "id1", -y, "id0", "three", plan))
+            _, seconds, peak = measure(msd, memory = memory)
+            record("msd", n, seconds, peak)
+        if "ci_crf" in stages:
+            res, seconds, peak = measure(ci_crf, audit, X, Z, W, Y, x0, x1, rep = 0, nboot = nboot2, crf_n_estimators = crf_n_estimators, random_state = seed, compact = compact, memory = memory)
+            record("ci_crf", n, seconds, peak, **_errors(res.groupby("measure").agg({'value':['mean','std']}), truth))
+        if "fairness_cookbook" in stages:
+            for method in methods:
+                (_, summary), seconds, peak = measure(fairness_cookbook, data, X, Z, W, Y, x0, x1, method = method, nboot1 = nboot1, nboot2 = nboot2,
+                                                      crf_n_estimators = crf_n_estimators, n_jobs = n_jobs, seed = seed, compact = compact, memory = memory, **kwargs)
+                record("fairness_cookbook", n, seconds, peak, method, **_errors(summary, truth))
+        if "encoding" in stages:
+            for encoding in encodings:
+                n_features = AuditData.from_frame(data, X, Z, W, Y, x0, dtype = dtype, encode = True, encoding = encoding).features.shape[1]
+                (res, summary), seconds, peak = measure(fairness_cookbook, data, X, Z, W, Y, x0, x1, method = "causal_forest", nboot1 = nboot1, nboot2 = nboot2, crf_n_estimators = crf_n_estimators, 
+                                                        n_jobs = n_jobs, seed = seed, compact = compact, encoding = encoding, memory = memory, **kwargs)
+                record("encoding", n, seconds, peak, encoding, n_features = n_features, **_errors(summary, truth), **_rep_std(res))
+
+    if out is not None:
+        with open(out, "w") as f:
+            json.dump(report, f, indent = 1)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Benchmark the stages of an audit on simulated data.")
+    parser.add_argument("--sizes", type = int, nargs = "+", default = [10000, 100000, 1000000])
+    parser.add_argument("--stages", nargs = "+", default = STAGES, choices = STAGES)
+    parser.add_argument("--methods", nargs = "+", default = METHODS, choices = METHODS)
+    parser.add_argument("--nboot1", type = int, default = 1)
+    parser.add_argument("--nboot2", type = int, default = 100)
+    parser.add_argument("--crf-n-estimators", type = int, default = 100)
+    parser.add_argument("--n-jobs", type = int, default = 1)
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--no-memory", action = "store_true", help = "do not record the peak memory (each stage then runs once)")
+    parser.add_argument("--out", default = "benchmark.json")
+    parser.add_argument("--compact", action = "store_true", help = "reduced-precision data path (float32 design and inner bootstrap means)")
+    parser.add_argument("--z-levels", type = int, default = 10, help = "levels of the categorical confounder of the simulated data")
+    parser.add_argument("--encodings", nargs = "+", default = list(ENCODINGS[:-1]), choices = ENCODINGS, help = "encodings compared by the stage encoding")
+    args = parser.parse_args()
+    run_benchmark(args.sizes, args.stages, args.methods, args.nboot1, args.nboot2, args.crf_n_estimators, args.n_jobs, args.seed, not args.no_memory, args.out, args.compact, 
+                  args.z_levels, args.encodings)
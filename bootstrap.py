@@ -0,0 +1,357 @@
+import copy
+import os
+import tempfile
+import numpy as np
+import scipy.sparse as sp
+from helpers import boot_sums, index_dtype, mean_shift, shared_dir
+
+
+#number of rows of the columns stacked at once by BootPlan.means_many, longer data is streamed by blocks of rows
+_ROW_CHUNK = 2**20
+
+#resampling schemes drawing replicate weights instead of rows, see replicate_weights
+WEIGHTED = ("poisson", "dirichlet")
+
+#number of rows whose replicate weights are drawn from one generator
+WEIGHT_CHUNK = 2**16
+
+
+def replicate_weights(scheme, seed, n, rate=1.0, start=0, dtype=np.float64):
+    """
+    Weights of the rows of one replicate of a weighted bootstrap: Poisson(rate) counts ("poisson"), or Gamma(rate) weights ("dirichlet", the Bayesian bootstrap: 
+    normalized to sum to one, they are a Dirichlet draw), which the weighted means and model fits use in place of a resample of the rows.
+    Every row is drawn independently, and every block of WEIGHT_CHUNK rows from its own generator derived from seed and the position of the block, 
+    so that the weights of rows start, start+1, ... are the same whether they are drawn alone (e.g. one chunk of a file, or the rows of one worker) or with all the others, 
+    as long as start is a multiple of WEIGHT_CHUNK.
+    
+    :scheme:("poisson" or "dirichlet")
+    :seed:(integer or SeedSequence) seed of the replicate
+    :n:(integer) number of rows drawn
+    :rate:(float or 1-d array) mean weight of every row, or of each of the n rows. Default 1.
+    :start:(integer) position of the first row, a multiple of WEIGHT_CHUNK. Default 0.
+    :dtype:(numpy dtype) dtype of the weights. Default float64.
+    :return:(1-d array) the n weights
+    """
+    if scheme not in WEIGHTED:
+        raise ValueError("scheme must be 'poisson' or 'dirichlet', got %r" % (scheme,))
+    if start % WEIGHT_CHUNK != 0:
+        raise ValueError("start must be a multiple of WEIGHT_CHUNK (%d), got %d" % (WEIGHT_CHUNK, start))
+    seed = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    rate = np.broadcast_to(np.asarray(rate, dtype=np.float64), (n,))
+    w = np.empty(n, dtype=dtype)
+    for a in range(0, n, WEIGHT_CHUNK):
+        b = min(a + WEIGHT_CHUNK, n)
+        rng = np.random.default_rng(np.random.SeedSequence(seed.entropy, spawn_key=tuple(seed.spawn_key) + ((start + a) // WEIGHT_CHUNK,)))
+        w[a:b] = rng.poisson(rate[a:b]) if scheme == "poisson" else rng.standard_gamma(rate[a:b])
+    return w
+
+
+class BootPlan:
+    """
+    Inner bootstrap plan shared by all the measures of one outer repetition.
+
+    Every bootstrap sample b is drawn from its own generator, derived from "seed" and b, so the plan can either be stored as one contiguous
+    (nboot x n) index array, or regenerated chunk by chunk on demand ("lazy") without ever holding the whole plan in memory. Both give the same samples.
+
+    :group0:(1-d bool array) mask of the rows at the 0-level of the protected attribute, computed once for the data the plan refers to
+    :nboot:(integer) number of bootstrap samples
+    :seed:(integer or None) entropy used to generate the bootstrap samples. A random one is drawn if None.
+    :lazy:(True/False) if True, the indexes are regenerated from the seed whenever they are needed instead of being stored. Default False.
+    :chunk_size:(integer) number of bootstrap samples processed together when iterating over the plan
+    :size:(integer or None) number of rows drawn by each bootstrap sample. Default None, the number of rows n. 
+        Otherwise (bag of little bootstraps: the n rows are a subset of a larger sample of "size" rows), the plan holds the multinomial counts of the rows instead of their indexes.
+    :compact:(True/False) if True, the counts and the columns averaged by means_many are float32, summed in float32 around their helpers.mean_shift (in float64 across the blocks of long data). 
+        The indexes are int32 whenever they fit, compact or not. Default False.
+    :scheme:("multinomial", "poisson" or "dirichlet") "multinomial" draws size rows with replacement (indexes, or counts with size), 
+        "poisson" and "dirichlet" draw independent replicate weights for the rows instead (see replicate_weights), with means size * weight / sum(weight): 
+        the plan then holds (nboot x n) weights, every mean of means_many is a weighted mean, and the samples have no indexes (replicate and to_dict are not available). Default "multinomial".
+    :weight:(1-d array or None) with "poisson" and "dirichlet", weight of every row in the sample the plan resamples (e.g. the replicate weights of the outter repetition), 
+        which the weights of the plan are drawn around. Default None, the same for all rows.
+    """
+
+    def __init__(self, group0, nboot, seed=None, lazy=False, chunk_size=16, size=None, compact=False, scheme="multinomial", weight=None):
+        self.group0 = np.ascontiguousarray(group0, dtype=bool)
+        self.n = self.group0.shape[0]
+        self.nboot = int(nboot)
+        self.seed = np.random.SeedSequence().entropy if seed is None else int(seed)
+        self.lazy = lazy
+        self.chunk_size = max(int(chunk_size), 1)
+        self.size = self.n if size is None else int(size)
+        self.counts = self.size != self.n
+        self.dtype = index_dtype(max(self.n, self.size))
+        self.compact = compact
+        self.value_dtype = np.float32 if compact else np.float64
+        if scheme not in ("multinomial",) + WEIGHTED:
+            raise ValueError("scheme must be 'multinomial', 'poisson' or 'dirichlet', got %r" % (scheme,))
+        self.scheme = scheme
+        self.weighted = scheme in WEIGHTED
+        if self.weighted:
+            self.rate = self.size / self.n if weight is None else self.size * np.asarray(weight, dtype=np.float64) / np.sum(weight)
+        self.indices = None if lazy else self._generate(0, self.nboot)
+        self.path = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("_tmp", None)
+        if self.path is not None:
+            state.update(indices = None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if state.get("path") is not None:
+            self.indices = np.load(os.path.join(self.path, "indices.npy"), mmap_mode="r")
+
+    def share(self, directory=None):
+        """
+        Publish a stored plan for worker processes, as design.AuditData.share: its indexes are written once to a file of the shared memory of the host and mapped read-only, 
+        and the plan is pickled without them. The file is removed by close, when the returned plan is garbage collected, or at exit.
+
+        :directory:(string or None) see AuditData.share
+        :return:(BootPlan) self if the plan is lazy (it only holds its seed) or already shared, otherwise the published copy
+        """
+        if self.indices is None or self.path is not None:
+            return self
+        tmp = tempfile.TemporaryDirectory(prefix="plan_", dir=shared_dir(self.indices.nbytes) if directory is None else directory)
+        np.save(os.path.join(tmp.name, "indices.npy"), self.indices)
+        plan = copy.copy(self)
+        plan.indices = np.load(os.path.join(tmp.name, "indices.npy"), mmap_mode="r")
+        plan.path, plan._tmp = tmp.name, tmp
+        return plan
+
+    def close(self):
+        """
+        Remove the file of a plan published by share. Does nothing otherwise.
+        """
+        tmp = getattr(self, "_tmp", None)
+        if tmp is not None:
+            tmp.cleanup()
+            self._tmp = None
+
+    def __len__(self):
+        return self.nboot
+
+    def _generate(self, start, stop):
+        if self.weighted:
+            block = np.empty((stop - start, self.n), dtype=self.value_dtype)
+            for i, b in enumerate(range(start, stop)):
+                block[i] = replicate_weights(self.scheme, np.random.SeedSequence(self.seed, spawn_key=(b,)), self.n, self.rate, dtype=self.value_dtype)
+            return block
+        block = np.empty((stop - start, self.n), dtype=self.dtype)
+        for i, b in enumerate(range(start, stop)):
+            rng = np.random.default_rng(np.random.SeedSequence(self.seed, spawn_key=(b,)))
+            if self.counts:
+                block[i] = rng.multinomial(self.size, np.full(self.n, 1 / self.n))
+            else:
+                block[i] = rng.integers(0, self.n, self.n, dtype=self.dtype)
+        return block
+
+    def replicate(self, b):
+        """
+        :b:(integer) bootstrap id
+        :return:(1-d array) the row indexes of bootstrap sample b
+        """
+        self._check_indexes()
+        ind = self.indices[b] if self.indices is not None else self._generate(b, b + 1)[0]
+        return np.repeat(np.arange(self.n, dtype=self.dtype), ind) if self.counts else ind
+
+    def chunks(self, chunk_size=None):
+        """
+        Iterate over the plan by blocks of bootstrap samples
+
+        :chunk_size:(integer) number of bootstrap samples per block. Default self.chunk_size.
+        :return:(generator) of (start, block), where block is the (chunk_size x n) index array of the bootstrap samples start, start+1, ... (their (chunk_size x n) counts if self.counts, weights if self.weighted)
+        """
+        chunk_size = self.chunk_size if chunk_size is None else max(int(chunk_size), 1)
+        for start in range(0, self.nboot, chunk_size):
+            stop = min(start + chunk_size, self.nboot)
+            block = self.indices[start:stop] if self.indices is not None else self._generate(start, stop)
+            yield start, block
+
+    def weights(self, block):
+        """
+        :block:(2-d array) index block as yielded by chunks
+        :return:(sparse matrix) (len(block) x n) counts of each row in each bootstrap sample of the block (the dense block itself if self.weighted)
+        """
+        if self.weighted:
+            return block
+        if self.counts:
+            return sp.csr_matrix(block, dtype=self.value_dtype)
+        nb = block.shape[0]
+        indptr = np.arange(0, nb * self.n + 1, self.n, dtype=index_dtype(nb * self.n))
+        return sp.csr_matrix((np.ones(nb * self.n, dtype=self.value_dtype), block.ravel(), indptr), shape=(nb, self.n))
+
+    def masks(self):
+        """
+        :return:(dictionary) row masks of the index names "all", "id0" and "id1"
+        """
+        return {"all": np.ones(self.n, dtype=bool), "id0": self.group0, "id1": ~self.group0}
+
+    def means_many(self, cols, masks=None):
+        """
+        Calculate the mean (ignoring nan) of several vectors over several index names in a single pass over the plan
+
+        :cols:(dictionary) keys are index names ("all", "id0", "id1", or those of masks), values are lists of 1-d arrays of length n
+        :masks:(dictionary or None) row masks of additional index names, e.g. the rows of a segment (see segment_masks)
+        :return:(dictionary) same keys, values are (nboot x len(cols[t])) arrays of bootstrap means
+        """
+        masks = self.masks() if masks is None else {**self.masks(), **masks}
+        pairs = [(masks[t], x) for t in cols for x in cols[t]]
+        dtype = self.value_dtype
+        stack = lambda a, b: np.column_stack([np.where(m[a:b], np.asarray(x[a:b], dtype=dtype), dtype(np.nan)) for m, x in pairs]) if len(pairs) > 0 else np.empty((b - a, 0), dtype=dtype)
+        #the columns are stacked once if they fit in _ROW_CHUNK rows, otherwise the sums are accumulated block by block (e.g. over memory-mapped data)
+        stacked = stack(0, self.n) if self.n <= _ROW_CHUNK else None
+        #compact: the float32 columns are summed around their mean_shift (estimated on the first block of rows), added back to the means in float64
+        shift = mean_shift(stacked if stacked is not None else stack(0, _ROW_CHUNK)) if self.compact else 0
+        if stacked is not None and self.compact:
+            stacked -= shift
+
+        out = np.empty((self.nboot, len(pairs)))
+        for start, block in self.chunks():
+            w = self.weights(block)
+            if stacked is not None:
+                total, count = boot_sums(stacked, w)
+            else:
+                w = w.tocsc() if sp.issparse(w) else w
+                total, count = 0, 0
+                for a in range(0, self.n, _ROW_CHUNK):
+                    b = min(a + _ROW_CHUNK, self.n)
+                    total_ab, count_ab = boot_sums(stack(a, b) - shift, w[:, a:b])
+                    #the sums of the blocks are added up in float64
+                    total, count = total + np.asarray(total_ab, dtype=float), count + np.asarray(count_ab, dtype=float)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                out[start:start + block.shape[0]] = np.asarray(total, dtype=float) / count + np.asarray(shift, dtype=float)
+
+        res = {}
+        pos = 0
+        for t in cols:
+            res[t] = out[:, pos:pos + len(cols[t])]
+            pos += len(cols[t])
+        return res
+
+    def means(self, x, t):
+        """
+        :x:(1-d array) data input for calculation
+        :t:(string) index name, "all", "id0" or "id1"
+        :return:(1-d array) of length nboot, the mean of x (ignoring nan) over index t in each bootstrap sample
+        """
+        return self.means_many({t: [x]})[t][:, 0]
+
+    def _check_indexes(self):
+        if self.weighted:
+            raise ValueError("the samples of a %r plan are weights, without row indexes (see weights and means_many)" % (self.scheme,))
+
+    def to_dict(self):
+        """
+        :return:(nested dictionary) the plan in the boots format used by msd_one, msd_two and msd_three
+        """
+        self._check_indexes()
+        boots = {}
+        for start, block in self.chunks():
+            for i, ind in enumerate(block):
+                ind = np.repeat(np.arange(self.n, dtype=self.dtype), ind) if self.counts else ind
+                idx0 = self.group0[ind]
+                boots[start + i] = {"all": ind, "id0": ind[idx0], "id1": ind[~idx0]}
+        return boots
+
+
+def segment_masks(segments, rows, group0):
+    """
+    Row masks of the segments in an outter bootstrap sample, as additional index names of BootPlan.means_many
+
+    :segments:(1-d int array) segment of each row of the data, from 0 to n_segments - 1 (-1 for the rows in no segment)
+    :rows:(1-d int array) row of the data each row of the outter bootstrap sample was drawn from (see outer_sample)
+    :group0:(1-d bool array) mask of the rows at the 0-level of the protected attribute in the outter bootstrap sample
+    :return:(list) one dictionary per segment, mapping the index names "all", "id0" and "id1" to (name, segment) and their masks
+    """
+    codes = np.asarray(segments)[rows]
+    res = []
+    for k in range(int(np.max(segments, initial=-1)) + 1):
+        seg = codes == k
+        res.append({name: ((name, k), mask) for name, mask in (("all", seg), ("id0", seg & group0), ("id1", seg & ~group0))})
+    return res
+
+
+def subset_rows(subset_size, n):
+    """
+    :subset_size:(integer or float) number of rows of the subsets of the bag of little bootstraps, or if a float in (0, 1), the exponent gamma of b = n**gamma
+    :n:(integer) number of rows of the data
+    :return:(integer) number of rows b of each subset, between 2 and n
+    """
+    if isinstance(subset_size, (float, np.floating)):
+        if not 0 < subset_size < 1:
+            raise ValueError("a float subset_size is the exponent of n and must be in (0, 1), got %r" % (subset_size,))
+        subset_size = n ** subset_size
+    return int(min(max(round(subset_size), 2), n))
+
+
+def outer_sample(data, rep, random_state=None, resample="index", n_seeds=2, subset_size=None):
+    """
+    Draw the outter bootstrap sample of one repetition, the seed of its inner bootstrap plan and the seeds of the models fitted on it.
+    
+    :data:(AuditData)
+    :rep:(integer) scalar index input from the outter bootstrap loop, rep <= 1 uses the data as is
+    :random_state:(None, integer, SeedSequence or Generator) source of all the randomness of this repetition. If None, the global np.random state is used.
+    :resample:("index", "weight", "poisson" or "dirichlet") "index" gathers the drawn rows, "weight" keeps the distinct drawn rows with their counts as weights, 
+        "poisson" and "dirichlet" draw no rows but replicate weights (see replicate_weights), and keep the rows with a positive weight
+    :n_seeds:(integer) number of model seeds to draw
+    :subset_size:(integer, float or None) if given, bag of little bootstraps: every repetition (rep <= 1 included) fits on a random subset of subset_rows(subset_size, n) distinct rows, 
+        drawn without replacement, and its inner bootstrap samples draw n rows from them (see BootPlan size). Default None.
+    :return:(dictionary) 
+        "features", "t", "y": arrays the models are fitted on, 
+        "weight": their sample weights (None if unweighted), also the weights the inner plan is drawn around with "poisson" and "dirichlet" (see BootPlan weight), 
+        "expand": index mapping the rows of the outter bootstrap sample onto the fitted rows (None if they are the same), 
+        "rows": row of the data each row of the outter bootstrap sample was drawn from, 
+        "plan_seed": seed of the inner bootstrap plan, 
+        "seeds": model seeds (None each if random_state is None)
+    """
+    nrow_df = data.n
+    if random_state is None:
+        if subset_size is not None:
+            boot_samp = np.random.choice(nrow_df, subset_rows(subset_size, nrow_df), replace=False)
+        elif resample in WEIGHTED and rep>1:
+            boot_samp = np.random.randint(np.iinfo(np.int32).max)
+        else:
+            boot_samp = np.random.randint(0,nrow_df,nrow_df) if rep>1 else np.arange(0,nrow_df)  
+        plan_seed = np.random.randint(np.iinfo(np.int32).max)
+        seeds = [None] * n_seeds
+    else:
+        rng = np.random.default_rng(random_state)
+        if subset_size is not None:
+            boot_samp = rng.choice(nrow_df, subset_rows(subset_size, nrow_df), replace=False)
+        elif resample in WEIGHTED and rep>1:
+            boot_samp = rng.integers(np.iinfo(np.int64).max)
+        else:
+            boot_samp = rng.integers(0,nrow_df,nrow_df) if rep>1 else np.arange(0,nrow_df)
+        plan_seed = rng.integers(np.iinfo(np.int64).max)
+        seeds = rng.integers(np.iinfo(np.int32).max, size=n_seeds)
+    
+    #the models are fitted either on the resampled rows, or on the distinct drawn rows weighted by how often they were drawn, or on the rows weighted by their replicate weights
+    if subset_size is not None:
+        rows = np.sort(boot_samp)
+        features, t, y = data.take(rows)
+        weight, expand = None, None
+    elif rep <= 1:
+        rows = np.arange(nrow_df)
+        features, t, y = data.take(None)
+        weight, expand = None, None
+    elif resample == "index":
+        rows = boot_samp
+        features, t, y = data.take(boot_samp)
+        weight, expand = None, None
+    elif resample == "weight":
+        rows = boot_samp
+        counts = np.bincount(boot_samp, minlength=nrow_df)
+        keep = np.flatnonzero(counts)
+        features, t, y = data.take(keep)
+        weight, expand = counts[keep], np.searchsorted(keep, boot_samp)
+    elif resample in WEIGHTED:
+        #boot_samp is the seed of the replicate weights, drawn by blocks of rows. The rows with a zero Poisson weight are left out of the fits and of the inner bootstrap
+        w = replicate_weights(resample, int(boot_samp), nrow_df)
+        rows = np.flatnonzero(w) if resample == "poisson" else np.arange(nrow_df)
+        features, t, y = data.take(rows if resample == "poisson" else None)
+        weight, expand = w[rows], None
+    else:
+        raise ValueError("resample must be 'index', 'weight', 'poisson' or 'dirichlet', got %r" % (resample,))
+    
+    return {"features": features, "t": t, "y": y, "weight": weight, "expand": expand, "rows": rows, "plan_seed": plan_seed, "seeds": seeds}
@@ -1,9 +1,24 @@
-from helpers import msd_one, msd_two, msd_three, inh_str
-import pandas as pd
+from results import MEASURES, measures_frame, measure_values, analytic_measures, shape_values, subset_se
+from bootstrap import BootPlan, WEIGHTED, outer_sample, segment_masks
+from design import AuditData
+from helpers import if_mean
+from profiling import as_profiler
+from concurrent.futures import ThreadPoolExecutor
+from joblib import Parallel, delayed
+from sklearn.utils import check_random_state
+import os
+import threading
+import warnings
 import numpy as np
+import econml
 from econml.grf import CausalForest
 
-#removed tune_params for now compared to the original version. Unlike the GRF library in R, the python's corresponding EconML's causal forest does not allow auto-tuning. I added several other parameters here for manual tuning.
+#the bounded-memory oob_predict replays private attributes of the econml forests, checked against forest.oob_predict up to this econml version. 
+#Later versions, or forests without these attributes, use forest.oob_predict
+_OOB_MAX_VERSION = (0, 17)
+_OOB_ATTRIBUTES = ("subsample_random_seed_", "inference_", "n_samples_", "n_samples_subsample_", "estimators_")
+
+#removed tune_params for now compared to the original version. Unlike the GRF library in R, the python's corresponding EconML's causal forest does not allow auto-tuning. I added several other parameters here for manual tuning. tuning.tune_crf searches them by successive halving.
 def ci_crf(data, X, Z, W, Y, x0, x1, rep, nboot = 100,
            crf_n_estimators = 2000, 
            crf_criterion = "het", 
@@ -13,15 +28,25 @@ def ci_crf(data, X, Z, W, Y, x0, x1, rep, nboot = 100,
            crf_max_samples = 0.5,
            crf_min_samples_split=2, 
            crf_min_balancedness_tol=0.45, 
-           crf_inference=False):
+           crf_inference=False,
+           crf_n_jobs=-1,
+           crf_concurrent=True,
+           crf_oob_batch=2**16,
+           random_state=None,
+           resample="index",
+           inference="bootstrap",
+           subset_size=None,
+           profiler=None,
+           segments=None,
+           compact=False):
     """
     Use causal random forest to decompose the causal effects.
     
-    :data:(dataframe)
+    :data:(dataframe or AuditData) if a dataframe, the columns of Z and W must be numeric. Passing an AuditData avoids encoding the data again on every call.
     :X:(array) scalar giving the name of the protected attribute. Must be one of the entries of data.columns
     :Z:(array) vector giving the names of all mediators. Must be one of the entries of data.columns
     :W:(array) vector giving the names of all confounders. Must be one of the entries of data.columns
-    :Y:(array) scalar giving the name of the outcome. Must be one of the entries of data.columns
+    :Y:(array) scalar giving the name of the outcome. Must be one of the entries of data.columns. A list of names audits all of them on the same bootstrap samples.
     :x0:(string) scalar values giving the two levels of the binary protected attribute.
     :x1:(string) scalar values giving the two levels of the binary protected attribute.
     :rep:(integer) scalar index input from the outter bootstrap loop
@@ -38,70 +63,325 @@ def ci_crf(data, X, Z, W, Y, x0, x1, rep, nboot = 100,
     :crf_min_samples_split:(int or float, default 10) – The minimum number of samples required to split an internal node
     :crf_min_balancedness_tol:(float in [0, .5], default .45) – How imbalanced a split we can tolerate. This enforces that each split leaves at least (.5 - min_balancedness_tol) fraction of samples on each side of the split
     :crf_inference:(True or False) whether inference (i.e. confidence interval construction and uncertainty quantification of the estimates) should be enabled.
+    :crf_n_jobs:(integer) number of threads of the forests of a repetition, for fitting and predicting, split between the two forests when they are fitted concurrently. -1 means all cores.
+    :crf_concurrent:(True/False) whether the Z-only and the Z+W forests (and their out-of-bag predictions) are fitted at the same time, each with half of crf_n_jobs threads. 
+        Neither depends on the other, and the parts of a fit that do not scale with the threads overlap, which shortens the repetitions on multi-core hosts. 
+        The results are the same either way, up to the rounding of the sums of the tree predictions (whose order already depends on the threads). Default True.
+    :crf_oob_batch:(integer or None) number of rows every tree predicts at once in the out-of-bag predictions (see oob_predict), which bounds their memory on long data. None predicts all rows at once. Default 65536.
+    
+    :random_state:(None, integer, SeedSequence or Generator) source of all the randomness of this repetition (outter and inner bootstrap, forests). If None, the global np.random state is used.
+    :resample:("index", "weight", "poisson" or "dirichlet") how the outter bootstrap sample is fed to the forests: "index" gathers the drawn rows, "weight" fits on the distinct drawn rows with their counts as sample_weight (no duplicated rows, so a row never shares a tree with its own copy). 
+        "poisson" and "dirichlet" draw no rows at all: every row gets an independent Poisson(1) or Gamma(1) (Bayesian bootstrap) replicate weight, passed as sample_weight to the forests, 
+        and the inner bootstrap samples draw their weights around them in the same way, their measures being weighted means (see bootstrap.replicate_weights and BootPlan scheme).
+        The weights of a row only depend on the seed and on its position, so they can be drawn chunk by chunk or on the machine that holds the row. Not with inference "analytic". Default "index".
+    :inference:("bootstrap" or "analytic") "bootstrap" evaluates the measures on nboot inner bootstrap samples. "analytic" skips them and returns one estimate per measure with its standard error, 
+        from the influence functions of the means the measure is made of (O(n) per measure, the forest predictions being taken as given like in the inner bootstrap). Default "bootstrap".
+    :subset_size:(integer, float or None) bag of little bootstraps: the forests are fitted on a random subset of rows drawn without replacement (an integer number of rows, or a float gamma in (0, 1) for n**gamma rows), 
+        and the inner bootstrap samples draw n rows from the subset, so that the spread of the measures is on the scale of the full data. The cost of the forests no longer grows with n. 
+        The repetitions are combined by a heuristic rule, see results.stats_summary. Default None (fit on the whole outter sample).
+    :profiler:(None, profiling.Profiler or function) records the time and memory of the stages (outter sample, fit and out-of-bag prediction of each forest, inner bootstrap, measures). A function is called with every event. Default None (off).
+    :segments:(1-d int array or None) segment of each row of data, from 0 to n_segments - 1 (-1 for the rows in no segment). The measures are then also computed within every segment, 
+        by averaging the per-row effects of the same forests over its rows, in the same pass over the inner bootstrap samples: no forest is fitted per segment. 
+        The segment effects are those of the forests fitted on all rows, conditional on Z (and W), so the segments are best defined by columns of Z or W. Default None.
+    :compact:(True/False) reduced-precision data path: a dataframe is encoded into a float32 design matrix (an AuditData is used as is, see AuditData.from_frame dtype), 
+        the out-of-bag predictions are kept in float32, and the inner bootstrap means are taken from float32 columns and counts, summed in float32 around an estimate of their mean (see bootstrap.BootPlan compact).
+        The outcomes, the measures and their standard errors stay float64. This halves the memory of the arrays held during a repetition, the forests themselves still fit on a float64 copy of the sampled rows. Default False.
+    
+    :return:(dataframe) This df inclused all types of causal effects. value=calculated measure, boot=row number/bootstrap id, measure=meas (name of the calculated measure). With inference="analytic", one row per measure (boot=0) and the columns se, ci_lower and ci_upper.
+        With segments, the column segment is the segment (0 to n_segments - 1), or -1 for all the rows.
+    """
+    values = crf_measures(data=data, X=X, Z=Z, W=W, Y=Y, x0=x0, x1=x1, rep=rep, nboot=nboot,
+                          crf_n_estimators=crf_n_estimators,
+                          crf_criterion=crf_criterion,
+                          crf_min_samples_leaf=crf_min_samples_leaf,
+                          crf_max_features=crf_max_features,
+                          crf_honest=crf_honest,
+                          crf_max_samples=crf_max_samples,
+                          crf_min_samples_split=crf_min_samples_split,
+                          crf_min_balancedness_tol=crf_min_balancedness_tol,
+                          crf_inference=crf_inference,
+                          crf_n_jobs=crf_n_jobs,
+                          crf_concurrent=crf_concurrent,
+                          crf_oob_batch=crf_oob_batch,
+                          random_state=random_state,
+                          resample=resample,
+                          inference=inference,
+                          subset_size=subset_size,
+                          profiler=profiler,
+                          segments=segments,
+                          compact=compact)
+    outcomes = data.outcomes if isinstance(data, AuditData) else Y
+    labels = None if segments is None else np.arange(-1, len(values[0] if inference == "analytic" else values) - 1)
+    if inference == "analytic":
+        return measures_frame(values[0], rep, outcomes = outcomes, se = values[1], segments = labels)
+    return measures_frame(values, rep, outcomes = outcomes, segments = labels)
+
+
+def crf_predict(data, rep, crf_params, random_state=None, resample="index", subset_size=None, profiler=None, concurrent=True, oob_batch=2**16, forests=None):
+    """
+    Draw the outter bootstrap sample of one repetition and get the out-of-bag predictions of the two causal forests on it.
     
-    :return:(dataframe) This df inclused all types of causal effects. value=calculated measure, boot=row number/bootstrap id, measure=meas (name of the calculated measure)
+    :data:(AuditData)
+    :rep:(integer) scalar index input from the outter bootstrap loop, rep <= 1 uses the data as is
+    :crf_params:(dictionary) parameters of econml.grf.CausalForest (except random_state). Its n_jobs is the number of threads of all the forests of the repetition.
+    :random_state:(None, integer, SeedSequence or Generator) see ci_crf
+    :resample:("index", "weight", "poisson" or "dirichlet") see ci_crf
+    :subset_size:(integer, float or None) see ci_crf
+    :profiler:(None, profiling.Profiler or function) see ci_crf
+    :concurrent:(True/False) see ci_crf crf_concurrent
+    :oob_batch:(integer or None) see ci_crf crf_oob_batch
+    :forests:(list or None) if given, the fitted forests are appended to it, as ("te" or "med", outcome index, forest) in the order they were fitted, instead of being discarded
+    :return:(tuple) t (treatment), y (2-d, one column per outcome), crf_te and crf_med (lists with one array per outcome, empty if Z resp. W is empty), 
+        all aligned on the rows of the outter bootstrap sample, the seed of the inner bootstrap plan, the row of data each row was drawn from, 
+        and with resample "poisson" or "dirichlet" the replicate weight of each row (None otherwise)
     """
-    #load data by using outter bootstrap index
-    nrow_df = data.shape[0]
-    boot_samp = np.random.randint(0,nrow_df,nrow_df) if rep>1 else np.arange(0,nrow_df)  
-    boot_data = data.iloc[boot_samp,:].reset_index(drop=True)
-    
-    
-    #creat index of this inner bootstrap
-    nrow_boot_df = boot_data.shape[0]
-    boots = dict.fromkeys(np.arange(nboot))
-    for key in boots:
-        boots[key] = dict.fromkeys(["all","id0","id1"])
-        ind = np.random.randint(0,nrow_boot_df,nrow_boot_df)
-        
-        idx0 = boot_data[X][ind] == x0
-        ind0 = ind[idx0]
-        ind1 = ind[~idx0]
-        
-        boots[key]["all"] = ind
-        boots[key]["id0"] = ind0
-        boots[key]["id1"] = ind1
-    
-    y = boot_data[Y].astype(float)
-    tv = msd_two(y, "id1", -y, "id0", "tv", boots) 
-    
-    if len(Z) == 0:
-        te = inh_str(tv,"te")
-        ett = inh_str(tv,"ett")
-        expse_x1 = inh_str(tv,"expse_x1",set0=True)
-        expse_x0 = inh_str(tv,"expse_x0",set0=True)
-        ctfse = inh_str(tv,"ctfse",set0=True)
-        crf_te = np.array([tv['value'][0]]*data.shape[0])
+    profiler = as_profiler(profiler)
+    with profiler.stage("outer_sample", rep):
+        samp = outer_sample(data, rep, random_state = random_state, resample = resample, subset_size = subset_size)
+    #the forests work in float64: a compact (float32) sample is converted once, instead of by every fit and prediction
+    features, t, y, weight = np.asarray(samp.pop("features"), dtype = np.float64), samp["t"], samp["y"], samp["weight"]
+    crf_seeds = samp["seeds"]
+    
+    #one pair of forests per outcome, all with the same seeds, so that the outcomes are audited on paired resamples
+    jobs = []
+    for j in range(data.n_y):
+        if data.n_z > 0:
+            jobs.append(("te", j, features[:, :data.n_z], y[:, j], crf_seeds[0]))
+        if data.n_w > 0:
+            jobs.append(("med", j, features, y[:, j], crf_seeds[1]))
+    
+    #the threads of the repetition are split between the forests fitted at the same time. 
+    #Stages recorded under tracemalloc would overlap, so the forests are then fitted one after the other
+    n_threads = (os.cpu_count() or 1) if crf_params["n_jobs"] == -1 else max(int(crf_params["n_jobs"]), 1)
+    n_parallel = min(2, len(jobs), n_threads) if concurrent and profiler.memory != "tracemalloc" else 1
+    params = dict(crf_params, n_jobs = max(n_threads // n_parallel, 1))
+    fit = lambda job: _fit_oob(params, job, t, weight, oob_batch, profiler, rep)
+    if n_parallel == 1:
+        fitted = [fit(job) for job in jobs]
     else:
-        crf_tmp = CausalForest(n_estimators = crf_n_estimators, criterion = crf_criterion, min_samples_leaf = crf_min_samples_leaf, max_features = crf_max_features, honest = crf_honest, max_samples = crf_max_samples, min_samples_split = crf_min_samples_split, min_balancedness_tol = crf_min_balancedness_tol, inference = crf_inference  )
-        crf_tmp.fit(X = boot_data[Z].values, T = np.where(boot_data[X].values==x0,0,1), y = y.values)
-        crf_te = crf_tmp.oob_predict(Xtrain =  boot_data[Z].values).ravel()
-        
-        te = msd_one(crf_te,"all","te",boots)
-        ett = msd_one(crf_te,"id0","ett",boots)
-        ctfse = msd_three(crf_te,"id0",-y,"id1",y,"id0","ctfse",boots)
-        expse_x0 = inh_str(tv, "expse_x0", setna=True)
-        expse_x1 = inh_str(tv, "expse_x1", setna=True)
-
-    if len(W)==0:
-        nde = inh_str(te,"nde")
-        ctfde = inh_str(ett,"ctfde")
-        ctfie = inh_str(ett,"ctfie",set0=True)
-        nie = inh_str(te,"nie",set0=True)
+        with ThreadPoolExecutor(max_workers = n_parallel) as pool:
+            fitted = list(pool.map(fit, jobs))
+    crf_te = [pred for job, (_, pred) in zip(jobs, fitted) if job[0] == "te"]
+    crf_med = [pred for job, (_, pred) in zip(jobs, fitted) if job[0] == "med"]
+    if forests is not None:
+        forests.extend((job[0], job[1], forest) for job, (forest, _) in zip(jobs, fitted))
+    
+    expand = samp["expand"]
+    if expand is not None:
+        t, y = t[expand], y[expand]
+        crf_te = [v[expand] for v in crf_te]
+        crf_med = [v[expand] for v in crf_med]
+    
+    return t, y, crf_te, crf_med, samp["plan_seed"], samp["rows"], samp["weight"] if resample in WEIGHTED else None
+
+
+def _fit_oob(crf_params, job, t, weight, oob_batch, profiler, rep):
+    #fit one forest of crf_predict and get its out-of-bag predictions, job is (name, outcome index, features, outcome, seed)
+    name, _, features, y, seed = job
+    crf_tmp = CausalForest(**crf_params, random_state = seed)
+    with profiler.stage("crf_fit_" + name, rep):
+        crf_tmp.fit(X = features, T = t, y = y, sample_weight = weight)
+    with profiler.stage("crf_oob_" + name, rep):
+        return crf_tmp, oob_predict(crf_tmp, features, batch_size = oob_batch).ravel()
+
+
+def _subsample_inds(forest):
+    #the subsamples of the trees, regenerated one tree at a time from the seed of the fit, in the order of forest.get_subsample_inds (which holds all of them at once)
+    rs = check_random_state(forest.subsample_random_seed_)
+    if forest.inference_:
+        for sl, n_, ns_ in zip(forest.slices_, forest.slices_n_samples_, forest.slices_n_samples_subsample_):
+            half_sample_inds = rs.choice(n_, n_ // 2, replace=False)
+            for _ in range(len(sl)):
+                yield half_sample_inds[rs.choice(n_ // 2, ns_, replace=False)]
     else:
-        crf_tmp = CausalForest(n_estimators = crf_n_estimators, criterion = crf_criterion, min_samples_leaf = crf_min_samples_leaf, max_features = crf_max_features, honest = crf_honest, max_samples = crf_max_samples, min_samples_split = crf_min_samples_split, min_balancedness_tol = crf_min_balancedness_tol, inference = crf_inference  )
-        crf_tmp.fit(X = boot_data[np.concatenate([Z,W])].values, T = np.where(boot_data[X].values==x0,0,1), y = y.values)
-        crf_med = crf_tmp.oob_predict(Xtrain = boot_data[np.concatenate([Z,W])].values).ravel()
-        
-        nde = msd_one(crf_med,"all","nde",boots)
-        ctfde = msd_one(crf_med,"id0","ctfde",boots)
-        nie = msd_two(crf_med,"all",-crf_te,"all","nie",boots)
-        ctfie = msd_two(crf_med,"id0",-crf_te,"id0","ctfie",boots)
-        
-    res = pd.concat([tv,te,expse_x1,expse_x0,ett,ctfse,nde,nie,ctfde,ctfie])
-    res['rep'] = rep
-    
-    
-    
-    return res
-        
\ No newline at end of file
+        for n_, ns_ in zip(forest.n_samples_, forest.n_samples_subsample_):
+            yield rs.choice(n_, ns_, replace=False)
+
+
+def _replays_subsamples(forest):
+    #whether _subsample_inds can regenerate the subsamples of this forest: known econml version and private attributes present
+    version = tuple(int(v) for v in econml.__version__.split(".")[:2] if v.isdigit())
+    attributes = _OOB_ATTRIBUTES + (("slices_", "slices_n_samples_", "slices_n_samples_subsample_") if getattr(forest, "inference_", False) else ())
+    return version <= _OOB_MAX_VERSION and all(hasattr(forest, a) for a in attributes) and all(hasattr(tree, "predict_alpha_and_jac") for tree in forest.estimators_[:1])
+
+
+def oob_predict(forest, X, batch_size=2**16):
+    """
+    Out-of-bag predictions of a fitted econml forest, the same as forest.oob_predict(X) but in bounded memory: 
+    every tree predicts its out-of-bag rows by blocks of batch_size rows, instead of copying all of them at once, and the subsamples of the trees are regenerated one at a time.
+    
+    :forest:(econml.grf forest) fitted on X
+    :X:(2-d array) the features the forest was fitted on
+    :batch_size:(integer or None) number of rows predicted at once by every tree. None (or at most batch_size rows) calls forest.oob_predict, 
+        as do econml versions after _OOB_MAX_VERSION (with a warning), since the subsamples are regenerated from private attributes of the forest.
+    :return:(2-d array) (n x n_relevant_outputs) out-of-bag predictions, nan for the rows in the subsample of every tree
+    """
+    n = X.shape[0]
+    if batch_size is None or n <= batch_size:
+        return forest.oob_predict(Xtrain = X)
+    if not _replays_subsamples(forest):
+        warnings.warn("oob_predict falls back to forest.oob_predict, whose memory grows with the number of rows: econml %s is not supported by the bounded-memory version" % (econml.__version__,))
+        return forest.oob_predict(Xtrain = X)
+    
+    n_out = forest.n_outputs_
+    alpha_hat = np.zeros((n, n_out))
+    jac_hat = np.zeros((n, n_out**2))
+    counts = np.zeros(n, dtype = np.intp)
+    lock = threading.Lock()
+    
+    def accumulate(tree, subsample_inds):
+        oob = np.ones(n, dtype = bool)
+        oob[subsample_inds] = False
+        for a in range(0, n, batch_size):
+            rows = a + np.flatnonzero(oob[a:a + batch_size])
+            alpha, jac = tree.predict_alpha_and_jac(X[rows])
+            with lock:
+                alpha_hat[rows] += alpha
+                jac_hat[rows] += jac
+                counts[rows] += 1
+    
+    Parallel(n_jobs = forest.n_jobs, backend = "threading", require = "sharedmem")(
+        delayed(accumulate)(tree, subsample_inds) for tree, subsample_inds in zip(forest.estimators_, _subsample_inds(forest)))
+    
+    preds = np.empty((n, forest.n_relevant_outputs_))
+    for a in range(0, n, batch_size):
+        alpha, jac, pos = alpha_hat[a:a + batch_size], jac_hat[a:a + batch_size], counts[a:a + batch_size] > 0
+        alpha[pos] /= counts[a:a + batch_size][pos].reshape((-1, 1))
+        jac[pos] /= counts[a:a + batch_size][pos].reshape((-1, 1))
+        block = np.einsum("ijk,ik->ij", np.linalg.pinv(jac.reshape((-1, n_out, n_out))), alpha)[:, :forest.n_relevant_outputs_]
+        block[~pos] = np.nan
+        preds[a:a + batch_size] = block
+    return preds
+
+
+def crf_measures(data, X, Z, W, Y, x0, x1, rep, nboot = 100,
+                 crf_n_estimators = 2000, 
+                 crf_criterion = "het", 
+                 crf_min_samples_leaf = 5,  
+                 crf_max_features = "sqrt", 
+                 crf_honest = True,
+                 crf_max_samples = 0.5,
+                 crf_min_samples_split=2, 
+                 crf_min_balancedness_tol=0.45, 
+                 crf_inference=False,
+                 crf_n_jobs=-1,
+                 crf_concurrent=True,
+                 crf_oob_batch=2**16,
+                 random_state=None,
+                 resample="index",
+                 inference="bootstrap",
+                 subset_size=None,
+                 profiler=None,
+                 segments=None,
+                 compact=False):
+    """
+    Same as ci_crf, but return the measures as an array instead of a dataframe.
+    
+    :return:(2-d array) (nboot x len(MEASURES)) value of each measure (columns, in the order of results.MEASURES) for each inner bootstrap sample. If Y is a list of outcomes, (len(Y) x nboot x len(MEASURES)).
+        With inference="analytic", a tuple of the estimates and their standard errors, each (1 x len(MEASURES)) (or (len(Y) x 1 x len(MEASURES))).
+        With segments, one more leading axis: all the rows first, then each segment.
+    """
+    if not isinstance(data, AuditData):
+        data = AuditData.from_frame(data, X, Z, W, Y, x0, dtype = np.float32 if compact else np.float64)
+    
+    profiler = as_profiler(profiler)
+    crf_params = dict(n_estimators = crf_n_estimators, criterion = crf_criterion, min_samples_leaf = crf_min_samples_leaf, max_features = crf_max_features, honest = crf_honest, max_samples = crf_max_samples, min_samples_split = crf_min_samples_split, min_balancedness_tol = crf_min_balancedness_tol, inference = crf_inference, n_jobs = crf_n_jobs)
+    t, y, crf_te, crf_med, plan_seed, rows, weight = crf_predict(data, rep, crf_params, random_state = random_state, resample = resample, subset_size = subset_size, profiler = profiler, concurrent = crf_concurrent, oob_batch = crf_oob_batch)
+    return effect_measures(t, y, crf_te, crf_med, plan_seed, rows, data.n, data.n_z > 0, data.n_w > 0, data.multi, nboot = nboot, inference = inference, segments = segments, compact = compact, profiler = profiler, rep = rep,
+                           resample = resample, weight = weight)
+
+
+def effect_measures(t, y, crf_te, crf_med, plan_seed, rows, size, has_z, has_w, multi, nboot=100, inference="bootstrap", segments=None, compact=False, profiler=None, rep=None, resample="index", weight=None):
+    """
+    Measures of one outter repetition from the per-row effects of its forests: the inner bootstrap (or the analytic inference) and the aggregation of crf_measures, without any fit.
+    
+    :t, y, crf_te, crf_med, plan_seed, rows:(see crf_predict) out-of-bag predictions, or the predictions of already fitted forests on other data (see auditor.FairnessAuditor)
+    :size:(integer) number of rows of the data, drawn by every inner bootstrap sample (more than len(t) when the forests were fitted on a subset)
+    :has_z:(True/False) whether crf_te was fitted
+    :has_w:(True/False) whether crf_med was fitted
+    :multi:(True/False) whether several outcomes are audited
+    :nboot, inference, segments, compact, profiler:(see ci_crf)
+    :rep:(integer or None) outter repetition, for the profiler
+    :resample:(string) see ci_crf, "poisson" and "dirichlet" draw the inner bootstrap samples as replicate weights
+    :weight:(1-d array or None) replicate weights of the rows (see crf_predict), which the inner weights are drawn around
+    :return:(see crf_measures)
+    """
+    profiler = as_profiler(profiler)
+    if inference == "analytic" and resample in WEIGHTED:
+        raise ValueError("inference 'analytic' does not support resample %r" % (resample,))
+    if compact:
+        crf_te, crf_med = [v.astype(np.float32) for v in crf_te], [v.astype(np.float32) for v in crf_med]
+    segs = [] if segments is None else segment_masks(segments, rows, t == 0)
+    
+    if inference == "analytic":
+        with profiler.stage("measures", rep):
+            fits = [_analytic_values(t, y, crf_te, crf_med, has_z, has_w, True, seg_rows) for seg_rows in [None] + [seg["all"][1] for seg in segs]]
+        values, se = np.stack([v for v, _ in fits]), np.stack([s for _, s in fits])
+        return shape_values(values, segments, multi), subset_se(shape_values(se, segments, multi), len(t), size)
+    if inference != "bootstrap":
+        raise ValueError("inference must be 'bootstrap' or 'analytic', got %r" % (inference,))
+    
+    #inner bootstrap plan: the group mask is computed once and the indexes are regenerated from the seed while the measures are evaluated.
+    #every inner sample draws n rows, also from a subset of the data (with replicate weights, its weights sum to about n)
+    plan = BootPlan(group0 = t == 0, nboot = nboot, seed = plan_seed, lazy = True, size = size, compact = compact,
+                    scheme = resample if resample in WEIGHTED else "multinomial", weight = weight)
+    
+    #all the means needed by the measures of all the outcomes, evaluated in a single pass over the plan, 
+    #over all the rows and over the rows of each segment (index names restricted to the segment)
+    names = [{name: name for name in ("all", "id0", "id1")}] + [{name: key for name, (key, _) in seg.items()} for seg in segs]
+    cols = {}
+    for nm in names:
+        cols.update({nm["all"]: [], nm["id0"]: [], nm["id1"]: []})
+        for j in range(y.shape[1]):
+            cols[nm["id0"]].append(y[:, j])
+            cols[nm["id1"]].append(y[:, j])
+            if has_z:
+                cols[nm["all"]].append(crf_te[j])
+                cols[nm["id0"]].append(crf_te[j])
+            if has_w:
+                cols[nm["all"]].append(crf_med[j])
+                cols[nm["id0"]].append(crf_med[j])
+    with profiler.stage("inner_bootstrap", rep):
+        m = plan.means_many(cols, {key: mask for seg in segs for key, mask in seg.values()})
+    
+    n_all = int(has_z) + int(has_w)
+    values = np.empty((len(names), y.shape[1], nboot, len(MEASURES)))
+    with profiler.stage("measures", rep):
+        for k, nm in enumerate(names):
+            for j in range(y.shape[1]):
+                m_j = {"all": m[nm["all"]][:, j*n_all:(j+1)*n_all],
+                       "id0": m[nm["id0"]][:, j*(n_all+1):(j+1)*(n_all+1)],
+                       "id1": m[nm["id1"]][:, j:j+1]}
+                values[k, j] = measure_values(m_j, nboot, has_z, has_w)
+    
+    return shape_values(values, segments, multi)
+
+
+def _analytic_values(t, y, crf_te, crf_med, has_z, has_w, multi, rows=None):
+    """
+    Estimate every measure and its standard error from the influence functions of the means it is made of, without inner bootstrap
+    
+    :t:(1-d array) treatment, aligned with y, crf_te and crf_med (see crf_predict)
+    :y:(2-d array) outcomes, one column per outcome
+    :crf_te:(list) out-of-bag predictions of the Z-only forest, one array per outcome (empty if not fitted)
+    :crf_med:(list) out-of-bag predictions of the Z+W forest, one array per outcome (empty if not fitted)
+    :has_z:(True/False) whether crf_te was fitted
+    :has_w:(True/False) whether crf_med was fitted
+    :multi:(True/False) whether several outcomes are audited
+    :rows:(1-d bool array or None) rows the means are taken over (e.g. a segment). Default None, all.
+    :return:(tuple) estimates and standard errors, each (1 x len(MEASURES)) or (n_outcomes x 1 x len(MEASURES)) if multi
+    """
+    rows = np.ones(len(t), dtype=bool) if rows is None else rows
+    idx = {"all": rows, "id0": rows & (t == 0), "id1": rows & (t == 1)}
+    
+    values = np.empty((y.shape[1], 1, len(MEASURES)))
+    se = np.empty((y.shape[1], 1, len(MEASURES)))
+    for j in range(y.shape[1]):
+        terms = {"y_id0": if_mean(y[:,j], idx["id0"]), "y_id1": if_mean(y[:,j], idx["id1"])}
+        if has_z:
+            terms["te_all"], terms["te_id0"] = if_mean(crf_te[j], idx["all"]), if_mean(crf_te[j], idx["id0"])
+        if has_w:
+            terms["med_all"], terms["med_id0"] = if_mean(crf_med[j], idx["all"]), if_mean(crf_med[j], idx["id0"])
+        values[j, 0], se[j, 0] = analytic_measures(terms, has_z, has_w)
+    
+    return (values, se) if multi else (values[0], se[0])
@@ -0,0 +1,150 @@
+"""
+Run directories of long audits: fairness_cookbook(..., run_dir=...) records there its configuration and the state of its seed, then every completed outter repetition
+as soon as it is done, so that an interrupted audit is resumed from the repetitions already done with identical results, and partial results can be read while it runs (load_run).
+
+Layout of a run directory:
+    config.json         parameters of the audit, seed state and fingerprint of the encoded data, written once
+    reps/rep_000012.npz values (and analytic standard errors) of the outter repetition 12, (segments x outcomes x) nboot2 x n_measures as in MeasureStore, written once
+    status.json         number of repetitions and why they stopped, written when the audit ends
+"""
+from results import MeasureStore
+import json
+import os
+import numpy as np
+
+CONFIG, STATUS, REPS = "config.json", "status.json", "reps"
+
+#parameters that change how the audit runs but not its results, they may differ when resuming
+RUNTIME_KEYS = ("nboot1", "n_jobs", "cpu_budget", "crf_n_jobs", "crf_concurrent", "crf_oob_batch", "mdml_n_jobs", "tol", "tol_measures", "min_reps", "max_time")
+
+
+def _json(value):
+    #parameters that JSON does not represent (e.g. scikit-learn models) are recorded by their repr
+    return json.loads(json.dumps(value, default = lambda v: v.tolist() if isinstance(v, (np.ndarray, np.generic)) else repr(v)))
+
+
+def seed_state(seed):
+    """
+    :seed:(SeedSequence)
+    :return:(dictionary) entropy and spawn_key, from which seed_from_state rebuilds the same SeedSequence
+    """
+    return {"entropy": seed.entropy, "spawn_key": list(seed.spawn_key)}
+
+
+def seed_from_state(state):
+    return np.random.SeedSequence(state["entropy"], spawn_key = tuple(state["spawn_key"]))
+
+
+def read_config(run_dir):
+    """
+    :run_dir:(string) run directory
+    :return:(dictionary or None) the configuration recorded in run_dir, None if there is none yet
+    """
+    path = os.path.join(run_dir, CONFIG)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_file(path, write, binary=False):
+    """
+    Write a file of a run directory or of a cache: to a temporary file first, renamed to path once complete, so that an interruption never leaves a truncated file
+
+    :path:(string) path of the file
+    :write:(function) writes the content to the open temporary file
+    :binary:(True/False) whether the file is opened in binary mode
+    """
+    with open(path + ".tmp", "wb" if binary else "w") as f:
+        write(f)
+    os.replace(path + ".tmp", path)
+
+
+def _write_json(path, value):
+    write_file(path, lambda f: json.dump(value, f, indent = 1))
+
+
+def start_run(run_dir, config, store):
+    """
+    Record the configuration of a new run, or check it against the one of the run being resumed and load the repetitions it has done into store.
+
+    :run_dir:(string) run directory, created if needed
+    :config:(dictionary) parameters of the audit, with "seed" (see seed_state), "data" (fingerprint of the encoded data) and "store" (parameters of the MeasureStore)
+    :store:(MeasureStore or StreamSummary) store of the audit, filled with the repetitions already done (in their order)
+    :return:(list) outter repetitions loaded
+    """
+    config = _json(config)
+    recorded = read_config(run_dir)
+    if recorded is None:
+        os.makedirs(os.path.join(run_dir, REPS), exist_ok = True)
+        _write_json(os.path.join(run_dir, CONFIG), config)
+        return []
+
+    differ = sorted(k for k in set(config) | set(recorded) if k not in RUNTIME_KEYS and k != "store" and config.get(k) != recorded.get(k))
+    differ += ["store." + k for k in set(config["store"]) | set(recorded["store"]) if k != "nboot1" and config["store"].get(k) != recorded["store"].get(k)]
+    if len(differ) > 0:
+        raise ValueError("run_dir %r holds a run with other parameters (%s), use another directory" % (run_dir, ", ".join(differ)))
+    #a run extended to more repetitions records its new size, so that load_run reads all of them
+    if config["store"]["nboot1"] > recorded["store"]["nboot1"]:
+        recorded["store"]["nboot1"] = config["store"]["nboot1"]
+        _write_json(os.path.join(run_dir, CONFIG), recorded)
+    return _load_reps(run_dir, store)
+
+
+def _shards(run_dir):
+    #outter repetition of every shard of the run directory, in order
+    names = os.listdir(os.path.join(run_dir, REPS)) if os.path.isdir(os.path.join(run_dir, REPS)) else []
+    return sorted(int(name[4:-4]) for name in names if name.startswith("rep_") and name.endswith(".npz"))
+
+
+def _load_reps(run_dir, store):
+    loaded = []
+    for r in _shards(run_dir):
+        name = "rep_%06d.npz" % r
+        if r >= len(store.done):
+            continue
+        with np.load(os.path.join(run_dir, REPS, name)) as shard:
+            store.write(r, shard["values"], se = shard["se"] if "se" in shard else None)
+        loaded.append(r)
+    return loaded
+
+
+def save_rep(run_dir, rep, values):
+    """
+    Append an outter repetition to the run directory
+    
+    :rep:(integer) index of the outter repetition
+    :values:(array or tuple) its measures as returned by crf_measures (a tuple of the values and their standard errors with analytic inference)
+    """
+    path = os.path.join(run_dir, REPS, "rep_%06d.npz" % rep)
+    arrays = {"values": values[0], "se": values[1]} if isinstance(values, tuple) else {"values": values}
+    write_file(path, lambda f: np.savez(f, **arrays), binary = True)
+
+
+def finish_run(run_dir, attrs):
+    """
+    :attrs:(dictionary) n_reps, stop_reason and mc_error of the audit, recorded in status.json
+    """
+    _write_json(os.path.join(run_dir, STATUS), _json(attrs))
+
+
+def load_run(run_dir):
+    """
+    Read the results of a run directory, also while the audit is still running
+
+    :run_dir:(string) run directory
+    :return1:(MeasureStore) the outter repetitions done so far (see MeasureStore.summary and to_frame), stop_reason None if the audit has not ended
+    :return2:(dictionary) configuration of the run
+    """
+    config = read_config(run_dir)
+    if config is None:
+        raise ValueError("no run in %r" % (run_dir,))
+    #sized from the shards on disk as well, so that no completed repetition is left out
+    shards = _shards(run_dir)
+    store = MeasureStore(**dict(config["store"], nboot1 = max([config["store"]["nboot1"]] + [r + 1 for r in shards])))
+    _load_reps(run_dir, store)
+    status = os.path.join(run_dir, STATUS)
+    if os.path.exists(status):
+        with open(status) as f:
+            store.stop_reason = json.load(f).get("stop_reason")
+    return store, config
@@ -1,8 +1,88 @@
-from causal_forest import ci_crf
-from helpers import auto_dummy
+from causal_forest import crf_measures
+from med_dml import mdml_measures
+from OLS import ols_measures
+from results import MEASURES, MeasureStore, StreamSummary
+from design import AuditData, read_chunks
+from bootstrap import subset_rows
+from profiling import Profiler, as_profiler
+from checkpoint import read_config, seed_state, seed_from_state, start_run, save_rep, finish_run
+from concurrent.futures import ProcessPoolExecutor
+from threadpoolctl import threadpool_limits
+import contextlib
+import hashlib
+import os
+import time
 import pandas as pd
 import numpy as np
 
+
+#state shared by the outter bootstrap repetitions run in a worker process, set once per worker by _init_worker
+_worker_state = {}
+
+def _init_worker(fun, data, kwargs, memory=None, profile=False, n_threads=None):
+    #the BLAS and OpenMP pools of the worker only use its share of the cores
+    threadpool_limits(limits=n_threads)
+    _worker_state["fun"] = fun
+    _worker_state["data"] = data
+    _worker_state["kwargs"] = kwargs
+    _worker_state["profile"] = profile
+    _worker_state["memory"] = memory
+
+def _write_rep(store, r, values):
+    #analytic inference gives a tuple of values and standard errors
+    if isinstance(values, tuple):
+        store.write(r, values[0], se = values[1])
+    else:
+        store.write(r, values)
+
+def _run_rep(r, seed):
+    #with profiling, the events of the repetition are recorded by a Profiler of the worker and sent back with the values
+    if not _worker_state["profile"]:
+        return _worker_state["fun"](data=_worker_state["data"], rep=r, random_state=seed, **_worker_state["kwargs"]), []
+    profiler = Profiler(memory=_worker_state["memory"])
+    with profiler, profiler.stage("rep", r):
+        values = _worker_state["fun"](data=_worker_state["data"], rep=r, random_state=seed, profiler=profiler, **_worker_state["kwargs"])
+    return values, profiler.events
+
+def _stop_reason(store, tol, tol_measures, min_reps, deadline):
+    """
+    Why the outter repetitions should stop after the ones done so far: "tolerance" if the Monte-Carlo standard errors (MeasureStore.mc_error) of the mean and of both
+    interval endpoints of every tracked measure are below tol, "time" if the deadline (time.perf_counter()) is passed, else None.
+    """
+    if deadline is not None and time.perf_counter() >= deadline:
+        return "time"
+    if tol is None or store.done.sum() < max(min_reps, 2):
+        return None
+    #an error that cannot be estimated (e.g. every tracked measure nan so far) never stops the repetitions
+    error = _max_mc_error(store, tol_measures)
+    if not np.isnan(error) and error < tol:
+        return "tolerance"
+    return None
+
+def _max_mc_error(store, tol_measures):
+    #largest Monte-Carlo standard error of the tracked measures, those that are not estimated (nan) are left out
+    error = store.mc_error()
+    if tol_measures is not None:
+        error = error[error.index.get_level_values("measure").isin(tol_measures)]
+    error = error.to_numpy()
+    return float("nan") if np.all(np.isnan(error)) else float(np.nanmax(error))
+
+def _segment_codes(data, segments, n, chunk_size=100000):
+    #segment of each row (-1 for missing labels) and the names of the measure levels, "all" first, from a column of data (read by chunks if data is a path) or the labels of the rows
+    if segments is None:
+        return None, None
+    if isinstance(segments, str):
+        if isinstance(data, AuditData):
+            raise ValueError("an AuditData has no column %r, pass segments as one label per row instead" % (segments,))
+        if isinstance(data, (str, os.PathLike)):
+            segments = pd.concat([chunk[segments] for chunk in read_chunks(data, [segments], chunk_size)], ignore_index = True)
+        else:
+            segments = data[segments]
+    segments = pd.Categorical(segments if isinstance(segments, pd.Series) else np.asarray(segments))
+    if len(segments) != n:
+        raise ValueError("segments must have one label per row, got %d labels for %d rows" % (len(segments), n))
+    return segments.codes.astype(np.int32), ["all"] + list(segments.categories)
+
 def fairness_cookbook(data, X, Z, W, Y, x0, x1, method = "causal_forest", nboot1 = 1, nboot2 = 100, if_auto_dummy=True,
                       crf_n_estimators = 100, 
                       crf_criterion = "het", 
@@ -12,18 +92,25 @@ def fairness_cookbook(data, X, Z, W, Y, x0, x1, method = "causal_forest", nboot1
                       crf_max_samples = 0.5,
                       crf_min_samples_split=2, 
                       crf_min_balancedness_tol=0.45, 
-                      crf_inference=False):
+                      crf_inference=False,
+                      crf_n_jobs=None, crf_concurrent=True, crf_oob_batch=2**16,
+                      mdml_regressor=None, mdml_classifier=None, mdml_n_folds=5, mdml_clip=0.01, mdml_n_jobs=None,
+                      encoding="dummy", compact=False, out_dir=None, chunk_size=100000, segments=None,
+                      inference="bootstrap", resample="index", subset_size=None,
+                      n_jobs=1, cpu_budget=None, seed=None, profiler=None,
+                      tol=None, tol_measures=None, min_reps=5, max_time=None, run_dir=None,
+                      return_store=False, return_raw=True, ci_level=0.95):
     """
     Main function to decompose the causal effects.
     
-    :data:(dataframe)
+    :data:(dataframe, AuditData or string) the data, already encoded data (see design.AuditData), or the path of a CSV or Parquet file encoded by chunks, the memory of the fits being bounded by subset_size only (see AuditData.from_file).
     :X:(array) scalar giving the name of the protected attribute. Must be one of the entries of data.columns
     :Z:(array) vector giving the names of all mediators. Must be one of the entries of data.columns
     :W:(array) vector giving the names of all confounders. Must be one of the entries of data.columns
-    :Y:(array) scalar giving the name of the outcome. Must be one of the entries of data.columns
+    :Y:(array) scalar giving the name of the outcome, or a list of names audited in one pass on the same bootstrap samples. Must be one of the entries of data.columns
     :x0:(string) scalar values giving the two levels of the binary protected attribute.
     :x1:(string) scalar values giving the two levels of the binary protected attribute.
-    :method:("causal_forest" for causal forest from EconML.grf  or "medDML" for mediation analysis with double-machine learning) Only support "causal_forest" for now. 
+    :method:("causal_forest" for causal forest from EconML.grf, "medDML" for mediation analysis with double-machine learning, or "OLS" for linear regressions refitted in closed form on every bootstrap sample)
     :nboot1:(integer) scalar determining the number of outter bootstrap repetitions, that is, how many times the fitting procedure is repeated. 
     :nboot2:(integer) scalar determining the number of inner bootstrap repetitions, that is, how many bootstrap samples are taken after the potential outcomes are obtained from the estimation procedure. 
     :if_auto_dummy:(True/False) If automatically transform categorical variables into dummies. Default True.
@@ -39,45 +126,190 @@ def fairness_cookbook(data, X, Z, W, Y, x0, x1, method = "causal_forest", nboot1
     :crf_min_samples_split:(int or float, default 10) – The minimum number of samples required to split an internal node
     :crf_min_balancedness_tol:(float in [0, .5], default .45) – How imbalanced a split we can tolerate. This enforces that each split leaves at least (.5 - min_balancedness_tol) fraction of samples on each side of the split
     :crf_inference:(True or False) whether inference (i.e. confidence interval construction and uncertainty quantification of the estimates) should be enabled.
+    :crf_n_jobs:(integer or None) number of threads of the forests of each outter repetition. Default None, the share of cpu_budget of each worker process.
+    :crf_concurrent:(True/False) fit the two forests of a repetition at the same time, sharing its crf_n_jobs threads. Default True.
+    :crf_oob_batch:(integer) number of rows of each block of the out-of-bag predictions. Default 2**16.
+    
+    **parameters of method="medDML", see med_dml.ci_mdml.
+    
+    :mdml_regressor:(scikit-learn regressor) model of the outcome regressions. Default LinearRegression().
+    :mdml_classifier:(scikit-learn classifier) model of the propensity scores. Default LogisticRegression(max_iter=1000).
+    :mdml_n_folds:(integer) number of cross-fitting folds. Default 5.
+    :mdml_clip:(float) propensity scores are clipped to [mdml_clip, 1 - mdml_clip]. Default 0.01.
+    :mdml_n_jobs:(integer or None) number of folds fitted in parallel in each outter repetition. Default None, the share of cpu_budget of each worker process.
+    
+    **data
+    
+    :encoding:(string or dictionary) with if_auto_dummy, "dummy", "rare", "ordinal", "frequency", "target" or "auto" for all the categorical columns, or {column: mode}, see encoders.CategoricalEncoder. Default "dummy".
+    :compact:(True/False) float32 design matrix and int32 indexes, see ci_crf. Default False.
+    :out_dir:(string or None) if data is a path, directory of the memory-mapped arrays. Default None, a temporary directory.
+    :chunk_size:(integer) if data is a path, number of rows read and encoded at a time. Default 100000.
+    :segments:(string, array or None) column of data or label of each row: the measures are also computed in every segment from the same fits, not with method "OLS". Default None.
     
+    **inference
     
-    :return1:(dataframe) This df inclused all types of causal effects. value=calculated measure, boot=row number/bootstrap id, measure=meas (name of the calculated measure)
-    :return2:(dataframe) Aggregated summary of return1.
+    :inference:("bootstrap" or "analytic") "analytic" replaces the nboot2 inner samples by influence-function standard errors. Default "bootstrap".
+    :resample:("index", "weight", "poisson" or "dirichlet") outter samples as gathered rows, as frequency weights, or replicate weights for both bootstrap levels, see ci_crf. Default "index".
+    :subset_size:(integer, float or None) fit every outter repetition on a subset of rows (a float gamma for n**gamma), a heuristic bag of little bootstraps, see results.stats_summary. Default None.
+    
+    **execution
+    
+    :n_jobs:(integer) number of worker processes of the outter repetitions, -1 for one per core of cpu_budget. Default 1.
+    :cpu_budget:(integer or None) number of cores shared by the worker processes and their threads. Default None, all the cores.
+    :seed:(None, integer or SeedSequence) seed of the run, every outter repetition gets a generator spawned from it. Default None, drawn from np.random.
+    :profiler:(None, profiling.Profiler or function) records the time and memory of every stage, see profiling.Profiler. Default None.
+    
+    **stopping and checkpointing
+    
+    :tol:(float or None) stop once the Monte-Carlo error of the means and interval endpoints is below tol, see MeasureStore.mc_error. Default None.
+    :tol_measures:(list or None) names of results.MEASURES tracked by tol. Default None, all.
+    :min_reps:(integer) number of outter repetitions run before tol is checked. Default 5.
+    :max_time:(float or None) no outter repetition is started after this many seconds. Default None.
+    :run_dir:(string or None) directory the run is checkpointed in and resumed from, see checkpoint. Default None.
+    
+    **output
+    
+    :return_store:(True/False) return1 is the MeasureStore instead of the long dataframe. Default False.
+    :return_raw:(True/False) if False, return1 is a results.StreamSummary that does not keep the inner samples. Default True.
+    :ci_level:(float) level of the percentile intervals of the StreamSummary. Default 0.95.
+    
+    :return1:(dataframe) This df inclused all types of causal effects. value=calculated measure, boot=row number/bootstrap id, measure=meas (name of the calculated measure), plus outcome=name of the outcome if Y is a list.
+    :return2:(dataframe) Aggregated summary of return1. Its attrs hold n_reps, stop_reason and mc_error.
     """
     
-    Z = None if ((len(Z)==0) | (Z is "")) else Z
-    W = None if ((len(W)==0) | (W is "")) else W
+    #an empty list, array or string means no Z (W) columns
+    Z = None if len(Z)==0 else Z
+    W = None if len(W)==0 else W
+    if tol_measures is not None:
+        unknown = [m for m in tol_measures if m not in MEASURES]
+        if len(unknown) > 0:
+            raise ValueError("tol_measures must be names of results.MEASURES, got unknown %s" % (", ".join(map(repr, unknown)),))
     
-    if if_auto_dummy:
-        Z_dtypes = np.isin(data[Z].dtypes, np.array(["object","string","category"]))
-        W_dtypes = np.isin(data[W].dtypes, np.array(["object","string","category"]))
-
-        if Z_dtypes.sum() > 0:
-            data, Z = auto_dummy(data = data, col = Z)
-        if W_dtypes.sum() > 0:
-            data, W = auto_dummy(data = data, col = W)
+    profiler = as_profiler(profiler)
+    
+    #encode once: the categorical columns of Z and W are turned into dummies by fitted encoders (kept in audit.encoders), 
+    #and the outter repetitions only resample the arrays of "audit" by index or weight
+    with profiler.stage("encode"):
+        if isinstance(data, AuditData):
+            audit = data
+        elif isinstance(data, (str, os.PathLike)):
+            audit = AuditData.from_file(data, X, Z, W, Y, x0, out_dir = out_dir, chunk_size = chunk_size, dtype = np.float32 if compact else np.float64, encode = if_auto_dummy, encoding = encoding)
+        else:
+            audit = AuditData.from_frame(data, X, Z, W, Y, x0, dtype = np.float32 if compact else np.float64, encode = if_auto_dummy, encoding = encoding)
+    
+    segments, segment_names = _segment_codes(data, segments, audit.n, chunk_size)
     
-    idx = (data[X] == x1)
+    analytic = inference == "analytic"
+    outcomes = audit.outcomes if audit.multi else None
+    #with the bag of little bootstraps, the spread between the subsets is brought back to the scale of the n rows
+    between = True if subset_size is None else subset_rows(subset_size, audit.n) / audit.n
+    if return_raw:
+        store = MeasureStore(nboot1, 1 if analytic else nboot2, outcomes = outcomes, with_se = analytic, between = between, segments = segment_names)
+    else:
+        store = StreamSummary(nboot1, outcomes = outcomes, segments = segment_names, with_se = analytic, between = between, level = ci_level)
     
-    res = pd.DataFrame({'boot':[],
-             'value':[],
-             'measure':[],
-             'rep':[]})
+    if seed is None and run_dir is not None and read_config(run_dir) is not None:
+        seed = seed_from_state(read_config(run_dir)["seed"])
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(np.random.randint(np.iinfo(np.int32).max) if seed is None else seed)
+    rep_seeds = seed.spawn(nboot1)
     
+    n_cores = max(int(cpu_budget), 1) if cpu_budget is not None else os.cpu_count() or 1
+    n_jobs = max(min(n_cores if n_jobs == -1 else n_jobs, nboot1, n_cores), 1)
+    #cores of each process, shared by the threads of its repetitions
+    n_threads = max(n_cores // n_jobs, 1)
+    
+    kwargs = dict(X=X, Z=Z, W=W, Y=Y, x0=x0, x1=x1, nboot = nboot2, resample=resample, inference=inference, subset_size=subset_size)
     if method == "causal_forest":
-        for r in range(nboot1):
-            res_tmp = ci_crf(data=data, X=X, Z=Z, W=W, Y=Y, x0=x0, x1=x1, rep=r, nboot = nboot2, 
-                             crf_n_estimators = crf_n_estimators, 
-                             crf_criterion = crf_criterion, 
-                             crf_min_samples_leaf = crf_min_samples_leaf, 
-                             crf_max_features = crf_max_features, 
-                             crf_honest = crf_honest ,
-                             crf_max_samples = crf_max_samples,
-                             crf_min_samples_split=crf_min_samples_split,
-                             crf_min_balancedness_tol=crf_min_balancedness_tol, 
-                             crf_inference=crf_inference)
-            
-            res = pd.concat([res,res_tmp])
+        fun = crf_measures
+        if crf_n_jobs is None:
+            crf_n_jobs = n_threads
+        kwargs.update(crf_n_estimators = crf_n_estimators, 
+                      crf_criterion = crf_criterion, 
+                      crf_min_samples_leaf = crf_min_samples_leaf, 
+                      crf_max_features = crf_max_features, 
+                      crf_honest = crf_honest ,
+                      crf_max_samples = crf_max_samples,
+                      crf_min_samples_split=crf_min_samples_split,
+                      crf_min_balancedness_tol=crf_min_balancedness_tol, 
+                      crf_inference=crf_inference,
+                      crf_n_jobs=crf_n_jobs,
+                      crf_concurrent=crf_concurrent,
+                      crf_oob_batch=crf_oob_batch,
+                      compact=compact)
+    elif method == "medDML":
+        fun = mdml_measures
+        if mdml_n_jobs is None:
+            mdml_n_jobs = min(n_threads, mdml_n_folds)
+        kwargs.update(mdml_regressor = mdml_regressor,
+                      mdml_classifier = mdml_classifier,
+                      mdml_n_folds = mdml_n_folds,
+                      mdml_clip = mdml_clip,
+                      mdml_n_jobs = mdml_n_jobs)
+    elif method == "OLS":
+        fun = ols_measures
+        if segments is not None:
+            raise ValueError("segments reuse the per-row effects of the models, which method 'OLS' does not estimate: audit each segment separately (segments.segmented_cookbook with refit=True)")
+    else:
+        raise ValueError("method must be 'causal_forest', 'medDML' or 'OLS', got %r" % (method,))
+    if segments is not None:
+        kwargs.update(segments = segments)
+    
+    if run_dir is not None:
+        config = {k: v for k, v in kwargs.items() if k != "segments"}
+        config.update(method = method, seed = seed_state(seed), data = audit.fingerprint(), 
+                      store = dict(nboot1 = nboot1, nboot2 = 1 if analytic else nboot2, outcomes = outcomes, with_se = analytic, between = store.between, segments = segment_names))
+        if segments is not None:
+            config["segments"] = hashlib.blake2b(segments.tobytes(), digest_size = 16).hexdigest()
+        start_run(run_dir, config, store)
+    
+    deadline = None if max_time is None else time.perf_counter() + max_time
+    stop_reason = "max_reps"
+    if n_jobs == 1:
+        #with an explicit cpu_budget, the BLAS and OpenMP pools are limited to it as well
+        with threadpool_limits(limits = n_threads if cpu_budget is not None else None):
+            for r in range(nboot1):
+                #the repetitions of a resumed run are already in the store
+                if not store.done[r]:
+                    with profiler.stage("rep", r):
+                        values = fun(data=audit, rep=r, random_state=rep_seeds[r], profiler=profiler, **kwargs)
+                        _write_rep(store, r, values)
+                    if run_dir is not None:
+                        save_rep(run_dir, r, values)
+                reason = _stop_reason(store, tol, tol_measures, min_reps, deadline) if r < nboot1 - 1 else None
+                if reason is not None:
+                    stop_reason = reason
+                    break
+    else:
+        #when stopping early, only a few repetitions are queued ahead of the one being collected, and the queued ones are cancelled
+        ahead = nboot1 if tol is None and max_time is None else 2 * n_jobs
+        todo = [r for r in range(nboot1) if not store.done[r]]
+        #the workers map the arrays published once in shared memory (see AuditData.share) instead of each receiving a copy
+        shared = audit.share()
+        with (shared if shared is not audit else contextlib.nullcontext()), ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker, initargs=(fun, shared, kwargs, profiler.memory, profiler.enabled, n_threads)) as pool:
+            futures = {}
+            for r in range(nboot1):
+                if not store.done[r]:
+                    while len(todo) > 0 and len(futures) < ahead:
+                        futures[todo[0]] = pool.submit(_run_rep, todo[0], rep_seeds[todo[0]])
+                        todo.pop(0)
+                    values, events = futures.pop(r).result()
+                    _write_rep(store, r, values)
+                    profiler.add(events)
+                    if run_dir is not None:
+                        save_rep(run_dir, r, values)
+                reason = _stop_reason(store, tol, tol_measures, min_reps, deadline) if r < nboot1 - 1 else None
+                if reason is not None:
+                    stop_reason = reason
+                    for future in futures.values():
+                        future.cancel()
+                    break
+    store.stop_reason = stop_reason
 
-    res_summary = res.groupby("measure").agg({'value':['mean','std']})
+    with profiler.stage("summary"):
+        res_summary = store.summary()
+        res_summary.attrs.update(n_reps = int(store.done.sum()), stop_reason = stop_reason, mc_error = _max_mc_error(store, tol_measures))
+        if run_dir is not None:
+            finish_run(run_dir, res_summary.attrs)
+        res = store if return_store or not return_raw else store.to_frame()
     return res, res_summary 
\ No newline at end of file
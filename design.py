@@ -0,0 +1,281 @@
+import hashlib
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+from encoders import CategoricalEncoder
+from helpers import shared_dir
+
+
+def _as_cols(col):
+    return np.array([]) if (col is None) or (len(col) == 0) else np.asarray(col).reshape(-1)
+
+
+def read_chunks(path, columns, chunk_size=100000):
+    """
+    Read a CSV or Parquet file by chunks of rows
+    
+    :path:(string) path of a .parquet file (requires pyarrow) or of a CSV file (possibly compressed, e.g. .csv.gz)
+    :columns:(list) names of the columns to read
+    :chunk_size:(integer) number of rows per chunk
+    :return:(generator) of dataframes with the columns "columns"
+    """
+    path = os.fspath(path)
+    columns = list(dict.fromkeys(columns))
+    if path.endswith((".parquet", ".pq")):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("reading Parquet files requires pyarrow")
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size, columns=columns):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(path, usecols=columns, chunksize=chunk_size)
+
+
+class AuditData:
+    """
+    Data of one audit, encoded once as contiguous NumPy arrays so that the outter bootstrap only needs index arrays or weights.
+
+    :features:(2-d float array) (n x (n_z + n_w)) design matrix, the columns of Z first, then the columns of W
+    :t:(1-d uint8 array) treatment vector, 0 at the 0-level (x0) of the protected attribute and 1 otherwise
+    :y:(1-d or 2-d float array) outcome, or (n x k) matrix with one column per outcome
+    :n_z:(integer) number of columns of features coming from Z
+    :columns:(array) names of the columns of features
+    :outcomes:(array) names of the outcomes (columns of y)
+    :encoders:(tuple or None) fitted CategoricalEncoder of Z and W the features were built with, reusable on new data
+    
+    An AuditData built by from_file or share keeps its arrays memory-mapped from the directory "path": it is pickled (e.g. to the worker processes) without its arrays, 
+    which are mapped again (read-only) from the files when unpickled, so that all the processes share the same pages.
+    """
+
+    def __init__(self, features, t, y, n_z, columns=None, outcomes=None, encoders=None):
+        self.features = np.ascontiguousarray(features)
+        self.t = np.ascontiguousarray(t, dtype=np.uint8)
+        y = np.asarray(y, dtype=float)
+        #several outcomes share the design matrix, the treatment and all the bootstrap plans
+        self.multi = y.ndim == 2
+        self.y = np.ascontiguousarray(y.reshape(y.shape[0], -1))
+        self.n_z = int(n_z)
+        self.columns = np.arange(self.features.shape[1]) if columns is None else np.asarray(columns)
+        self.outcomes = np.arange(self.y.shape[1]) if outcomes is None else np.asarray(outcomes).reshape(-1)
+        self.encoders = encoders
+        self.path = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        #the temporary directory is only removed by the AuditData that created it
+        state.pop("_tmp", None)
+        if self.path is not None:
+            state.update(features = None, t = None, y = None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.path is not None:
+            self.features, self.t, self.y = (np.load(os.path.join(self.path, k + ".npy"), mmap_mode="r") for k in ("features", "t", "y"))
+
+    @classmethod
+    def from_frame(cls, data, X, Z, W, Y, x0, dtype=np.float64, encode=False, encoders=None, encoding="dummy"):
+        """
+        Encode the columns of an audit from a dataframe. Unless encode is True or encoders are given, the columns of Z and W must already be numeric (see auto_dummy).
+
+        :data:(dataframe)
+        :X:(string) name of the protected attribute
+        :Z:(array) names of the confounders
+        :W:(array) names of the mediators
+        :Y:(string or list) name of the outcome, or list of names to audit several outcomes at once
+        :x0:(string) 0-level of the protected attribute
+        :dtype:(numpy dtype) dtype of the design matrix. Default float64.
+        :encode:(True/False) if True, fit a CategoricalEncoder on Z and one on W and encode their categorical columns (into dummies by default, see encoding). Default False.
+        :encoders:(tuple or None) already fitted (Z, W) CategoricalEncoder, e.g. the encoders of another AuditData, to encode new data with the same columns
+        :encoding:(string or dictionary) with encode, how the categorical columns are encoded, one mode for all or {column: mode} (see CategoricalEncoder). 
+            The "target" mode uses the outcome (the first one if Y is a list), out of fold. Default "dummy".
+        :return:(AuditData)
+        """
+        Z, W = _as_cols(Z), _as_cols(W)
+        fit = encode and encoders is None
+        if fit:
+            encoders = (CategoricalEncoder(Z, encoding), CategoricalEncoder(W, encoding))
+            target = data[np.atleast_1d(Y)[0]].to_numpy(dtype=float)
+        
+        if encoders is None:
+            columns = np.concatenate([Z, W])
+            features = data[columns].to_numpy(dtype=dtype) if len(columns) > 0 else np.empty((data.shape[0], 0), dtype=dtype)
+            n_z = len(Z)
+        elif fit:
+            #the columns are only known once the encoders are fitted, which encodes the data too (out of fold with the "target" mode)
+            features = np.hstack([e.fit_transform(data, dtype=dtype, y=target) for e in encoders])
+            columns, n_z = np.concatenate([encoders[0].columns_, encoders[1].columns_]), len(encoders[0].columns_)
+        else:
+            columns = np.concatenate([encoders[0].columns_, encoders[1].columns_])
+            features = np.empty((data.shape[0], len(columns)), dtype=dtype)
+            n_z = len(encoders[0].columns_)
+            features[:, :n_z] = encoders[0].transform(data, dtype=dtype)
+            features[:, n_z:] = encoders[1].transform(data, dtype=dtype)
+        
+        t = np.where(data[X].values == x0, 0, 1)
+        y = data[Y].to_numpy(dtype=float)
+        return cls(features, t, y, n_z, columns, Y, encoders)
+
+    @classmethod
+    def from_file(cls, path, X, Z, W, Y, x0, out_dir=None, chunk_size=100000, dtype=np.float64, encode=False, encoders=None, encoding="dummy"):
+        """
+        Out-of-core version of from_frame: the file is read twice by chunks, first to learn the levels of the categorical columns and count the rows, 
+        then to encode each chunk into the memory-mapped files features.npy, t.npy and y.npy. Only one chunk is held in memory at a time.
+        This bounds the memory of the encoding only: every outter repetition still gathers its sample in memory (see outer_sample, in float64 for the forests, which econml requires), 
+        so that the memory of the fits is bounded by the subset_size of fairness_cookbook, not by chunk_size.
+        
+        :path:(string) CSV or Parquet file, see read_chunks
+        :X, Z, W, Y, x0, dtype, encode, encoders, encoding:(see from_frame) the levels and their counts are learnt chunk by chunk, so the "target" mode is not available.
+        :out_dir:(string or None) directory the .npy files are written to. Default None, a temporary directory removed with the AuditData.
+        :chunk_size:(integer) number of rows per chunk. Default 100000.
+        :return:(AuditData) with memory-mapped, read-only arrays
+        """
+        Z, W = _as_cols(Z), _as_cols(W)
+        Y_cols = list(np.atleast_1d(Y))
+        usecols = [X] + list(Z) + list(W) + Y_cols
+        
+        fit = encode and encoders is None
+        if fit:
+            encoders = (CategoricalEncoder(Z, encoding), CategoricalEncoder(W, encoding))
+        n = 0
+        for chunk in read_chunks(path, usecols, chunk_size):
+            n += chunk.shape[0]
+            if fit:
+                encoders[0].partial_fit(chunk)
+                encoders[1].partial_fit(chunk)
+        
+        tmp = None
+        if out_dir is None:
+            tmp = tempfile.TemporaryDirectory(prefix="audit_")
+            out_dir = tmp.name
+        os.makedirs(out_dir, exist_ok=True)
+        if encoders is None:
+            columns, n_z = np.concatenate([Z, W]), len(Z)
+        else:
+            columns, n_z = np.concatenate([encoders[0].columns_, encoders[1].columns_]), len(encoders[0].columns_)
+        files = {k: os.path.join(out_dir, k + ".npy") for k in ("features", "t", "y")}
+        features = np.lib.format.open_memmap(files["features"], mode="w+", dtype=dtype, shape=(n, len(columns)))
+        t = np.lib.format.open_memmap(files["t"], mode="w+", dtype=np.uint8, shape=(n,))
+        y = np.lib.format.open_memmap(files["y"], mode="w+", dtype=np.float64, shape=(n, len(Y_cols)))
+        
+        start = 0
+        for chunk in read_chunks(path, usecols, chunk_size):
+            part = cls.from_frame(chunk, X, Z, W, Y_cols, x0, dtype=dtype, encoders=encoders)
+            stop = start + part.n
+            features[start:stop], t[start:stop], y[start:stop] = part.features, part.t, part.y
+            start = stop
+        for arr in (features, t, y):
+            arr.flush()
+        del features, t, y
+        
+        features, t, y = (np.load(files[k], mmap_mode="r") for k in ("features", "t", "y"))
+        audit = cls(features, t, y if isinstance(Y, (list, tuple, np.ndarray)) else y[:, 0], n_z, columns, Y, encoders)
+        audit.path, audit._tmp = out_dir, tmp
+        return audit
+
+    def share(self, directory=None):
+        """
+        Publish the arrays once for worker processes: they are written to .npy files in a new directory of the shared memory of the host (/dev/shm, where it exists and has room for them, 
+        else the temporary directory), and the AuditData returned maps them read-only. It is pickled without its arrays, and every process that unpickles it maps the same pages, 
+        so that the memory and the start-up time of the workers do not grow with the size of the data or their number.
+        The files are removed by close, when the returned AuditData is garbage collected, or at exit. The processes that mapped them keep their arrays until they let go of them.
+        
+            with audit.share() as shared:
+                with ProcessPoolExecutor(8) as pool:
+                    results = list(pool.map(audit_outcome, [shared] * 8, outcomes))
+        
+        :directory:(string or None) parent directory of the files. Default None, see above.
+        :return:(AuditData) self if its arrays are already memory-mapped from files (from_file, share), otherwise the published copy
+        """
+        if self.path is not None:
+            return self
+        nbytes = self.features.nbytes + self.t.nbytes + self.y.nbytes
+        tmp = tempfile.TemporaryDirectory(prefix="audit_", dir=shared_dir(nbytes) if directory is None else directory)
+        for k in ("features", "t", "y"):
+            np.save(os.path.join(tmp.name, k + ".npy"), getattr(self, k))
+        features, t, y = (np.load(os.path.join(tmp.name, k + ".npy"), mmap_mode="r") for k in ("features", "t", "y"))
+        audit = AuditData(features, t, y if self.multi else y[:, 0], self.n_z, self.columns, self.outcomes, self.encoders)
+        audit.path, audit._tmp = tmp.name, tmp
+        return audit
+
+    def close(self):
+        """
+        Remove the files of the temporary directory created by from_file (without out_dir) or share, once the arrays are no longer needed. Does nothing otherwise.
+        """
+        tmp = getattr(self, "_tmp", None)
+        if tmp is not None:
+            tmp.cleanup()
+            self._tmp = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    @property
+    def n(self):
+        return self.features.shape[0]
+
+    @property
+    def n_y(self):
+        return self.y.shape[1]
+
+    @property
+    def n_w(self):
+        return self.features.shape[1] - self.n_z
+
+    def select(self, rows=None, t=None, exclude=None):
+        """
+        The same audit on other rows, with another treatment or without some variables, reusing the encoded arrays (e.g. the audits of several protected attributes or segments)
+        
+        :rows:(1-d int array or None) rows kept. Default None, all.
+        :t:(1-d array or None) treatment of every row of the data (before selecting rows), 0 at the 0-level of the protected attribute and 1 otherwise. Default None, the same.
+        :exclude:(list or None) names of variables of Z or W whose encoded columns are dropped, e.g. the protected attribute when it is a confounder of another one. Default None.
+        :return:(AuditData) self if nothing changes, otherwise a new one in memory. The encoders are dropped if columns are.
+        """
+        cols, encoders = None, self.encoders
+        if exclude is not None and len(exclude) > 0:
+            sources = self.columns if encoders is None else np.concatenate([encoders[0].sources_, encoders[1].sources_])
+            cols = np.flatnonzero(~np.isin(sources, list(exclude)))
+            if len(cols) == self.features.shape[1]:
+                cols = None
+        if rows is None and cols is None:
+            if t is None:
+                return self
+            features, y = self.features, self.y
+        else:
+            features = self.features if rows is None else self.features[rows]
+            features = features if cols is None else features[:, cols]
+            y = self.y if rows is None else self.y[rows]
+        t = self.t if t is None else np.asarray(t, dtype=np.uint8)
+        t = t if rows is None else t[rows]
+        
+        n_z, columns = self.n_z, self.columns
+        if cols is not None:
+            n_z, columns, encoders = int((cols < self.n_z).sum()), self.columns[cols], None
+        return AuditData(features, t, y if self.multi else y[:, 0], n_z, columns, self.outcomes, encoders)
+
+    def fingerprint(self, chunk_size=100000):
+        """
+        :chunk_size:(integer) number of rows hashed at a time, to stream over memory-mapped arrays
+        :return:(string) hash of the content of the arrays and of the names of their columns, identical for the same encoded data wherever it is stored
+        """
+        h = hashlib.blake2b(digest_size=16)
+        h.update(repr((self.features.shape, str(self.features.dtype), self.n_z, self.y.shape, [str(c) for c in self.columns], [str(o) for o in self.outcomes])).encode())
+        for start in range(0, self.n, chunk_size):
+            for arr in (self.features, self.t, self.y):
+                h.update(np.ascontiguousarray(arr[start:start + chunk_size]).tobytes())
+        return h.hexdigest()
+
+    def take(self, rows):
+        """
+        :rows:(1-d int array or None) row indexes. None means all rows, without copy.
+        :return:(tuple) features, t and y (always 2-d, one column per outcome) of the selected rows
+        """
+        if rows is None:
+            return self.features, self.t, self.y
+        return self.features[rows], self.t[rows], self.y[rows]
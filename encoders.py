@@ -0,0 +1,250 @@
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+
+#ways a categorical column can be encoded, see CategoricalEncoder
+ENCODINGS = ("dummy", "rare", "ordinal", "frequency", "target", "auto")
+
+
+class CategoricalEncoder:
+    """
+    Learn the levels of the categorical columns once, then encode any data with the same, stable column layout: the encoded categorical columns first, then the other columns.
+    
+    Every categorical column is encoded by its own mode, so that the columns with many levels do not blow up the number of features:
+        "dummy": one 0/1 column per level, as helpers.auto_dummy.
+        "rare": one 0/1 column per level held by at least min_frequency of the rows, and one column "<col>_rare" for all the other levels (and the levels not seen at fit time).
+        "ordinal": one column, the code of the level among the sorted levels (the order of the categories of a categorical dtype).
+        "frequency": one column, the share of the rows having the level at fit time.
+        "target": one column, the mean of the target (the outcome) over the rows having the level, shrunk towards the overall mean by smoothing rows at the overall mean. 
+            On the rows the encoder is fitted on, fit_transform gives every row the mean over the rows of the other n_folds - 1 folds, so that its own outcome never enters its feature; 
+            transform (new data) uses all the rows.
+        "auto": "dummy" for the columns with at most max_dummies levels, the others "target" if the encoder is fitted with a target, else "frequency".
+    The one-column modes cost one feature whatever the number of levels: a tree then splits on ranges of levels (ordered by code, frequency or mean target) instead of isolating single levels.
+    
+    Levels not seen at fit time and missing values are encoded as all-zero dummies (the rare column for unseen levels with "rare"), as -1 with "ordinal", 0 with "frequency" 
+    and the overall mean with "target", so bootstrap samples or new data always give the same columns.
+    
+    :col:(array) the columns to be screened and encoded
+    :encoding:(string or dictionary) mode of every categorical column (see ENCODINGS), or {column: mode}, the columns left out being turned into dummies. 
+        Columns of the dictionary that are numeric (e.g. integer codes) are encoded as categorical columns too. Default "dummy".
+    :min_frequency:(integer or float) with "rare", number of rows (integer), or share of the rows (float in (0, 1)), a level needs to get its own dummy. Default 0.01.
+    :max_dummies:(integer) with "auto", largest number of levels turned into dummies. Default 16.
+    :smoothing:(float) with "target", weight (in rows) of the overall mean in the mean of every level. Default 10.
+    :n_folds:(integer) with "target", number of folds of the out-of-fold encoding of fit_transform. Default 5.
+    :seed:(integer) seed of the folds. Default 0.
+    """
+    
+    def __init__(self, col, encoding="dummy", min_frequency=0.01, max_dummies=16, smoothing=10.0, n_folds=5, seed=0):
+        self.col = np.asarray(col).reshape(-1)
+        self.encoding = encoding
+        self.min_frequency = min_frequency
+        self.max_dummies = max_dummies
+        self.smoothing = smoothing
+        self.n_folds = n_folds
+        self.seed = seed
+        for mode in (encoding.values() if isinstance(encoding, dict) else [encoding]):
+            if mode not in ENCODINGS:
+                raise ValueError("encoding must be one of %s, got %r" % (", ".join(ENCODINGS), mode))
+    
+    def _mode(self, c):
+        return self.encoding.get(c, "dummy") if isinstance(self.encoding, dict) else self.encoding
+    
+    def fit(self, data, y=None):
+        """
+        :data:(dataframe) the data the levels are learned from
+        :y:(1-d array or None) target of the "target" mode (the outcome, the first one if there are several), one value per row of data. Default None.
+        :return:(CategoricalEncoder) self
+        """
+        data_col = data[data.columns[np.isin(data.columns, self.col)]]
+        is_cat = np.isin(data_col.dtypes, np.array(["object","string","category"]))
+        if isinstance(self.encoding, dict):
+            is_cat |= np.isin(data_col.columns, list(self.encoding))
+        self.col_cat_ = data_col.dtypes.index[is_cat].values
+        self.col_other_ = self.col[~(np.isin(self.col, self.col_cat_))]
+        
+        self.categories_ = {c: pd.Categorical(data[c]).categories for c in self.col_cat_}
+        codes = self.codes(data)
+        self.n_ = data.shape[0]
+        self.counts_ = {c: np.bincount(codes[codes[:, j] >= 0, j], minlength=len(self.categories_[c])) for j, c in enumerate(self.col_cat_)}
+        
+        self.target_ = None
+        if y is not None:
+            y = np.asarray(y, dtype=float).reshape(-1)
+            known = ~np.isnan(y)
+            #sum and number of the non-missing targets of every level
+            self.target_ = {c: (np.bincount(codes[known & (codes[:, j] >= 0), j], weights=y[known & (codes[:, j] >= 0)], minlength=len(self.categories_[c])),
+                                np.bincount(codes[known & (codes[:, j] >= 0), j], minlength=len(self.categories_[c])))
+                            for j, c in enumerate(self.col_cat_)}
+            self.target_mean_ = y[known].mean() if known.any() else 0.0
+        self._set_columns()
+        return self
+    
+    def partial_fit(self, data):
+        """
+        Add the levels found in one more chunk of the data, and their counts, to fit on data read by chunks. The categorical columns are the ones of the first chunk.
+        The "target" mode needs all the rows at once and is not available ("auto" then encodes the columns with many levels by frequency).
+        
+        :data:(dataframe) one chunk of the data
+        :return:(CategoricalEncoder) self
+        """
+        if not hasattr(self, "categories_"):
+            return self.fit(data)
+        for c in self.col_cat_:
+            old = self.categories_[c]
+            levels = old.append(pd.Categorical(data[c]).categories).unique()
+            self.categories_[c] = pd.Categorical(levels).categories
+            counts = np.zeros(len(self.categories_[c]), dtype=np.int64)
+            counts[self.categories_[c].get_indexer(old)] = self.counts_[c]
+            self.counts_[c] = counts
+        codes = self.codes(data)
+        for j, c in enumerate(self.col_cat_):
+            self.counts_[c] += np.bincount(codes[codes[:, j] >= 0, j], minlength=len(self.categories_[c]))
+        self.n_ += data.shape[0]
+        self._set_columns()
+        return self
+    
+    def _set_columns(self):
+        #every categorical column c gets a block of columns, and tables_[c] maps its level codes (the last entry for -1, unseen or missing) 
+        #to a column of the block (-1 for none) with "dummy" and "rare", or to the encoded value with the one-column modes
+        self.modes_, self.tables_, names = {}, {}, []
+        for c in self.col_cat_:
+            mode, counts, n_levels = self._mode(c), self.counts_[c], len(self.categories_[c])
+            if mode == "auto":
+                mode = "dummy" if n_levels <= self.max_dummies else ("target" if self.target_ is not None else "frequency")
+            if mode == "target" and self.target_ is None:
+                raise ValueError("the target encoding of %r needs the target, fit the encoder with y on all the rows" % (c,))
+            self.modes_[c] = mode
+            
+            if mode == "dummy":
+                self.tables_[c] = np.append(np.arange(n_levels), -1)
+                names.append([str(c) + "_" + str(l) for l in self.categories_[c]])
+            elif mode == "rare":
+                threshold = self.min_frequency if self.min_frequency >= 1 else np.ceil(self.min_frequency * self.n_)
+                kept = counts >= threshold
+                self.tables_[c] = np.append(np.where(kept, np.cumsum(kept) - 1, kept.sum()), kept.sum())
+                names.append([str(c) + "_" + str(l) for l in self.categories_[c][kept]] + [str(c) + "_rare"])
+            else:
+                if mode == "ordinal":
+                    values, default = np.arange(n_levels, dtype=float), -1.0
+                elif mode == "frequency":
+                    values, default = counts / max(self.n_, 1), 0.0
+                else:
+                    sums, known = self.target_[c]
+                    values, default = self._target_values(sums, known, self.target_mean_), self.target_mean_
+                self.tables_[c] = np.append(values, default)
+                names.append([c])
+        
+        self.widths_ = np.array([len(b) for b in names], dtype=np.int64)
+        col_cat_adj = [name for b in names for name in b]
+        self.columns_ = np.concatenate([np.array(col_cat_adj, dtype=object), self.col_other_]) if len(col_cat_adj) > 0 else self.col_other_
+        #column of the data each encoded column comes from
+        self.sources_ = np.concatenate([np.array([c for c, b in zip(self.col_cat_, names) for name in b], dtype=object), self.col_other_])
+    
+    def _target_values(self, sums, known, prior):
+        return (sums + self.smoothing * prior) / (known + self.smoothing)
+    
+    def fit_transform(self, data, output="dense", dtype=np.float64, y=None):
+        """
+        Fit on data and encode it, the "target" columns out of fold (see the class description)
+        
+        :data, y:(see fit)
+        :output, dtype:(see transform)
+        """
+        self.fit(data, y=y)
+        target = [(j, c) for j, c in enumerate(self.col_cat_) if self.modes_[c] == "target"]
+        if len(target) == 0:
+            return self.transform(data, output=output, dtype=dtype)
+        
+        #sums of the targets by fold and level, the encoding of the rows of a fold using the rows of the others
+        n = data.shape[0]
+        y = np.asarray(y, dtype=float).reshape(-1)
+        known = ~np.isnan(y)
+        fold = np.random.default_rng(self.seed).permutation(n) % self.n_folds
+        fold_n = np.bincount(fold[known], minlength=self.n_folds)
+        fold_sum = np.bincount(fold[known], weights=y[known], minlength=self.n_folds)
+        prior = (fold_sum.sum() - fold_sum) / np.maximum(known.sum() - fold_n, 1)
+        codes = self.codes(data)
+        values = {}
+        for j, c in target:
+            n_levels, code = len(self.categories_[c]), codes[:, j]
+            rows = known & (code >= 0)
+            cell = fold[rows] * n_levels + code[rows]
+            sums = np.bincount(cell, weights=y[rows], minlength=self.n_folds * n_levels).reshape(self.n_folds, n_levels)
+            counts = np.bincount(cell, minlength=self.n_folds * n_levels).reshape(self.n_folds, n_levels)
+            oof = self._target_values(sums.sum(axis=0) - sums, counts.sum(axis=0) - counts, prior[:, None])
+            values[c] = np.where(code >= 0, oof[fold, np.maximum(code, 0)], prior[fold])
+        return self._encode(data, output, dtype, codes, values)
+    
+    def codes(self, data):
+        """
+        :data:(dataframe)
+        :return:(2-d int32 array) (n x len(col_cat_)) level code of each categorical column, -1 for unseen levels and missing values
+        """
+        codes = np.empty((data.shape[0], len(self.col_cat_)), dtype=np.int32)
+        for j, c in enumerate(self.col_cat_):
+            codes[:, j] = pd.Categorical(data[c], categories=self.categories_[c]).codes
+        return codes
+    
+    def transform(self, data, output="dense", dtype=np.float64):
+        """
+        :data:(dataframe) data with the columns the encoder was fitted on
+        :output:("dense", "sparse", "codes" or "frame") 
+            "dense": (n x len(columns_)) array, 
+            "sparse": (n x len(columns_)) scipy.sparse.csr_matrix, 
+            "codes": tuple of the integer codes of the categorical columns (see codes) and the (n x len(col_other_)) array of the other columns, 
+            "frame": dataframe with columns columns_
+        :dtype:(numpy dtype) dtype of the encoded values. Default float64.
+        :return: the encoded columns, the categorical ones first then the other columns, as in helpers.auto_dummy
+        """
+        return self._encode(data, output, dtype, self.codes(data))
+    
+    def _encode(self, data, output, dtype, codes, values=None):
+        #values: encoded value of every row for some one-column modes, instead of the tables (the out-of-fold target encoding)
+        n = data.shape[0]
+        other = data[self.col_other_].to_numpy(dtype=dtype) if len(self.col_other_) > 0 else np.empty((n, 0), dtype=dtype)
+        if output == "codes":
+            return codes, other
+        
+        offsets = np.concatenate([[0], np.cumsum(self.widths_)]).astype(np.int64)
+        n_cat = offsets[-1]
+        rows, cols, vals = [], [], []
+        for j, c in enumerate(self.col_cat_):
+            table, code = self.tables_[c], codes[:, j]
+            if self.modes_[c] in ("dummy", "rare"):
+                col = table[code]
+                if self.modes_[c] == "rare":
+                    col[pd.isna(data[c]).to_numpy()] = -1
+                r = np.flatnonzero(col >= 0)
+                rows.append(r)
+                cols.append(offsets[j] + col[r])
+                vals.append(np.ones(len(r), dtype=dtype))
+            else:
+                rows.append(np.arange(n))
+                cols.append(np.full(n, offsets[j]))
+                vals.append((table[code] if values is None or c not in values else values[c]).astype(dtype))
+        rows, cols, vals = (np.concatenate(v) if len(v) > 0 else np.empty(0, dtype=np.int64) for v in (rows, cols, vals))
+        
+        if output == "sparse":
+            encoded = sp.csr_matrix((vals.astype(dtype), (rows, cols)), shape=(n, n_cat))
+            return sp.hstack([encoded, sp.csr_matrix(other)], format="csr")
+        
+        encoded = np.zeros((n, n_cat + other.shape[1]), dtype=dtype)
+        encoded[rows, cols] = vals
+        encoded[:, n_cat:] = other
+        if output == "frame":
+            return pd.DataFrame(encoded, columns=self.columns_, index=data.index)
+        if output != "dense":
+            raise ValueError("output must be 'dense', 'sparse', 'codes' or 'frame', got %r" % (output,))
+        return encoded
+
+
+class DummyEncoder(CategoricalEncoder):
+    """
+    CategoricalEncoder turning every categorical column into dummies: the stable column layout of helpers.auto_dummy
+    
+    :col:(array) the columns to be screened and encoded
+    """
+    
+    def __init__(self, col):
+        super().__init__(col)
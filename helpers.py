@@ -1,65 +1,174 @@
 import pandas as pd
 import numpy as np
+import scipy.sparse as sp
+import os
+import warnings
 
-def msd_one(x1,t1,meas,boots):
+def index_dtype(n):
     """
-    For each bootstrap index "boots", calculate the fairness measure "meas" from data "x" and the corresponding index name "t"
+    :n:(integer) number of rows indexed
+    :return:(numpy dtype) int32 if it can index n rows, int64 otherwise
+    """
+    return np.int32 if n <= np.iinfo(np.int32).max else np.int64
+
+
+def shared_dir(nbytes):
+    """
+    :nbytes:(integer) size of the arrays to be published to worker processes
+    :return:(string or None) /dev/shm, the shared memory of the host, if it exists and has room for them (with a margin), else None (the temporary directory, see tempfile)
+    """
+    try:
+        stats = os.statvfs("/dev/shm")
+    except (AttributeError, OSError):
+        return None
+    return "/dev/shm" if stats.f_bavail * stats.f_frsize > 2 * nbytes + 2**26 else None
+
+
+def boot_weights(boots, n, compact=False):
+    """
+    Convert the bootstrap indexes "boots" into sparse count matrices, so that all bootstrap samples can be evaluated at once
     
     :boots:(nested dictionary) boostrap indexes, including index of all samples, as well as the index of 0-level ("id0") and 1-level ("id1") 
-    :x1:(1-d array) data input for calculation 
-    :t1:(string) string indicating name of the index for x1
-    :meas:(string) name for the output measure
-    :return:(dataframe) with value=calculated measure, boot=row number/bootstrap id, measure=meas (name of the calculated measure)
+    :n:(integer) length of the data the indexes refer to
+    :compact:(True/False) if True, the counts are stored in float32 (exact up to 2**24). Default False, float64.
+    :return:(dictionary) keys "all", "id0" and "id1", each a (nboot x n) scipy.sparse.csr_matrix whose entry (b,i) counts how often row i is drawn in bootstrap sample b
     """
-    meas_result = []
+    weights = {}
+    dtype = index_dtype(max(n, sum(len(boots[b]["all"]) for b in boots)))
+    for t in ["all","id0","id1"]:
+        ind = [np.asarray(boots[b][t], dtype=dtype).ravel() for b in boots]
+        indptr = np.concatenate([[0], np.cumsum([len(i) for i in ind])]).astype(dtype)
+        indices = np.concatenate(ind) if len(ind) > 0 else np.array([], dtype=dtype)
+        weights[t] = sp.csr_matrix((np.ones(len(indices), dtype=np.float32 if compact else np.float64), indices, indptr), shape=(len(ind), n))
     
-    for b in boots:
-        boot_data1_tmp = x1[boots[b][t1]]
-        
-        meas_result_tmp = np.nanmean(boot_data1_tmp)
-        meas_result.append(meas_result_tmp)
-        
+    return weights
+
+
+def boot_sums(x, w):
+    """
+    Weighted sum and weighted count of the non-missing values of "x" for every bootstrap sample at once. Sums over consecutive blocks of rows add up, so that long data can be streamed.
+    
+    :x:(1-d or 2-d array) data input for calculation, one column per variable if 2-d. Float32 data is summed in float32 (see mean_shift), other data in float64.
+    :w:(sparse or dense matrix) (nboot x n) bootstrap counts or weights, one row per bootstrap sample
+    :return:(tuple) total and count, each of length nboot (nboot x k if x is 2-d)
+    """
+    x = np.asarray(x)
+    x = x if x.dtype == np.float32 else x.astype(float, copy=False)
+    obs = ~np.isnan(x)
+    return w @ np.where(obs, x, x.dtype.type(0)), w @ obs.astype(x.dtype)
+
+
+def mean_shift(x):
+    """
+    Float32 value close to the mean of each column of "x". Float32 sums of the data minus this shift stay of the order of sqrt(n) times the spread of the data instead of n times its mean, 
+    so that their rounding error no longer grows with the level of the data, and the means are recovered exactly in float64 by adding the shift back.
+    
+    :x:(1-d or 2-d array) data input for calculation, one column per variable if 2-d (e.g. the first block of rows of a long array)
+    :return:(float32 scalar or 1-d array) the shift (0 for the columns without non-missing values)
+    """
+    with np.errstate(invalid="ignore"), warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        shift = np.nanmean(x, axis=0, dtype=np.float64)
+    return np.nan_to_num(shift).astype(np.float32)
+
+
+def boot_means(x, w):
+    """
+    Calculate the mean of "x" (ignoring nan) for every bootstrap sample at once
+    
+    :x:(1-d or 2-d array) data input for calculation, one column per variable if 2-d
+    :w:(sparse or dense matrix) (nboot x n) bootstrap counts or weights, one row per bootstrap sample
+    :return:(array) of length nboot (nboot x k if x is 2-d), the weighted mean of x for each bootstrap sample (nan if the sample has no non-missing value)
+    """
+    x = np.asarray(x)
+    #float32 data is averaged around its mean_shift, added back in float64
+    shift = mean_shift(x) if x.dtype == np.float32 else 0
+    total, count = boot_sums(x - shift if x.dtype == np.float32 else x, w)
+    
+    with np.errstate(invalid="ignore", divide="ignore"):
+        res = np.asarray(total / count, dtype=float) + np.asarray(shift, dtype=float)
+    return res.ravel() if x.ndim == 1 else res
+
+
+def _as_weights(boots, n, compact=False):
+    """
+    Return "boots" in a form accepted by _boot_mean, converting the nested dictionary of indexes into count matrices (float32 if compact) if necessary
+    """
+    if hasattr(boots, "means"):
+        return boots
+    if set(boots.keys()) == {"all","id0","id1"} and sp.issparse(boots["all"]):
+        return boots
+    return boot_weights(boots, n, compact)
+
+
+def _boot_mean(x, t, w, compact=False):
+    """
+    Mean of "x" over the index "t" for every bootstrap sample of "w" (a BootPlan or the output of boot_weights), from float32 values of x if compact
+    """
+    if compact:
+        x = np.asarray(x, dtype=np.float32)
+    if hasattr(w, "means"):
+        return w.means(x, t)
+    return boot_means(x, w[t])
+
+
+def meas_frame(meas_result, meas):
+    """
+    Put the bootstrap values of one measure in the long format shared by all the measures
+    
+    :meas_result:(1-d array) value of the measure for each bootstrap sample
+    :meas:(string) name for the output measure
+    :return:(dataframe) value=calculated measure, boot=row number/bootstrap id, measure=meas (name of the calculated measure)
+    """
     meas_df = pd.DataFrame({'value' : meas_result,
                             'measure': meas
                           }).reset_index()
     meas_df.columns = ['boot','value','measure']
     return meas_df
+
+
+def msd_one(x1,t1,meas,boots,compact=False):
+    """
+    For each bootstrap index "boots", calculate the fairness measure "meas" from data "x" and the corresponding index name "t"
+    
+    :boots:(nested dictionary) boostrap indexes, including index of all samples, as well as the index of 0-level ("id0") and 1-level ("id1"). The output of boot_weights or a BootPlan are also accepted.
+    :x1:(1-d array) data input for calculation 
+    :t1:(string) string indicating name of the index for x1
+    :meas:(string) name for the output measure
+    :compact:(True/False) if True, the means are computed from float32 values and counts, summed around their mean_shift. 
+        The indexes are kept in int32 whenever they fit. A BootPlan uses its own precision (see BootPlan compact). Default False.
+    :return:(dataframe) with value=calculated measure, boot=row number/bootstrap id, measure=meas (name of the calculated measure)
+    """
+    w = _as_weights(boots, len(x1), compact)
+    meas_result = _boot_mean(x1, t1, w, compact)
+    
+    return meas_frame(meas_result, meas)
         
     
-def msd_two(x1,t1,x2,t2,meas,boots):
+def msd_two(x1,t1,x2,t2,meas,boots,compact=False):
     """
     For each bootstrap index "boots", calculate the fairness measure "meas" from data "x" and the corresponding index name "t"
     
-    :boots:(dictionary) boostrap indexes, including index of all samples, as well as the index of 0-level ("id0") and 1-level ("id1") 
+    :boots:(dictionary) boostrap indexes, including index of all samples, as well as the index of 0-level ("id0") and 1-level ("id1"). The output of boot_weights or a BootPlan are also accepted.
     :x1:(1-d array) data input for calculation 
     :t1:(string) string indicating name of the index for x1
     :x2:(1-d array) data input for calculation 
     :t2:(string) string indicating name of the index for x2
     :meas:(string) name for the output measure
+    :compact:(True/False) see msd_one
     :return:(dataframe) value=calculated measure, boot=row number/bootstrap id, measure=meas (name of the calculated measure)
      """
-    meas_result = []
-    
-    for b in boots:
-        boot_data1_tmp = x1[boots[b][t1]]
-        boot_data2_tmp = x2[boots[b][t2]]
-        
-        meas_result_tmp = np.nanmean(boot_data1_tmp) + np.nanmean(boot_data2_tmp)
-        meas_result.append(meas_result_tmp)
-        
-    meas_df = pd.DataFrame({'value' : meas_result,
-                            'measure': meas
-                          }).reset_index()
-    meas_df.columns = ['boot','value','measure']
-    return meas_df
+    w = _as_weights(boots, len(x1), compact)
+    meas_result = _boot_mean(x1, t1, w, compact) + _boot_mean(x2, t2, w, compact)
     
-
+    return meas_frame(meas_result, meas)
     
 
-def msd_three(x1,t1,x2,t2,x3,t3,meas,boots):
+def msd_three(x1,t1,x2,t2,x3,t3,meas,boots,compact=False):
     """
     For each bootstrap index "boots", calculate the fairness measure "meas" from data "x" and the corresponding index name "t"
     
+    :boots:(dictionary) boostrap indexes, including index of all samples, as well as the index of 0-level ("id0") and 1-level ("id1"). The output of boot_weights or a BootPlan are also accepted.
     :x1:(1-d array) data input for calculation 
     :t1:(string) string indicating name of the index for x1
     :x2:(1-d array) data input for calculation 
@@ -67,23 +176,13 @@ def msd_three(x1,t1,x2,t2,x3,t3,meas,boots):
     :x3:(1-d array) data input for calculation 
     :t3:(string) string indicating name of the index for x3
     :meas:(string) name for the output measure
+    :compact:(True/False) see msd_one
     :return:(dataframe) value=calculated measure, boot=row number/bootstrap id, measure=meas (name of the calculated measure)
     """
-    meas_result = []
+    w = _as_weights(boots, len(x1), compact)
+    meas_result = _boot_mean(x1, t1, w, compact) + _boot_mean(x2, t2, w, compact) + _boot_mean(x3, t3, w, compact)
     
-    for b in boots:
-        boot_data1_tmp = x1[boots[b][t1]]
-        boot_data2_tmp = x2[boots[b][t2]]
-        boot_data3_tmp = x3[boots[b][t3]]
-        
-        meas_result_tmp = np.nanmean(boot_data1_tmp) + np.nanmean(boot_data2_tmp) + np.nanmean(boot_data3_tmp)
-        meas_result.append(meas_result_tmp)
-        
-    meas_df = pd.DataFrame({'value' : meas_result,
-                            'measure': meas
-                          }).reset_index()
-    meas_df.columns = ['boot','value','measure']
-    return meas_df
+    return meas_frame(meas_result, meas)
 
 
 def inh_str(x,meas,set0=False,setna=False):
@@ -105,12 +204,13 @@ def inh_str(x,meas,set0=False,setna=False):
     
     return x
 
-def auto_dummy(data, col):
+def auto_dummy(data, col, compact=False):
     """
     Automatically change the categorical variables in the "col" columns of data into dummies
     
     :data:(dataframe) the entire dataset
     :col:(array) the columns to be screened and adjusted
+    :compact:(True/False) if True, the dummies are uint8 and the float64 columns of "col" are turned into float32, see AuditData.from_frame dtype. Default False.
     :return1:(dataframe) the adjusted dataframe
     :return2:(array) the adjusted column names of "col"
     """
@@ -126,7 +226,9 @@ def auto_dummy(data, col):
 
     data_adj_col_other = data_adj_col[col_other]
     
-    data_adj_col_cat = pd.get_dummies(data = data_adj_col_cat,columns = col_cat)
+    data_adj_col_cat = pd.get_dummies(data = data_adj_col_cat,columns = col_cat, dtype = np.uint8 if compact else None)
+    if compact:
+        data_adj_col_other = data_adj_col_other.astype({c: np.float32 for c in col_other if data_adj_col_other[c].dtype == np.float64})
     col_cat_adj = data_adj_col_cat.columns.values
     col_adj = np.concatenate([col_cat_adj,col_other])
     
@@ -134,4 +236,38 @@ def auto_dummy(data, col):
     data_adj = pd.concat([data_adj_col,data_adj_other],axis=1)    
     
     return data_adj, col_adj 
-    
\ No newline at end of file
+    
+
+def if_mean(x, idx):
+    """
+    Mean of "x" over the rows "idx" (ignoring nan), together with its influence function, used for the analytic standard errors of the measures
+    
+    :x:(1-d array) data input for calculation 
+    :idx:(1-d bool array) rows the mean is taken over
+    :return1:(float) the mean
+    :return2:(1-d array) influence function, (x - mean) * n / n_idx on the non-missing rows of idx and 0 elsewhere. 
+        The variance of any sum of such means is estimated by sum(influence**2) / n**2.
+    """
+    x = np.asarray(x, dtype=float)
+    rows = idx & ~np.isnan(x)
+    n_idx = rows.sum()
+    if n_idx == 0:
+        return np.nan, np.zeros(len(x))
+    
+    mean = x[rows].mean()
+    influence = np.zeros(len(x))
+    influence[rows] = (x[rows] - mean) * len(x) / n_idx
+    return mean, influence
+
+
+def if_ratio(num, den):
+    """
+    Ratio of two means with its influence function (delta method)
+    
+    :num:(tuple) (mean, influence function) of the numerator, as returned by if_mean
+    :den:(tuple) (mean, influence function) of the denominator, as returned by if_mean
+    :return1:(float) num / den
+    :return2:(1-d array) influence function of the ratio
+    """
+    ratio = num[0] / den[0]
+    return ratio, (num[1] - ratio * den[1]) / den[0]
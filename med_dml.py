@@ -0,0 +1,286 @@
+from results import MEASURES, measures_frame, measure_values, analytic_measures, shape_values, subset_se
+from bootstrap import BootPlan, WEIGHTED, outer_sample, segment_masks
+from design import AuditData
+from helpers import if_mean, if_ratio
+from profiling import as_profiler
+from concurrent.futures import ThreadPoolExecutor
+from threadpoolctl import threadpool_limits
+from sklearn.base import clone
+from sklearn.dummy import DummyClassifier, DummyRegressor
+from sklearn.linear_model import LinearRegression, LogisticRegression
+from sklearn.model_selection import KFold
+import numpy as np
+
+
+def ci_mdml(data, X, Z, W, Y, x0, x1, rep, nboot = 100,
+            mdml_regressor = None,
+            mdml_classifier = None,
+            mdml_n_folds = 5,
+            mdml_clip = 0.01,
+            mdml_n_jobs = 1,
+            random_state = None,
+            resample = "index",
+            inference = "bootstrap",
+            subset_size = None,
+            profiler = None,
+            segments = None):
+    """
+    Use cross-fitted double machine learning (doubly robust scores of the mediation formula) to decompose the causal effects.
+    Gives the same measure table as ci_crf.
+
+    :data:(dataframe or AuditData) if a dataframe, the columns of Z and W must be numeric.
+    :X:(array) scalar giving the name of the protected attribute. Must be one of the entries of data.columns
+    :Z:(array) vector giving the names of all confounders. Must be one of the entries of data.columns
+    :W:(array) vector giving the names of all mediators. Must be one of the entries of data.columns
+    :Y:(array) scalar giving the name of the outcome, or a list of names. Must be one of the entries of data.columns
+    :x0:(string) scalar values giving the two levels of the binary protected attribute.
+    :x1:(string) scalar values giving the two levels of the binary protected attribute.
+    :rep:(integer) scalar index input from the outter bootstrap loop
+    :nboot:(integer) scalar determining the number of inner bootstrap repetitions.
+
+    :mdml_regressor:(scikit-learn regressor) model of the outcome regressions, cloned for every fit. Default LinearRegression().
+    :mdml_classifier:(scikit-learn classifier with predict_proba) model of the propensity scores P(x1|Z) and P(x1|Z,W). Default LogisticRegression(max_iter=1000).
+        Every fold fits two classifiers and four regressions per outcome, so the default models are linear ones, far cheaper than the two causal forests; 
+        flexible models (e.g. HistGradientBoostingRegressor(max_iter=50)) capture nonlinear nuisances at several times the cost of the forests.
+    :mdml_n_folds:(integer) number of cross-fitting folds. Default 5.
+    :mdml_clip:(float) propensity scores are clipped to [mdml_clip, 1 - mdml_clip]. Default 0.01.
+    :mdml_n_jobs:(integer) number of folds fitted in parallel (threads). Default 1.
+
+    :random_state:(None, integer, SeedSequence or Generator) source of all the randomness of this repetition. If None, the global np.random state is used.
+    :resample:("index", "weight", "poisson" or "dirichlet") see ci_crf. With all but "index", the nuisance models must accept sample_weight in fit.
+    :inference:("bootstrap" or "analytic") see ci_crf.
+    :subset_size:(integer, float or None) bag of little bootstraps, see ci_crf.
+    :profiler:(None, profiling.Profiler or function) see ci_crf. The stages are outer_sample, nuisance_fit (all the folds), scores, inner_bootstrap and measures.
+    :segments:(1-d int array or None) see ci_crf: the measures are also computed within every segment by averaging the same cross-fitted scores over its rows.
+
+    :return:(dataframe) This df inclused all types of causal effects. value=calculated measure, boot=row number/bootstrap id, measure=meas (name of the calculated measure)
+    """
+    values = mdml_measures(data=data, X=X, Z=Z, W=W, Y=Y, x0=x0, x1=x1, rep=rep, nboot=nboot,
+                           mdml_regressor=mdml_regressor,
+                           mdml_classifier=mdml_classifier,
+                           mdml_n_folds=mdml_n_folds,
+                           mdml_clip=mdml_clip,
+                           mdml_n_jobs=mdml_n_jobs,
+                           random_state=random_state,
+                           resample=resample,
+                           inference=inference,
+                           subset_size=subset_size,
+                           profiler=profiler,
+                           segments=segments)
+    outcomes = data.outcomes if isinstance(data, AuditData) else Y
+    labels = None if segments is None else np.arange(-1, len(values[0] if inference == "analytic" else values) - 1)
+    if inference == "analytic":
+        return measures_frame(values[0], rep, outcomes = outcomes, se = values[1], segments = labels)
+    return measures_frame(values, rep, outcomes = outcomes, segments = labels)
+
+
+def mdml_measures(data, X, Z, W, Y, x0, x1, rep, nboot = 100,
+                  mdml_regressor = None,
+                  mdml_classifier = None,
+                  mdml_n_folds = 5,
+                  mdml_clip = 0.01,
+                  mdml_n_jobs = 1,
+                  random_state = None,
+                  resample = "index",
+                  inference = "bootstrap",
+                  subset_size = None,
+                  profiler = None,
+                  segments = None):
+    """
+    Same as ci_mdml, but return the measures as an array instead of a dataframe (see crf_measures for the shapes).
+    """
+    if not isinstance(data, AuditData):
+        data = AuditData.from_frame(data, X, Z, W, Y, x0)
+
+    profiler = as_profiler(profiler)
+    t, y, scores, plan_seed, rows, weight = mdml_predict(data, rep, regressor = mdml_regressor, classifier = mdml_classifier, n_folds = mdml_n_folds,
+                                                         clip = mdml_clip, n_jobs = mdml_n_jobs, random_state = random_state, resample = resample, subset_size = subset_size, profiler = profiler)
+    has_z, has_w = data.n_z > 0, data.n_w > 0
+    p0 = (t == 0).astype(float)
+    segs = [] if segments is None else segment_masks(segments, rows, t == 0)
+
+    if inference == "analytic":
+        if resample in WEIGHTED:
+            raise ValueError("inference 'analytic' does not support resample %r" % (resample,))
+        values = np.empty((1 + len(segs), data.n_y, 1, len(MEASURES)))
+        se = np.empty((1 + len(segs), data.n_y, 1, len(MEASURES)))
+        with profiler.stage("measures", rep):
+            for k, seg_rows in enumerate([np.ones(len(t), dtype=bool)] + [seg["all"][1] for seg in segs]):
+                idx = {"all": seg_rows, "id0": seg_rows & (t == 0), "id1": seg_rows & (t == 1)}
+                p0_all = if_mean(p0, idx["all"])
+                for j, s in enumerate(scores):
+                    terms = {"y_id0": if_mean(y[:,j], idx["id0"]), "y_id1": if_mean(y[:,j], idx["id1"]),
+                             "te_all": if_mean(s["te"], idx["all"]), "te_id0": if_ratio(if_mean(s["ett"], idx["all"]), p0_all),
+                             "med_all": if_mean(s["nde"], idx["all"]), "med_id0": if_ratio(if_mean(s["ctfde"], idx["all"]), p0_all)}
+                    values[k, j, 0], se[k, j, 0] = analytic_measures(terms, has_z, has_w)
+        se = subset_se(se, len(t), data.n)
+        return shape_values(values, segments, data.multi), shape_values(se, segments, data.multi)
+    if inference != "bootstrap":
+        raise ValueError("inference must be 'bootstrap' or 'analytic', got %r" % (inference,))
+
+    #all the means of all the outcomes in a single pass over the plan, over all the rows and over the rows of each segment. 
+    #The x0-specific effects are ratios of means over all rows, their denominator being the share of x0 rows of the bootstrap sample
+    plan = BootPlan(group0 = t == 0, nboot = nboot, seed = plan_seed, lazy = True, size = data.n, scheme = resample if resample in WEIGHTED else "multinomial", weight = weight)
+    names = [{name: name for name in ("all", "id0", "id1")}] + [{name: key for name, (key, _) in seg.items()} for seg in segs]
+    cols = {}
+    for nm in names:
+        cols.update({nm["all"]: [p0], nm["id0"]: [], nm["id1"]: []})
+        for j, s in enumerate(scores):
+            cols[nm["all"]] += [s["te"], s["ett"], s["nde"], s["ctfde"]]
+            cols[nm["id0"]].append(y[:, j])
+            cols[nm["id1"]].append(y[:, j])
+    with profiler.stage("inner_bootstrap", rep):
+        m = plan.means_many(cols, {key: mask for seg in segs for key, mask in seg.values()})
+
+    values = np.empty((len(names), data.n_y, nboot, len(MEASURES)))
+    with profiler.stage("measures", rep):
+        for k, nm in enumerate(names):
+            m_all = m[nm["all"]]
+            for j in range(data.n_y):
+                te, ett, nde, ctfde = m_all[:, 1+4*j:5+4*j].T
+                ett, ctfde = ett / m_all[:, 0], ctfde / m_all[:, 0]
+
+                #same layout as the causal forest means, see measure_values
+                all_cols, id0_cols = [], [m[nm["id0"]][:, j]]
+                if has_z:
+                    all_cols.append(te)
+                    id0_cols.append(ett)
+                if has_w:
+                    all_cols.append(nde)
+                    id0_cols.append(ctfde)
+                m_j = {"all": np.column_stack(all_cols) if len(all_cols) > 0 else np.empty((nboot, 0)),
+                       "id0": np.column_stack(id0_cols),
+                       "id1": m[nm["id1"]][:, j:j+1]}
+                values[k, j] = measure_values(m_j, nboot, has_z, has_w)
+
+    return shape_values(values, segments, data.multi)
+
+
+def mdml_predict(data, rep, regressor=None, classifier=None, n_folds=5, clip=0.01, n_jobs=1, random_state=None, resample="index", subset_size=None, profiler=None):
+    """
+    Draw the outter bootstrap sample of one repetition and compute the cross-fitted doubly robust scores of the effects on it.
+
+    The nuisance models are fitted once per fold and shared by all the scores: the propensity scores P(x1|Z) and P(x1|Z,W) by all the outcomes,
+    the outcome regressions E[Y|x,Z] by te and ett, and E[Y|x1,Z,W] with its nested regression on Z by nde and ctfde.
+
+    :data:(AuditData)
+    :rep:(integer) scalar index input from the outter bootstrap loop, rep <= 1 uses the data as is
+    :regressor, classifier, n_folds, clip, n_jobs:(see ci_mdml)
+    :random_state:(None, integer, SeedSequence or Generator) see ci_crf
+    :resample:("index", "weight", "poisson" or "dirichlet") see ci_crf
+    :subset_size:(integer, float or None) see ci_crf
+    :profiler:(None, profiling.Profiler or function) see ci_crf
+    :return:(tuple) t (treatment), y (2-d, one column per outcome), scores (one dictionary per outcome with the per-row scores
+        "te" and "nde", whose means are the effects, and "ett" and "ctfde", whose means divided by the share of x0 rows are the x0-specific effects),
+        all aligned on the rows of the outter bootstrap sample, the seed of the inner bootstrap plan, the row of data each row was drawn from, 
+        and with resample "poisson" or "dirichlet" the replicate weight of each row (None otherwise)
+    """
+    regressor = LinearRegression() if regressor is None else regressor
+    classifier = LogisticRegression(max_iter = 1000) if classifier is None else classifier
+
+    profiler = as_profiler(profiler)
+    with profiler.stage("outer_sample", rep):
+        samp = outer_sample(data, rep, random_state = random_state, resample = resample, subset_size = subset_size)
+    features, t, y, weight = samp["features"], samp["t"], samp["y"], samp["weight"]
+    seed = samp["seeds"][0]
+
+    with profiler.stage("nuisance_fit", rep):
+        #with "index", the copies of a drawn row are in the same fold, so that no row is predicted by models fitted on its own copy
+        folds = _group_folds(samp["rows"] if samp["expand"] is None else np.arange(len(t)), n_folds, seed)
+        args = (features, t, y, weight, data.n_z, data.n_w > 0, regressor, classifier, seed)
+        if n_jobs == 1:
+            fitted = [_fit_fold(train, test, *args) for train, test in folds]
+        else:
+            #the folds run in threads, the models themselves single-threaded to avoid oversubscription
+            with threadpool_limits(limits = 1), ThreadPoolExecutor(max_workers = n_jobs) as pool:
+                fitted = list(pool.map(lambda f: _fit_fold(f[0], f[1], *args), folds))
+
+    with profiler.stage("scores", rep):
+        #cross-fitted nuisance predictions, each row predicted by the models of the folds it was not in
+        nuis = {k: np.empty((len(t),) + v.shape[1:]) for k, v in fitted[0].items()}
+        for (train, test), pred in zip(folds, fitted):
+            for k in nuis:
+                nuis[k][test] = pred[k]
+
+        e_z = np.clip(nuis["e_z"], clip, 1 - clip)
+        e_zw = np.clip(nuis["e_zw"], clip, 1 - clip) if data.n_w > 0 else e_z
+
+        scores = []
+        for j in range(y.shape[1]):
+            y_j, mu0, mu1 = y[:, j], nuis["mu0_z"][:, j], nuis["mu1_z"][:, j]
+            mu1_zw, nu = (nuis["mu1_zw"][:, j], nuis["nu_z"][:, j]) if data.n_w > 0 else (mu1, mu1)
+
+            psi0 = mu0 + (1 - t) * (y_j - mu0) / (1 - e_z)
+            psi1 = mu1 + t * (y_j - mu1) / e_z
+            #E[Y_{x1, W_{x0}}]
+            psi10 = t * (1 - e_zw) / (e_zw * (1 - e_z)) * (y_j - mu1_zw) + (1 - t) / (1 - e_z) * (mu1_zw - nu) + nu
+            scores.append({"te": psi1 - psi0,
+                           "nde": psi10 - psi0,
+                           "ett": (1 - t) * (mu1 - y_j) + t * (1 - e_z) / e_z * (y_j - mu1),
+                           "ctfde": (1 - t) * (mu1_zw - y_j) + t * (1 - e_zw) / e_zw * (y_j - mu1_zw)})
+
+    expand = samp["expand"]
+    if expand is not None:
+        t, y = t[expand], y[expand]
+        scores = [{k: v[expand] for k, v in s.items()} for s in scores]
+
+    return t, y, scores, samp["plan_seed"], samp["rows"], samp["weight"] if resample in WEIGHTED else None
+
+
+def _group_folds(groups, n_folds, seed):
+    """
+    Cross-fitting folds over the distinct values of "groups": every group (e.g. the copies of a row in a bootstrap sample) is in a single fold.
+    Without repeated groups, the folds are those of KFold on the rows, when groups is increasing.
+
+    :groups:(1-d int array) group of each row
+    :return:(list) (train, test) row indexes of every fold
+    """
+    ids, inverse = np.unique(groups, return_inverse = True)
+    fold = np.empty(len(ids), dtype = int)
+    for k, (_, test) in enumerate(KFold(n_splits = n_folds, shuffle = True, random_state = seed).split(ids)):
+        fold[test] = k
+    fold = fold[inverse]
+    return [(np.flatnonzero(fold != k), np.flatnonzero(fold == k)) for k in range(n_folds)]
+
+
+def _fit(model, X, y, weight, seed):
+    """
+    Fit a clone of "model", or a constant model if there are no features
+    """
+    if X.shape[1] == 0:
+        model = DummyClassifier(strategy = "prior") if hasattr(model, "predict_proba") else DummyRegressor()
+    else:
+        model = clone(model)
+        if "random_state" in model.get_params():
+            model.set_params(random_state = seed)
+    if weight is None:
+        return model.fit(X, y)
+    return model.fit(X, y, sample_weight = weight)
+
+
+def _fit_fold(train, test, features, t, y, weight, n_z, has_w, regressor, classifier, seed):
+    """
+    Fit the nuisance models on the rows "train" and predict them on the rows "test"
+    """
+    w = (lambda rows: None if weight is None else weight[rows])
+    x_z, x_zw = features[:, :n_z], features
+    tr0, tr1 = train[t[train] == 0], train[t[train] == 1]
+
+    pred = {"e_z": _fit(classifier, x_z[train], t[train], w(train), seed).predict_proba(x_z[test])[:, 1],
+            "mu0_z": np.empty((len(test), y.shape[1])),
+            "mu1_z": np.empty((len(test), y.shape[1]))}
+    if has_w:
+        pred["e_zw"] = _fit(classifier, x_zw[train], t[train], w(train), seed).predict_proba(x_zw[test])[:, 1]
+        pred["mu1_zw"] = np.empty((len(test), y.shape[1]))
+        pred["nu_z"] = np.empty((len(test), y.shape[1]))
+
+    for j in range(y.shape[1]):
+        pred["mu0_z"][:, j] = _fit(regressor, x_z[tr0], y[tr0, j], w(tr0), seed).predict(x_z[test])
+        pred["mu1_z"][:, j] = _fit(regressor, x_z[tr1], y[tr1, j], w(tr1), seed).predict(x_z[test])
+        if has_w:
+            mu1_zw = _fit(regressor, x_zw[tr1], y[tr1, j], w(tr1), seed)
+            pred["mu1_zw"][:, j] = mu1_zw.predict(x_zw[test])
+            #nested regression E[ E[Y|x1,Z,W] | x0, Z ]
+            pred["nu_z"][:, j] = _fit(regressor, x_z[tr0], mu1_zw.predict(x_zw[tr0]), w(tr0), seed).predict(x_z[test])
+
+    return pred
@@ -0,0 +1,178 @@
+import os
+import sys
+import time
+import tracemalloc
+import pandas as pd
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class _NullProfiler:
+    """
+    Profiler used when profiling is off: every stage is the same no-op context manager, so the instrumented code costs one method call per stage.
+    """
+    enabled = False
+    memory = None
+    _stage = _NullStage()
+
+    def stage(self, name, rep=None):
+        return self._stage
+
+    def add(self, events):
+        pass
+
+
+NULL_PROFILER = _NullProfiler()
+
+
+def as_profiler(profiler):
+    """
+    :profiler:(None, Profiler or function) a function is used as the callback of a new Profiler
+    :return:(Profiler) NULL_PROFILER if profiler is None
+    """
+    if profiler is None:
+        return NULL_PROFILER
+    if callable(profiler) and not hasattr(profiler, "stage"):
+        return Profiler(callbacks = [profiler])
+    return profiler
+
+
+def _max_rss():
+    #peak resident memory of the process in MB (ru_maxrss is in kB on Linux, in bytes on macOS)
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2**20 if sys.platform == "darwin" else rss / 2**10
+
+
+class Profiler:
+    """
+    Record the wall time, CPU time and memory of the stages of an audit, as a list of events.
+
+    Pass it to fairness_cookbook (or the ci_* functions) as "profiler". The stages recorded are, per outter repetition ("rep"):
+    "outer_sample" (resampling of the encoded data), "crf_fit_te", "crf_oob_te", "crf_fit_med", "crf_oob_med" (causal forests), "crf_predict" (predictions of fitted forests on new data, see auditor.FairnessAuditor), "nuisance_fit" and "scores" (medDML),
+    "wls" (OLS), "inner_bootstrap" (the means of the inner bootstrap samples), "measures" and "rep" (the whole repetition);
+    and once per audit "encode" (dummies and NumPy arrays) and "summary".
+
+    Every event is a dictionary: stage, rep (None outside the repetitions), start (time.time()), wall and cpu (seconds, CPU time of the whole process, all threads),
+    mem (MB, see memory) and pid (the process it ran in, the worker processes send their events back to the main one).
+
+    Can be used as a context manager, which starts and stops the memory tracing:
+
+        with Profiler(memory="tracemalloc") as prof:
+            fairness_cookbook(..., profiler=prof)
+        prof.report()
+
+    :callbacks:(list of functions) called with every event as soon as it is recorded (in the main process), e.g. to send it to a logger
+    :memory:(None, "rss" or "tracemalloc") "rss": increase of the peak resident memory of the process during the stage (cheap, but 0 unless the stage reaches a new peak);
+        "tracemalloc": peak of the memory allocated by the stage above what was allocated when it started (precise, but slows down Python-heavy code). Default "rss".
+    """
+    enabled = True
+
+    def __init__(self, callbacks=None, memory="rss"):
+        if memory not in (None, "rss", "tracemalloc"):
+            raise ValueError("memory must be None, 'rss' or 'tracemalloc', got %r" % (memory,))
+        self.callbacks = list(callbacks) if callbacks is not None else []
+        self.memory = memory
+        self.events = []
+        self._open = []
+        self._started = False
+
+    def start(self):
+        if self.memory == "tracemalloc" and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started = True
+        return self
+
+    def stop(self):
+        if self._started:
+            tracemalloc.stop()
+            self._started = False
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+    def stage(self, name, rep=None):
+        """
+        :name:(string) name of the stage
+        :rep:(integer or None) outter repetition the stage belongs to
+        :return:(context manager) records one event when the block it wraps ends
+        """
+        return _Stage(self, name, rep)
+
+    def add(self, events):
+        """
+        Record events produced elsewhere (e.g. by the Profiler of a worker process) and pass them to the callbacks
+        """
+        for event in events:
+            self.events.append(event)
+            for callback in self.callbacks:
+                callback(event)
+
+    def report(self):
+        """
+        :return:(dataframe) one row per stage, sorted by total wall time: count, wall_total, wall_mean, cpu_total, mem_max, and share (of the total wall time of the repetitions, or of all stages if none)
+        """
+        columns = ["count", "wall_total", "wall_mean", "cpu_total", "mem_max", "share"]
+        if len(self.events) == 0:
+            return pd.DataFrame(columns = columns, index = pd.Index([], name = "stage"))
+        events = pd.DataFrame(self.events)
+        res = events.groupby("stage").agg(count = ("wall", "size"), wall_total = ("wall", "sum"), wall_mean = ("wall", "mean"),
+                                          cpu_total = ("cpu", "sum"), mem_max = ("mem", "max"))
+        total = res.loc["rep", "wall_total"] if "rep" in res.index else res["wall_total"].sum()
+        res["share"] = res["wall_total"] / total if total > 0 else float("nan")
+        return res.sort_values("wall_total", ascending = False)
+
+
+class _Stage:
+    def __init__(self, profiler, name, rep):
+        self.profiler = profiler
+        self.name = name
+        self.rep = rep
+
+    def __enter__(self):
+        prof = self.profiler
+        if prof.memory == "tracemalloc":
+            prof.start()
+            current, peak = tracemalloc.get_traced_memory()
+            #the stages around this one keep the peak reached so far, before it is reset for this one
+            for stage in prof._open:
+                stage.peak = max(stage.peak, peak)
+            tracemalloc.reset_peak()
+            self.mem0, self.peak = current, current
+        elif prof.memory == "rss":
+            self.mem0 = _max_rss()
+        prof._open.append(self)
+        self.start = time.time()
+        self.wall0, self.cpu0 = time.perf_counter(), time.process_time()
+        return self
+
+    def __exit__(self, *exc):
+        wall, cpu = time.perf_counter() - self.wall0, time.process_time() - self.cpu0
+        prof = self.profiler
+        prof._open.pop()
+        mem = None
+        if prof.memory == "tracemalloc":
+            self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+            if len(prof._open) > 0:
+                prof._open[-1].peak = max(prof._open[-1].peak, self.peak)
+            mem = (self.peak - self.mem0) / 2**20
+        elif prof.memory == "rss" and self.mem0 is not None:
+            mem = _max_rss() - self.mem0
+        prof.add([{"stage": self.name, "rep": self.rep, "start": self.start, "wall": wall, "cpu": cpu, "mem": mem, "pid": os.getpid()}])
+        return False
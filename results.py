@@ -0,0 +1,595 @@
+from scipy.stats import norm
+import warnings
+import pandas as pd
+import numpy as np
+
+#order in which the measures are computed and reported
+MEASURES = np.array(["tv","te","expse_x1","expse_x0","ett","ctfse","nde","nie","ctfde","ctfie"])
+
+#normal quantile of the 95% confidence intervals built from analytic standard errors
+Z_95 = 1.959963984540054
+
+
+def measures_frame(values, rep, measures=MEASURES, outcomes=None, se=None, segments=None):
+    """
+    Put the measures of one outter bootstrap repetition in the long format
+
+    :values:(2-d array) (nboot x n_measures) value of each measure for each inner bootstrap sample, or (n_outcomes x nboot x n_measures) for several outcomes
+    :rep:(integer) index of the outter bootstrap repetition
+    :measures:(array) names of the columns of values
+    :outcomes:(array) names of the outcomes if values is 3-d
+    :se:(array or None) analytic standard errors, same shape as values. If given, the columns se, ci_lower and ci_upper (normal 95% interval) are added.
+    :segments:(array or None) labels of the segments, if values has one more leading axis for them
+    :return:(dataframe) value=calculated measure, boot=row number/bootstrap id, measure=name of the calculated measure, rep=rep (and outcome=name of the outcome for several outcomes, segment=label of the segment)
+    """
+    if segments is not None:
+        res = [measures_frame(values[k], rep, measures, outcomes, None if se is None else se[k]) for k in range(len(segments))]
+        return pd.concat([r.assign(segment = s) for r, s in zip(res, segments)])
+    if values.ndim == 3:
+        res = [measures_frame(values[j], rep, measures, se = None if se is None else se[j]) for j in range(values.shape[0])]
+        return pd.concat([r.assign(outcome = o) for r, o in zip(res, outcomes)])
+    
+    nboot = values.shape[0]
+    boot = np.tile(np.arange(nboot), len(measures))
+    res = pd.DataFrame({'boot' : boot,
+                        'value' : values.T.ravel(),
+                        'measure' : np.repeat(measures, nboot).astype(object),
+                        'rep' : rep
+                       }, index = boot)
+    if se is not None:
+        res['se'] = se.T.ravel()
+        res['ci_lower'] = res['value'] - Z_95 * res['se']
+        res['ci_upper'] = res['value'] + Z_95 * res['se']
+    return res
+
+
+class MeasureStore:
+    """
+    Preallocated (nboot1 x nboot2 x n_measures) array holding every measure of every inner and outter bootstrap sample.
+
+    Measures are stored by their code (column position in "measures"); the long dataframe is only built when to_frame is called.
+    With several outcomes, the array is (nboot1 x n_outcomes x nboot2 x n_measures), and with segments (nboot1 x n_segments x [n_outcomes x] nboot2 x n_measures).
+
+    :nboot1:(integer) number of outter bootstrap repetitions
+    :nboot2:(integer) number of inner bootstrap repetitions
+    :measures:(array) names of the measures. Default MEASURES.
+    :outcomes:(array or None) names of the outcomes when several outcomes are audited together. Default None.
+    :segments:(array or None) names of the segments (subgroups of rows) the measures are also computed in. Default None.
+    :with_se:(True/False) whether analytic standard errors are stored next to the values (analytic inference, nboot2 is then 1). Default False.
+    :between:(True/False or float) whether the spread between the outter repetitions is part of the std of the summary. 
+        A float f in (0, 1) is the bag of little bootstraps, whose repetitions are fitted on subsets of b = f * n rows: the variance is then the mean variance within each repetition 
+        plus f times the variance between their means, the spread of fits on b rows brought back to the scale of n rows (see stats_summary). 
+        False leaves the repetitions out: the std is the average of the std within each repetition. Default True.
+    """
+
+    def __init__(self, nboot1, nboot2, measures=MEASURES, outcomes=None, with_se=False, between=True, segments=None):
+        self.measures = np.asarray(measures)
+        self.outcomes = None if outcomes is None else np.asarray(outcomes).reshape(-1)
+        self.segments = None if segments is None else np.asarray(segments, dtype=object).reshape(-1)
+        #axes between the outter repetitions and the inner samples, with their names
+        self.levels = [(name, labels) for name, labels in (("segment", self.segments), ("outcome", self.outcomes)) if labels is not None]
+        shape = (nboot1,) + tuple(len(labels) for _, labels in self.levels) + (nboot2, len(self.measures))
+        self.values = np.full(shape, np.nan)
+        self.se = np.full(shape, np.nan) if with_se else None
+        self.done = np.zeros(nboot1, dtype=bool)
+        self.between = between
+        #why the outter repetitions stopped, set by fairness_cookbook
+        self.stop_reason = None
+
+    def write(self, rep, values, se=None):
+        """
+        :rep:(integer) index of the outter bootstrap repetition
+        :values:(array) (nboot2 x n_measures) measures of this repetition, columns in the order of self.measures ((n_segments x n_outcomes x nboot2 x n_measures) with segments and several outcomes)
+        :se:(array or None) standard errors of values, if the store was created with_se
+        """
+        self.values[rep] = values
+        if self.se is not None:
+            self.se[rep] = se
+        self.done[rep] = True
+
+    def code(self, meas):
+        """
+        :meas:(string) name of a measure
+        :return:(integer) position of the measure in the last axis of self.values
+        """
+        return int(np.flatnonzero(self.measures == meas)[0])
+
+    def to_frame(self):
+        """
+        :return:(dataframe) the stored measures in the long format, value=calculated measure, boot=row number/bootstrap id, measure=name of the calculated measure, rep=outter repetition
+        """
+        reps = np.flatnonzero(self.done)
+        if len(reps) == 0:
+            return pd.DataFrame({'boot':[], 'value':[], 'measure':[], 'rep':[]})
+        if len(self.levels) == 0:
+            return pd.concat([measures_frame(self.values[r], r, self.measures, se = None if self.se is None else self.se[r]) for r in reps])
+        
+        res = []
+        for r in reps:
+            for key in np.ndindex(*self.values.shape[1:-2]):
+                frame = measures_frame(self.values[r][key], r, self.measures, se = None if self.se is None else self.se[r][key])
+                res.append(frame.assign(**{name: labels[k] for (name, labels), k in zip(self.levels, key)}))
+        return pd.concat(res)
+
+    def summary(self):
+        """
+        :return:(dataframe) mean and standard deviation of each measure over all bootstrap samples, indexed by measure (by segment, outcome and measure with segments and several outcomes), same layout as res.groupby("measure").agg({'value':['mean','std']}).
+            With analytic standard errors, std combines the mean analytic variance with the variance between the outter repetitions.
+            Without the spread between repetitions (between=False), std is the mean of the std (or of the analytic standard error) of each repetition, 
+            and with a float between, it adds between times the variance of their means to their mean variance.
+        """
+        index = pd.Index(self.measures, name = "measure")
+        values = self.values[self.done]
+        se = None if self.se is None else self.se[self.done]
+        if len(self.levels) == 0:
+            return _summary(values, index, se, self.between).sort_index()
+        
+        #one summary per (segment, outcome)
+        values, se, keys = self._by_level(values, se)
+        res_summary = [_summary(values[:, g], index, None if se is None else se[:, g], self.between) for g in range(len(keys))]
+        return pd.concat(res_summary, keys = keys, names = [name for name, _ in self.levels]).sort_index()
+
+    def _by_level(self, values, se):
+        #(repetitions x groups x nboot2 x n_measures), one group per combination of the levels, and the labels of the groups
+        shape = (values.shape[0], -1) + values.shape[-2:]
+        keys = pd.MultiIndex.from_product([labels for _, labels in self.levels]) if len(self.levels) > 1 else self.levels[0][1]
+        return values.reshape(shape), None if se is None else se.reshape(shape), list(keys)
+
+
+    def mc_error(self):
+        """
+        Monte-Carlo standard error of the summary due to the finite number of outter repetitions, by jackknife over the completed repetitions (each left out in turn).
+        
+        :return:(dataframe) indexed like summary, columns mean, ci_lower and ci_upper (mean -/+ Z_95 * std of the summary): the jackknife standard error of each. nan with less than 2 repetitions.
+        """
+        values = self.values[self.done]
+        se = None if self.se is None else self.se[self.done]
+        if len(self.levels) == 0:
+            index = pd.Index(self.measures, name = "measure")
+        else:
+            #(repetitions x inner samples x (segment, outcome, measure))
+            index = pd.MultiIndex.from_product([labels for _, labels in self.levels] + [self.measures], names = [name for name, _ in self.levels] + ["measure"])
+            values, se, _ = self._by_level(values, se)
+            values = np.swapaxes(values, 1, 2).reshape(values.shape[0], values.shape[2], -1)
+            se = None if se is None else np.swapaxes(se, 1, 2).reshape(se.shape[0], se.shape[2], -1)
+        
+        res = pd.DataFrame(_jackknife(rep_stats(values, se), self.between), index = index, columns = ["mean", "ci_lower", "ci_upper"])
+        return res.sort_index()
+
+
+class QuantileSketch:
+    """
+    Approximate quantiles of a stream of values in bounded memory, mergeable across workers (a compactor sketch in the spirit of KLL).
+    
+    The values are kept in levels: a level holding more than k values is sorted and every other value is promoted to the next level, where it counts twice.
+    With n values the sketch holds at most about k * log2(n / k) of them, and the error of the rank of a quantile is of the order of log2(n / k) / k.
+    While fewer than k values have been added, the quantiles are exact (those of np.quantile).
+    
+    :k:(integer) capacity of each level. Default 256.
+    """
+    
+    def __init__(self, k=256):
+        self.k = max(int(k), 2)
+        self.levels = [np.empty(0)]
+        self.n = 0
+        #offset of the values promoted by the next compaction, alternated so that the errors cancel out
+        self._offset = 0
+    
+    def update(self, x):
+        """
+        :x:(array) values to add, nan are ignored
+        :return:(QuantileSketch) self
+        """
+        x = np.asarray(x, dtype=float).ravel()
+        x = x[~np.isnan(x)]
+        self.levels[0] = np.concatenate([self.levels[0], x])
+        self.n += len(x)
+        self._compress()
+        return self
+    
+    def merge(self, other):
+        """
+        :other:(QuantileSketch) sketch of other values, e.g. computed by another worker
+        :return:(QuantileSketch) self, the sketch of the values of both
+        """
+        for h, values in enumerate(other.levels):
+            if h == len(self.levels):
+                self.levels.append(np.empty(0))
+            self.levels[h] = np.concatenate([self.levels[h], values])
+        self.n += other.n
+        self._compress()
+        return self
+    
+    def _compress(self):
+        h = 0
+        while h < len(self.levels):
+            if len(self.levels[h]) > self.k:
+                values = np.sort(self.levels[h])
+                #an odd value out stays at its level
+                keep, values = values[len(values) - len(values) % 2:], values[:len(values) - len(values) % 2]
+                if h + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                self.levels[h + 1] = np.concatenate([self.levels[h + 1], values[self._offset::2]])
+                self.levels[h] = keep
+                self._offset = 1 - self._offset
+            h += 1
+    
+    def quantile(self, q):
+        """
+        :q:(float or array) probabilities in [0, 1]
+        :return:(float or array) the approximate quantiles, nan if no value was added
+        """
+        if self.n == 0:
+            return np.full(np.shape(q), np.nan) if np.ndim(q) > 0 else np.nan
+        if len(self.levels) == 1:
+            return np.quantile(self.levels[0], q)
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(v), 2.0**h) for h, v in enumerate(self.levels)])
+        order = np.argsort(values)
+        values, weights = values[order], weights[order]
+        #each value stands for the middle of the ranks it represents
+        position = (np.cumsum(weights) - weights / 2) / weights.sum()
+        return np.interp(q, position, values)
+
+
+class StreamSummary:
+    """
+    Summary of the measures updated one outter repetition at a time, without keeping the inner bootstrap samples: 
+    for every measure, the count, mean and sum of squared deviations of each repetition (merged as in Welford's algorithm) and a quantile sketch of all the values, 
+    so that the memory does not grow with nboot2 (nor with nboot1 beyond a few numbers per repetition and measure).
+    Same interface as MeasureStore (write, done, summary, mc_error), except to_frame.
+    
+    :nboot1:(integer) number of outter bootstrap repetitions
+    :measures, outcomes, segments, with_se, between:(see MeasureStore)
+    :level:(float) level of the percentile intervals. Default 0.95.
+    :k:(integer) capacity of the quantile sketches, see QuantileSketch. Default 256.
+    """
+    
+    def __init__(self, nboot1, measures=MEASURES, outcomes=None, segments=None, with_se=False, between=True, level=0.95, k=256):
+        self.measures = np.asarray(measures)
+        self.outcomes = None if outcomes is None else np.asarray(outcomes).reshape(-1)
+        self.segments = None if segments is None else np.asarray(segments, dtype=object).reshape(-1)
+        self.levels = [(name, labels) for name, labels in (("segment", self.segments), ("outcome", self.outcomes)) if labels is not None]
+        self.shape = tuple(len(labels) for _, labels in self.levels) + (len(self.measures),)
+        n_cols = int(np.prod(self.shape))
+        self.stats = {"count": np.zeros((nboot1, n_cols), dtype=np.int64), "mean": np.full((nboot1, n_cols), np.nan), "m2": np.zeros((nboot1, n_cols))}
+        if with_se:
+            self.stats["se2"] = np.zeros((nboot1, n_cols))
+        self.probs = ((1 - level) / 2, (1 + level) / 2)
+        #quantiles within each repetition, averaged for the intervals of the bag of little bootstraps
+        self.rep_quantiles = np.full((nboot1, n_cols, 2), np.nan)
+        self.sketches = [QuantileSketch(k) for _ in range(n_cols)]
+        self.done = np.zeros(nboot1, dtype=bool)
+        self.between = between
+        self.stop_reason = None
+    
+    def write(self, rep, values, se=None):
+        """
+        :rep:(integer) index of the outter bootstrap repetition
+        :values:(array) measures of this repetition, laid out as in MeasureStore.write
+        :se:(array or None) standard errors of values, if the summary was created with_se
+        """
+        #(inner samples x (segment, outcome, measure))
+        cols = lambda a: np.moveaxis(np.asarray(a, dtype=float).reshape(self.shape[:-1] + a.shape[-2:]), -2, 0).reshape(a.shape[-2], -1)
+        x = cols(values)
+        stats = rep_stats(x[None], None if "se2" not in self.stats else cols(se)[None])
+        for key in self.stats:
+            self.stats[key][rep] = stats[key][0]
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            self.rep_quantiles[rep] = np.nanquantile(x, self.probs, axis=0).T
+        for j, sketch in enumerate(self.sketches):
+            sketch.update(x[:, j])
+        self.done[rep] = True
+    
+    def merge(self, other):
+        """
+        :other:(StreamSummary) summary of other outter repetitions of the same audit (e.g. run by another worker)
+        :return:(StreamSummary) self, holding the repetitions of both
+        """
+        for key in self.stats:
+            self.stats[key][other.done] = other.stats[key][other.done]
+        self.rep_quantiles[other.done] = other.rep_quantiles[other.done]
+        for sketch, sketch_other in zip(self.sketches, other.sketches):
+            sketch.merge(sketch_other)
+        self.done |= other.done
+        return self
+    
+    def _index(self):
+        names = [name for name, _ in self.levels] + ["measure"]
+        if len(self.levels) == 0:
+            return pd.Index(self.measures, name = "measure")
+        return pd.MultiIndex.from_product([labels for _, labels in self.levels] + [self.measures], names = names)
+    
+    def summary(self):
+        """
+        :return:(dataframe) same as MeasureStore.summary, with the percentile interval of each measure in the columns ci_lower and ci_upper: 
+            the quantiles of all its values (approximate, see QuantileSketch), with between=False the mean of the quantiles of each repetition, 
+            and with a float between the normal interval of the mean and std
+        """
+        stats = {key: v[self.done] for key, v in self.stats.items()}
+        mean, std = stats_summary(stats, self.between)
+        if self.between is True:
+            lower, upper = np.array([sketch.quantile(self.probs) for sketch in self.sketches]).reshape(-1, 2).T
+        elif self.between:
+            #the quantiles of the repetitions miss the spread between them, the interval is normal
+            z = norm.ppf(self.probs[1])
+            lower, upper = mean - z * std, mean + z * std
+        else:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", RuntimeWarning)
+                lower, upper = np.nanmean(self.rep_quantiles[self.done], axis=0).T
+        return pd.DataFrame({('value','mean'): mean, ('value','std'): std, ('value','ci_lower'): lower, ('value','ci_upper'): upper}, index = self._index()).sort_index()
+    
+    def mc_error(self):
+        """
+        :return:(dataframe) see MeasureStore.mc_error
+        """
+        stats = {key: v[self.done] for key, v in self.stats.items()}
+        return pd.DataFrame(_jackknife(stats, self.between), index = self._index(), columns = ["mean", "ci_lower", "ci_upper"]).sort_index()
+
+
+def rep_stats(values, se=None):
+    """
+    Sufficient statistics of the inner samples of each outter repetition, from which the summary and its Monte-Carlo error are computed (ignoring nan)
+    
+    :values:(3-d array) (repetitions x inner samples x k)
+    :se:(3-d array or None) analytic standard errors of values
+    :return:(dictionary) each (repetitions x k): "count", "mean" (nan if count is 0), "m2" (sum of the squared deviations from the mean), "se2" (sum of se**2, only with se)
+    """
+    count = (~np.isnan(values)).sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.where(count > 0, np.nansum(values, axis=1) / count, np.nan)
+        m2 = np.nansum((values - mean[:, None, :])**2, axis=1)
+    res = {"count": count, "mean": mean, "m2": m2}
+    if se is not None:
+        res["se2"] = np.nansum(se**2, axis=1)
+    return res
+
+
+def _within_std(count, m2, se2):
+    #std of each repetition, with the analytic variance if given
+    with np.errstate(invalid="ignore", divide="ignore"):
+        var = np.where(count > 1, m2 / np.maximum(count - 1, 1), np.nan if se2 is None else 0)
+        if se2 is not None:
+            var = np.where(count > 0, se2 / np.maximum(count, 1) + var, np.nan)
+    return np.sqrt(var)
+
+
+def stats_summary(stats, between=True):
+    """
+    Mean and std of _summary from the statistics of rep_stats, merging the repetitions as in the parallel version of Welford's algorithm
+    
+    With a float between f (subsets of f * n rows, see fairness_cookbook subset_size), the variance is the mean variance within the repetitions plus f times the variance between their means.
+    This is a heuristic, not the bag of little bootstraps proper, whose inner samples would refit the models: here they reweight the predictions of one fit per subset, 
+    so that only the spread between the subsets holds the variance of the fits, and that spread on b rows is taken to be n / b times the one on n rows.
+    
+    :return:(tuple) mean and std, each of length k
+    """
+    count, mean, m2, se2 = stats["count"], stats["mean"], stats["m2"], stats.get("se2")
+    total = count.sum(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        grand = np.where(total > 0, np.nansum(count * mean, axis=0) / np.maximum(total, 1), np.nan)
+        ss = m2.sum(axis=0) + np.nansum(count * (mean - grand)**2, axis=0)
+        if not between:
+            within = _within_std(count, m2, se2)
+            has = (~np.isnan(within)).sum(axis=0)
+            return grand, np.where(has > 0, np.nansum(within, axis=0) / np.maximum(has, 1), np.nan)
+        if between is not True:
+            within = _within_std(count, m2, se2)
+            has = (~np.isnan(within)).sum(axis=0)
+            var_within = np.where(has > 0, np.nansum(within**2, axis=0) / np.maximum(has, 1), np.nan)
+            return grand, np.sqrt(var_within + between * _rep_var(mean))
+        if se2 is None:
+            return grand, np.where(total > 1, np.sqrt(ss / np.maximum(total - 1, 1)), np.nan)
+        var = np.where(total > 1, ss / np.maximum(total - 1, 1), 0)
+        return grand, np.where(total > 0, np.sqrt(se2.sum(axis=0) / np.maximum(total, 1) + var), np.nan)
+
+
+def _rep_var(mean):
+    #variance between the means of the repetitions (those with values), 0 with less than 2
+    k = (~np.isnan(mean)).sum(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        center = np.nansum(mean, axis=0) / np.maximum(k, 1)
+        return np.where(k > 1, np.nansum((mean - center)**2, axis=0) / np.maximum(k - 1, 1), 0)
+
+
+def _jackknife(stats, between=True):
+    """
+    Jackknife standard error over the outter repetitions of the mean, mean - Z_95 * std and mean + Z_95 * std computed by _summary, 
+    from the statistics of rep_stats so that each leave-one-out summary costs O(1).
+    
+    :return:(2-d array) (k x 3)
+    """
+    count, mean, m2, se2 = stats["count"], stats["mean"], stats["m2"], stats.get("se2")
+    n_rep = count.shape[0]
+    if n_rep < 2:
+        return np.full((count.shape[-1], 3), np.nan)
+    
+    with np.errstate(invalid="ignore", divide="ignore"):
+        #sums centered on the grand mean, so that the sums of squares do not lose precision
+        center = np.where(count.sum(axis=0) > 0, np.nansum(count * mean, axis=0) / np.maximum(count.sum(axis=0), 1), 0)
+        dev = np.where(count > 0, mean - center, 0)
+        total, square = count * dev, m2 + count * dev**2
+        
+        loo = lambda a: a.sum(axis=0) - a
+        c, s, q = loo(count), loo(total), loo(square)
+        mean = np.where(c > 0, s / c, np.nan) + center
+        ss = q - s**2 / np.maximum(c, 1)
+        if not between:
+            #mean over the other repetitions of the std within each repetition
+            within = _within_std(count, m2, se2)
+            has = ~np.isnan(within)
+            std = loo(np.where(has, within, 0)) / loo(has.astype(float))
+        elif between is not True:
+            #mean variance within the other repetitions, plus between times the variance of their means
+            within = _within_std(count, m2, se2)
+            has, rep = ~np.isnan(within), count > 0
+            k, s1, s2 = loo(rep.astype(float)), loo(np.where(rep, dev, 0)), loo(np.where(rep, dev**2, 0))
+            var_means = np.where(k > 1, (s2 - s1**2 / np.maximum(k, 1)) / np.maximum(k - 1, 1), 0)
+            std = np.sqrt(loo(np.where(has, within**2, 0)) / loo(has.astype(float)) + between * var_means)
+        elif se2 is None:
+            std = np.where(c > 1, np.sqrt(ss / np.maximum(c - 1, 1)), np.nan)
+        else:
+            std = np.where(c > 0, np.sqrt(loo(se2) / np.maximum(c, 1) + np.where(c > 1, ss / np.maximum(c - 1, 1), 0)), np.nan)
+        
+        stats = np.stack([mean, mean - Z_95 * std, mean + Z_95 * std], axis=-1)
+        n_obs = (~np.isnan(stats)).sum(axis=0)
+        dev = stats - np.nansum(stats, axis=0) / np.maximum(n_obs, 1)
+        res = np.sqrt((n_rep - 1) / n_rep * np.nansum(dev**2, axis=0))
+    return np.where(n_obs == 0, np.nan, res)
+
+
+def _summary(values, index, se=None, between=True):
+    """
+    Mean and standard deviation (ignoring nan) of each measure (last axis) of the 3-d array values (outter repetitions x inner samples x measures). 
+    If the standard errors "se" of the values are given, the variance is the mean of se**2 plus the variance between the rows of values.
+    If not between, the standard deviation is the mean over the outter repetitions of their own standard deviation (or of se), with a float between see stats_summary.
+    """
+    if between is not True and between:
+        mean, std = stats_summary(rep_stats(values, se), between)
+        return pd.DataFrame({('value','mean') : mean, ('value','std') : std}, index = index)
+    if not between:
+        res = _summary(values, index)
+        #std (or root mean se**2) of each repetition, then their mean
+        within = np.array([_summary(values[r:r+1], index, None if se is None else se[r:r+1])[('value','std')].to_numpy() for r in range(len(values))]).reshape(-1, values.shape[-1])
+        count = (~np.isnan(within)).sum(axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            res[('value','std')] = np.where(count > 0, np.nansum(within, axis=0) / count, np.nan)
+        return res
+    
+    values = values.reshape(-1, values.shape[-1])
+    se = None if se is None else se.reshape(-1, se.shape[-1])
+    count = (~np.isnan(values)).sum(axis=0)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        total = np.nansum(values, axis=0)
+        mean = np.where(count > 0, total / count, np.nan)
+        ss = np.nansum((values - mean)**2, axis=0)
+        if se is None:
+            std = np.where(count > 1, np.sqrt(ss / (count - 1)), np.nan)
+        else:
+            between = np.where(count > 1, ss / np.maximum(count - 1, 1), 0)
+            std = np.where(count > 0, np.sqrt(np.nansum(se**2, axis=0) / count + between), np.nan)
+
+    return pd.DataFrame({('value','mean') : mean, ('value','std') : std}, index = index)
+
+
+def measure_values(m, nboot, has_z, has_w):
+    """
+    Combine the bootstrap means of one outcome into the measures
+    
+    :m:(dictionary) bootstrap means laid out like the output of BootPlan.means_many for the columns "all": [crf_te, crf_med], "id0": [y, crf_te, crf_med], "id1": [y] 
+        (crf_te and crf_med only if fitted). Other backends put their estimates of the same quantities in the same places.
+    :nboot:(integer) number of inner bootstrap samples
+    :has_z:(True/False) whether crf_te was fitted (the confounders Z are not empty)
+    :has_w:(True/False) whether crf_med was fitted (the mediators W are not empty)
+    :return:(2-d array) (nboot x len(MEASURES)) value of each measure for each inner bootstrap sample
+    """
+    y_id0, y_id1 = m["id0"][:,0], m["id1"][:,0]
+    
+    values = np.empty((nboot, len(MEASURES)))
+    meas = dict(zip(MEASURES, values.T))
+    meas["tv"][:] = y_id1 + (-y_id0)
+    
+    if not has_z:
+        meas["te"][:] = meas["tv"]
+        meas["ett"][:] = meas["tv"]
+        meas["expse_x1"][:] = 0
+        meas["expse_x0"][:] = 0
+        meas["ctfse"][:] = 0
+        te_all = te_id0 = np.full(nboot, meas["tv"][0])
+    else:
+        te_all, te_id0 = m["all"][:,0], m["id0"][:,1]
+        
+        meas["te"][:] = te_all
+        meas["ett"][:] = te_id0
+        meas["ctfse"][:] = te_id0 + (-y_id1) + y_id0
+        meas["expse_x0"][:] = np.nan
+        meas["expse_x1"][:] = np.nan
+
+    if not has_w:
+        meas["nde"][:] = meas["te"]
+        meas["ctfde"][:] = meas["ett"]
+        meas["ctfie"][:] = 0
+        meas["nie"][:] = 0
+    else:
+        med_all, med_id0 = m["all"][:,-1], m["id0"][:,-1]
+        
+        meas["nde"][:] = med_all
+        meas["ctfde"][:] = med_id0
+        meas["nie"][:] = med_all + (-te_all)
+        meas["ctfie"][:] = med_id0 + (-te_id0)
+    
+    return values
+
+
+def shape_values(values, segments, multi):
+    """
+    :values:(4-d array) (1 + n_segments) x n_outcomes x nboot x n_measures measures of one outter repetition, all the rows first, then each segment
+    :segments:(array or None) segments the measures were computed in
+    :multi:(True/False) whether several outcomes are audited
+    :return:(array) values without the axes of the segments (if None) and of the outcomes (if not multi)
+    """
+    if segments is None:
+        values = values[0]
+    return values if multi else values[..., 0, :, :]
+
+
+def subset_se(se, n_fit, n):
+    """
+    Standard errors of estimates on a subset of the data (bag of little bootstraps), brought back to the scale of all the rows: the influence-function variances shrink as 1 / n
+    
+    :se:(array) standard errors of the estimates on the n_fit rows of the subset
+    :n_fit:(integer) number of rows the estimates were computed on
+    :n:(integer) number of rows of the data
+    :return:(array) se * sqrt(n_fit / n), se itself without subset
+    """
+    return se * np.sqrt(n_fit / n)
+
+
+def analytic_measures(terms, has_z, has_w):
+    """
+    Combine the means of one outcome into the measures, with standard errors from their influence functions
+    
+    :terms:(dictionary) (mean, influence function) pairs (see helpers.if_mean) of "y_id0", "y_id1", and "te_all", "te_id0" if has_z, "med_all", "med_id0" if has_w. 
+        Same quantities as in measure_values.
+    :has_z:(True/False) whether the Z-only effects were estimated
+    :has_w:(True/False) whether the Z+W effects were estimated
+    :return:(tuple) estimates and standard errors, each a 1-d array of length len(MEASURES)
+    """
+    n = len(terms["y_id0"][1])
+    y_id0, y_id1 = terms["y_id0"], terms["y_id1"]
+    #each measure is a signed sum of means, its influence function is the same sum of theirs
+    meas = {"tv": [(1, y_id1), (-1, y_id0)]}
+    
+    if not has_z:
+        meas["te"] = meas["ett"] = meas["tv"]
+        meas["expse_x1"] = meas["expse_x0"] = meas["ctfse"] = []
+        te_all = te_id0 = meas["tv"]
+    else:
+        te_all, te_id0 = [(1, terms["te_all"])], [(1, terms["te_id0"])]
+        meas["te"], meas["ett"] = te_all, te_id0
+        meas["ctfse"] = te_id0 + [(-1, y_id1), (1, y_id0)]
+        meas["expse_x1"] = meas["expse_x0"] = None
+    
+    if not has_w:
+        meas["nde"], meas["ctfde"] = meas["te"], meas["ett"]
+        meas["nie"] = meas["ctfie"] = []
+    else:
+        med_all, med_id0 = [(1, terms["med_all"])], [(1, terms["med_id0"])]
+        meas["nde"], meas["ctfde"] = med_all, med_id0
+        meas["nie"] = med_all + [(-c, m) for c, m in te_all]
+        meas["ctfie"] = med_id0 + [(-c, m) for c, m in te_id0]
+    
+    values = np.empty(len(MEASURES))
+    se = np.empty(len(MEASURES))
+    for k, name in enumerate(MEASURES):
+        if meas[name] is None:
+            values[k] = se[k] = np.nan
+            continue
+        values[k] = sum(c * m[0] for c, m in meas[name])
+        influence = sum((c * m[1] for c, m in meas[name]), np.zeros(n))
+        se[k] = np.sqrt(np.sum(influence**2)) / n
+    
+    return values, se
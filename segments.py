@@ -0,0 +1,109 @@
+"""
+Audits of several protected attributes and of the segments (subgroups of rows, e.g. regions or industries) of the data in one call, sharing one encoding of the data.
+"""
+from decompositions import fairness_cookbook
+from design import AuditData
+from concurrent.futures import ProcessPoolExecutor
+import os
+import re
+import pandas as pd
+import numpy as np
+
+
+def _run_audit(base, spec, X, Z, W, Y, x0, x1, segments, seed, kwargs, name):
+    #the audit is selected from the shared encoding where it runs, spec being the rows, the treatment and the excluded variables (see AuditData.select)
+    audit = base.select(*spec)
+    if kwargs.get("run_dir") is not None:
+        #every audit is checkpointed in its own subdirectory
+        kwargs = dict(kwargs, run_dir = os.path.join(kwargs["run_dir"], re.sub(r"[^\w.-]", "_", name)))
+    return fairness_cookbook(audit, X, Z, W, Y, x0, x1, segments = segments, seed = seed, **kwargs)
+
+
+def segmented_cookbook(data, X, Z, W, Y, x0, x1, by = None, protected = None, method = "causal_forest", refit = False, min_size = 20,
+                       nboot1 = 1, nboot2 = 100, if_auto_dummy = True, n_jobs = 1, seed = None, **kwargs):
+    """
+    Decompose the causal effects for several protected attributes and within the segments of the data.
+
+    The columns of Z and W are encoded once, and every audit reuses the encoded arrays (see AuditData.select), which the worker processes map from shared memory (see AuditData.share).
+    Unless refit is True, the segments of one protected attribute are audited in the same run, from the same model fits and inner bootstrap samples (see fairness_cookbook segments):
+    each protected attribute then costs one audit, whatever the number of segments. Otherwise (refit, or method "OLS", which has no per-row effects),
+    the models are refitted on the rows of every segment, and these audits run in parallel over n_jobs processes.
+
+    :data:(dataframe)
+    :X, Z, W, Y, x0, x1:(see fairness_cookbook) X, x0 and x1 give the first protected attribute.
+        Only the rows at x0 or x1 are audited, the rows at other levels (e.g. of a protected attribute with more than two levels) are left out.
+    :by:(string or None) column of data defining the segments. Default None, no segments.
+    :protected:(list or None) other protected attributes, as (X, x0, x1) tuples, e.g. [("race", "white", "black"), ("hispanic_origin", "no", "yes")].
+        They are audited with the same Z, W and Y, without their own columns when they are among Z or W. Default None.
+    :method:(string) see fairness_cookbook
+    :refit:(True/False) whether the models are refitted on every segment instead of sharing the fits of all the rows.
+        The shared fits give the effects of each segment under the model of the whole population, the refits let each segment have its own model. Default False.
+    :min_size:(integer) with refits, segments with fewer rows at either level of the protected attribute are left out. Default 20.
+    :nboot1, nboot2, if_auto_dummy, seed:(see fairness_cookbook) every audit gets its own seed spawned from seed, so the results do not depend on n_jobs.
+    :n_jobs:(integer) number of worker processes: those of every audit with shared fits (its outter repetitions run in parallel), or those the refitted audits are spread over. 
+        The cores of cpu_budget (kwargs, default all) are split between them, see fairness_cookbook cpu_budget. Default 1.
+    :kwargs:(dictionary) other parameters of fairness_cookbook (crf_*, mdml_*, inference, subset_size, tol, encoding, ...). With run_dir, every audit is checkpointed in the subdirectory attribute_segment of run_dir (resuming them needs the same seed).
+    :return1:(dataframe) the measures of every audit as in fairness_cookbook, with the columns attribute and segment ("all" for all the rows) if by is given
+    :return2:(dataframe) their summary, indexed by attribute, segment (if by is given), outcome (if Y is a list) and measure.
+        Its attrs["runs"] lists the attrs of the summary of every audit (n_reps, stop_reason, mc_error) with its attribute and segment (None for all the segments of an audit with shared fits).
+    """
+    if kwargs.get("return_store", False) or "segments" in kwargs:
+        raise ValueError("segmented_cookbook does not take return_store or segments, see by")
+    Z = [] if Z is None else list(np.atleast_1d(Z))
+    W = [] if W is None else list(np.atleast_1d(W))
+    attributes = [(X, x0, x1)] + ([] if protected is None else [tuple(p) for p in protected])
+    share = by is not None and not refit and method != "OLS"
+
+    base = AuditData.from_frame(data, X, Z, W, Y, x0, dtype = np.float32 if kwargs.get("compact", False) else np.float64, encode = if_auto_dummy, encoding = kwargs.get("encoding", "dummy"))
+    labels = None if by is None else pd.Categorical(data[by])
+
+    #one job per protected attribute, and with refits one more per segment
+    jobs = []
+    for X_a, x0_a, x1_a in attributes:
+        level = data[X_a].to_numpy()
+        t = level != x0_a
+        rows = np.flatnonzero((level == x0_a) | (level == x1_a))
+        Z_a, W_a = [c for c in Z if c != X_a], [c for c in W if c != X_a]
+        if by is None or share:
+            jobs.append(((X_a, None), (rows if len(rows) < base.n else None, t, [X_a]), (X_a, Z_a, W_a, Y, x0_a, x1_a), None if by is None else np.asarray(labels)[rows]))
+            continue
+
+        jobs.append(((X_a, "all"), (rows if len(rows) < base.n else None, t, [X_a]), (X_a, Z_a, W_a, Y, x0_a, x1_a), None))
+        codes = labels.codes[rows]
+        for k, name in enumerate(labels.categories):
+            seg = rows[codes == k]
+            n_x1 = int(t[seg].sum())
+            if min(n_x1, len(seg) - n_x1) < min_size:
+                continue
+            jobs.append(((X_a, name), (seg, t, [X_a]), (X_a, Z_a, W_a, Y, x0_a, x1_a), None))
+
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(np.random.randint(np.iinfo(np.int32).max) if seed is None else seed)
+    seeds = seed.spawn(len(jobs))
+    kwargs.update(method = method, nboot1 = nboot1, nboot2 = nboot2, if_auto_dummy = if_auto_dummy)
+
+    n_cores = kwargs.get("cpu_budget") or os.cpu_count() or 1
+    n_jobs = max(min(n_cores if n_jobs == -1 else n_jobs, n_cores), 1)
+    if share or by is None or n_jobs == 1:
+        kwargs.update(n_jobs = n_jobs)
+        outputs = [_run_audit(base, spec, *cols, segs, s, kwargs, "%s_%s" % key) for (key, spec, cols, segs), s in zip(jobs, seeds)]
+    else:
+        #the refitted audits run in parallel, each in one process with its share of the cores, selecting its rows from the encoding published once in shared memory
+        kwargs.update(n_jobs = 1, cpu_budget = max(n_cores // n_jobs, 1))
+        base = base.share()
+        with base, ProcessPoolExecutor(max_workers = min(n_jobs, len(jobs))) as pool:
+            futures = [pool.submit(_run_audit, base, spec, *cols, segs, s, kwargs, "%s_%s" % key) for (key, spec, cols, segs), s in zip(jobs, seeds)]
+            outputs = [f.result() for f in futures]
+
+    frames, summaries, runs = [], [], []
+    for ((attribute, segment), _, _, _), (res, res_summary) in zip(jobs, outputs):
+        runs.append(dict(attribute = attribute, segment = segment, **res_summary.attrs))
+        if segment is not None:
+            res = res.assign(segment = segment)
+            res_summary = pd.concat([res_summary], keys = [segment], names = ["segment"])
+        frames.append(res.assign(attribute = attribute))
+        summaries.append(res_summary)
+
+    res_summary = pd.concat(summaries, keys = [attribute for (attribute, _), _, _, _ in jobs], names = ["attribute"]).sort_index()
+    res_summary.attrs = {"runs": runs}
+    return pd.concat(frames), res_summary
@@ -0,0 +1,73 @@
+from results import MEASURES
+import pandas as pd
+import numpy as np
+
+
+def simulate_scm(n, z_levels = 10, w_levels = 5, direct = 1.0, direct_z = 0.5, mediator = 1.0, mediator_effect = 1.0, confounding = 1.0, seed = None):
+    """
+    Draw data from a structural causal model with the graph used by fairness_cookbook: Z -> X, Z -> W, Z -> Y, X -> W, X -> Y, W -> Y,
+    together with the true value of every measure, computed from the potential outcomes of each row.
+
+    Columns: "x" protected attribute ("x0" or "x1"), confounders "z_num" (numeric) and "z_cat" (categorical, z_levels levels),
+    mediators "w_num" (numeric) and "w_cat" (categorical, w_levels levels), outcome "y".
+    The effect of x on y is direct * x + direct_z * x * z_num + mediator_effect * w_num + (level effects of w_cat), with w_num = mediator * x + ...,
+    so that te and ett differ when there is confounding (x depends on z_num) and the direct effect varies with z_num.
+
+    :n:(integer) number of rows
+    :z_levels:(integer) number of levels of z_cat
+    :w_levels:(integer) number of levels of w_cat
+    :direct:(float) direct effect of x1 vs x0 on y at z_num = 0
+    :direct_z:(float) change of the direct effect per unit of z_num
+    :mediator:(float) effect of x1 vs x0 on w_num
+    :mediator_effect:(float) effect of w_num on y
+    :confounding:(float) strength of the dependence of x, w and y on z_num
+    :seed:(None or integer) seed of the draws
+    :return1:(dataframe) the data, to be audited with X="x", Z=["z_num","z_cat"], W=["w_num","w_cat"], Y="y", x0="x0", x1="x1"
+    :return2:(series) true value of each measure of results.MEASURES on this sample, indexed by measure (expse_x1 and expse_x0 are not estimated by the package and left nan)
+    """
+    rng = np.random.default_rng(seed)
+
+    #effects of the levels of the categorical variables
+    z_on_x, z_on_y = rng.normal(0, 0.5, z_levels), rng.normal(0, 1, z_levels)
+    w_base, w_shift, w_on_y = rng.normal(0, 1, w_levels), rng.normal(0, 1, w_levels), rng.normal(0, 1, w_levels)
+
+    z_num = rng.normal(size = n)
+    z_cat = rng.integers(0, z_levels, n)
+    x = (rng.random(n) < 1 / (1 + np.exp(-(confounding * z_num + z_on_x[z_cat])))).astype(int)
+
+    #potential mediators, drawn from the same noise for x0 and x1
+    eps_w, u_w, eps_y = rng.normal(size = n), rng.random(n), rng.normal(size = n)
+    def w_of(xv):
+        logits = w_base + xv[:, None] * w_shift
+        prob = np.exp(logits - logits.max(axis = 1, keepdims = True))
+        cum = np.cumsum(prob / prob.sum(axis = 1, keepdims = True), axis = 1)
+        w_cat = np.minimum((cum < u_w[:, None]).sum(axis = 1), w_levels - 1)
+        return mediator * xv + 0.5 * confounding * z_num + eps_w, w_cat
+
+    def y_of(xv, w):
+        w_num, w_cat = w
+        return direct * xv + direct_z * xv * z_num + mediator_effect * w_num + w_on_y[w_cat] + confounding * z_num + z_on_y[z_cat] + eps_y
+
+    zeros, ones = np.zeros(n), np.ones(n)
+    w0, w1 = w_of(zeros), w_of(ones)
+    y0, y1, y10 = y_of(zeros, w0), y_of(ones, w1), y_of(ones, w0)
+    w_num, w_cat = np.where(x == 1, w1[0], w0[0]), np.where(x == 1, w1[1], w0[1])
+    y = np.where(x == 1, y1, y0)
+
+    data = pd.DataFrame({"x": np.where(x == 1, "x1", "x0"),
+                         "z_num": z_num,
+                         "z_cat": np.char.add("z", z_cat.astype(str)).astype(object),
+                         "w_num": w_num,
+                         "w_cat": np.char.add("w", w_cat.astype(str)).astype(object),
+                         "y": y})
+
+    #true measures, with the conventions of results.measure_values
+    id0 = x == 0
+    truth = dict.fromkeys(MEASURES, np.nan)
+    truth["tv"] = y[~id0].mean() - y[id0].mean()
+    truth["te"], truth["ett"] = (y1 - y0).mean(), (y1 - y0)[id0].mean()
+    truth["nde"], truth["ctfde"] = (y10 - y0).mean(), (y10 - y0)[id0].mean()
+    truth["nie"], truth["ctfie"] = truth["nde"] - truth["te"], truth["ctfde"] - truth["ett"]
+    truth["ctfse"] = truth["ett"] - truth["tv"]
+
+    return data, pd.Series(truth, name = "truth").rename_axis("measure")
@@ -0,0 +1,28 @@
+import os
+import sys
+import warnings
+
+import pytest
+
+#the modules of the package are flat files at the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from simulate import simulate_scm
+
+Z, W = ["z_num", "z_cat"], ["w_num", "w_cat"]
+
+
+@pytest.fixture(scope="session")
+def scm():
+    #small data of the structural causal model, with the arguments of fairness_cookbook
+    data, truth = simulate_scm(600, z_levels=4, w_levels=3, seed=0)
+    return data, ("x", Z, W, "y", "x0", "x1")
+
+
+@pytest.fixture(autouse=True)
+def _quiet():
+    #econml and scikit-learn warn about their own deprecations
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", FutureWarning)
+        warnings.simplefilter("ignore", DeprecationWarning)
+        yield
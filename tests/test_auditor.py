@@ -0,0 +1,27 @@
+import os
+
+import numpy as np
+
+from auditor import FairnessAuditor
+from decompositions import fairness_cookbook
+
+
+def test_in_sample_score_matches_cookbook(scm, tmp_path):
+    data, args = scm
+    params = dict(nboot1=2, crf_n_estimators=16, crf_n_jobs=1, seed=7)
+    _, expected = fairness_cookbook(data, *args, method="causal_forest", nboot2=10, **params)
+
+    auditor = FairnessAuditor(*args, cache_dir=str(tmp_path), **params).fit(data)
+    assert not auditor.cache_hit_
+    _, summary = auditor.score(data, nboot2=10)
+    assert summary.attrs["in_sample"]
+    np.testing.assert_allclose(summary.to_numpy(), expected.to_numpy(), rtol=1e-10)
+
+    #the same data, parameters and seed load the forests written by the first fit
+    cached = FairnessAuditor(*args, cache_dir=str(tmp_path), **params).fit(data)
+    assert cached.cache_hit_ and len(os.listdir(tmp_path)) == 1
+    assert cached.score(data, nboot2=10)[1].equals(summary)
+
+    path = str(tmp_path / "auditor.joblib")
+    auditor.save(path)
+    assert FairnessAuditor.load(path).score(data, nboot2=10)[1].equals(summary)
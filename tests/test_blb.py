@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from decompositions import fairness_cookbook
+from simulate import simulate_scm
+
+MEASURES = ["te", "ett", "nde", "ctfde"]
+
+
+def _std_and_error(store):
+    #std of the summary and its jackknife standard error over the outter repetitions
+    std = store.summary()[("value", "std")][MEASURES]
+    reps = np.flatnonzero(store.done)
+    loo = []
+    for r in reps:
+        store.done[r] = False
+        loo.append(store.summary()[("value", "std")][MEASURES])
+        store.done[r] = True
+    loo = pd.concat(loo, axis=1)
+    return std, np.sqrt((len(reps) - 1) * loo.var(axis=1, ddof=0))
+
+
+@pytest.mark.parametrize("method, nboot1", [("OLS", 40), ("causal_forest", 12)])
+def test_blb_std_matches_full_scheme(method, nboot1):
+    data, _ = simulate_scm(3000, z_levels=4, w_levels=3, seed=0)
+    args = (data, "x", ["z_num", "z_cat"], ["w_num", "w_cat"], "y", "x0", "x1")
+    kwargs = dict(method=method, nboot1=nboot1, nboot2=30, crf_n_estimators=24, seed=0, return_store=True)
+    full, _ = fairness_cookbook(*args, **kwargs)
+    blb, _ = fairness_cookbook(*args, subset_size=1000, **kwargs)
+
+    (std_full, error_full), (std_blb, error_blb) = _std_and_error(full), _std_and_error(blb)
+    z = (std_blb - std_full) / np.sqrt(error_full**2 + error_blb**2)
+    assert np.all(np.abs(z) < 3), z
+    if method == "causal_forest":
+        #the std within the repetitions alone misses the variance of the fits
+        blb.between = False
+        within = blb.summary()[("value", "std")][["te", "nde"]]
+        assert np.all(within < std_blb[["te", "nde"]] / 2)
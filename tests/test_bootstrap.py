@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+
+from bootstrap import BootPlan, WEIGHT_CHUNK, replicate_weights
+from helpers import msd_one, msd_two, msd_three
+
+
+def _loop_means(x, t, boots):
+    #the original loop of msd_one: one nanmean per bootstrap sample
+    return np.array([np.nanmean(x[boots[b][t]]) for b in boots])
+
+
+@pytest.fixture
+def sample():
+    rng = np.random.default_rng(1)
+    n = 500
+    group0 = rng.random(n) < 0.4
+    x = rng.normal(size=(3, n))
+    x[0, ::17] = np.nan
+    return group0, x
+
+
+def test_msd_matches_loop(sample):
+    group0, (x1, x2, x3) = sample
+    plan = BootPlan(group0, nboot=25, seed=3)
+    boots = plan.to_dict()
+    for source in (boots, plan):
+        np.testing.assert_allclose(msd_one(x1, "id0", "m", source)["value"], _loop_means(x1, "id0", boots), rtol=1e-10, atol=1e-12)
+        np.testing.assert_allclose(msd_two(x1, "all", x2, "id1", "m", source)["value"],
+                                   _loop_means(x1, "all", boots) + _loop_means(x2, "id1", boots), rtol=1e-10, atol=1e-12)
+        np.testing.assert_allclose(msd_three(x1, "all", x2, "id0", x3, "id1", "m", source)["value"],
+                                   _loop_means(x1, "all", boots) + _loop_means(x2, "id0", boots) + _loop_means(x3, "id1", boots), rtol=1e-10, atol=1e-12)
+    #float32 sums around the mean shift stay close to the float64 means
+    np.testing.assert_allclose(msd_one(x1, "all", "m", boots, compact=True)["value"], _loop_means(x1, "all", boots), atol=1e-5)
+
+
+def test_lazy_plan_matches_stored(sample):
+    group0, x = sample
+    stored, lazy = BootPlan(group0, nboot=30, seed=5), BootPlan(group0, nboot=30, seed=5, lazy=True, chunk_size=7)
+    for b in (0, 13, 29):
+        np.testing.assert_array_equal(stored.replicate(b), lazy.replicate(b))
+    cols = {"all": [x[0], x[1]], "id0": [x[2]]}
+    m_stored, m_lazy = stored.means_many(cols), lazy.means_many(cols)
+    for t in cols:
+        np.testing.assert_allclose(m_stored[t], m_lazy[t], rtol=1e-10, atol=1e-12)
+
+
+@pytest.mark.parametrize("scheme", ["poisson", "dirichlet"])
+def test_replicate_weights_by_chunks(scheme):
+    n = 2 * WEIGHT_CHUNK + 123
+    full = replicate_weights(scheme, 11, n)
+    parts = [replicate_weights(scheme, 11, min(WEIGHT_CHUNK, n - a), start=a) for a in range(0, n, WEIGHT_CHUNK)]
+    np.testing.assert_array_equal(full, np.concatenate(parts))
+    assert abs(full.mean() - 1) < 0.02
+    with pytest.raises(ValueError):
+        replicate_weights(scheme, 11, 10, start=5)
+
+
+def test_weighted_plan_means(sample):
+    group0, x = sample
+    plan = BootPlan(group0, nboot=10, seed=2, scheme="poisson")
+    w = plan.weights(next(plan.chunks())[1])
+    keep = ~np.isnan(x[0])
+    expected = (w[:, keep] @ x[0][keep]) / w[:, keep].sum(axis=1)
+    np.testing.assert_allclose(plan.means_many({"all": [x[0]]})["all"][:, 0], expected, rtol=1e-10, atol=1e-12)
+    with pytest.raises(ValueError):
+        plan.replicate(0)
@@ -0,0 +1,33 @@
+import warnings
+
+import numpy as np
+import pytest
+from econml.grf import CausalForest
+
+import causal_forest
+from causal_forest import oob_predict
+
+
+@pytest.fixture(scope="module")
+def fitted():
+    rng = np.random.default_rng(0)
+    X = rng.normal(size=(1500, 3))
+    T = rng.integers(0, 2, 1500)
+    y = X[:, 0] * T + rng.normal(size=1500)
+    return X, [CausalForest(n_estimators=16, inference=inference, random_state=1).fit(X, T, y) for inference in (False, True)]
+
+
+def test_oob_predict_matches_econml(fitted):
+    X, forests = fitted
+    for forest in forests:
+        np.testing.assert_allclose(oob_predict(forest, X, batch_size=400), forest.oob_predict(X), rtol=1e-10, atol=1e-12, equal_nan=True)
+
+
+def test_oob_predict_falls_back_on_unknown_econml(fitted, monkeypatch):
+    X, forests = fitted
+    monkeypatch.setattr(causal_forest, "_OOB_MAX_VERSION", (0, 0))
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        pred = oob_predict(forests[0], X, batch_size=400)
+    assert any("falls back" in str(w.message) for w in caught)
+    np.testing.assert_array_equal(pred, forests[0].oob_predict(X))
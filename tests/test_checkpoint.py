@@ -0,0 +1,37 @@
+import json
+import os
+
+from checkpoint import CONFIG, load_run
+from decompositions import fairness_cookbook
+
+FAST = dict(method="OLS", nboot2=10, seed=7)
+
+
+def test_resume_then_extend(scm, tmp_path):
+    data, args = scm
+    run_dir = str(tmp_path / "run")
+    fairness_cookbook(data, *args, nboot1=2, run_dir=run_dir, **FAST)
+    _, extended = fairness_cookbook(data, *args, nboot1=4, run_dir=run_dir, **FAST)
+    _, full = fairness_cookbook(data, *args, nboot1=4, **FAST)
+    assert extended.equals(full)
+
+    with open(os.path.join(run_dir, CONFIG)) as f:
+        assert json.load(f)["store"]["nboot1"] == 4
+    store, _ = load_run(run_dir)
+    assert int(store.done.sum()) == 4
+    assert store.summary().equals(full)
+
+
+def test_load_run_sizes_the_store_from_the_shards(scm, tmp_path):
+    data, args = scm
+    run_dir = str(tmp_path / "run")
+    fairness_cookbook(data, *args, nboot1=3, run_dir=run_dir, **FAST)
+    #a configuration recording fewer repetitions than the shards on disk
+    path = os.path.join(run_dir, CONFIG)
+    with open(path) as f:
+        config = json.load(f)
+    config["store"]["nboot1"] = 1
+    with open(path, "w") as f:
+        json.dump(config, f)
+    store, _ = load_run(run_dir)
+    assert int(store.done.sum()) == 3
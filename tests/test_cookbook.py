@@ -0,0 +1,84 @@
+import os
+
+import numpy as np
+import pytest
+
+from decompositions import fairness_cookbook
+
+FAST = dict(nboot1=3, nboot2=10, crf_n_estimators=16, seed=7)
+
+
+@pytest.mark.parametrize("method", ["causal_forest", "medDML", "OLS"])
+def test_parallel_matches_serial(scm, method):
+    data, args = scm
+    res1, summary1 = fairness_cookbook(data, *args, method=method, n_jobs=1, cpu_budget=2, **FAST)
+    res2, summary2 = fairness_cookbook(data, *args, method=method, n_jobs=2, cpu_budget=2, **FAST)
+    assert res1.reset_index(drop=True).equals(res2.reset_index(drop=True))
+    assert summary1.equals(summary2)
+
+
+@pytest.mark.parametrize("method", ["causal_forest", "medDML", "OLS"])
+def test_outcomes_match_separate_audits(scm, method):
+    data, (X, Z, W, Y, x0, x1) = scm
+    data = data.assign(y2=2 * data["y"] + np.random.default_rng(1).normal(size=len(data)))
+    _, both = fairness_cookbook(data, X, Z, W, [Y, "y2"], x0, x1, method=method, **FAST)
+    for outcome in (Y, "y2"):
+        _, single = fairness_cookbook(data, X, Z, W, outcome, x0, x1, method=method, **FAST)
+        assert list(both.loc[outcome].index) == list(single.index)
+        np.testing.assert_allclose(both.loc[outcome].to_numpy(), single.to_numpy(), rtol=1e-10, atol=1e-12)
+
+
+@pytest.mark.parametrize("method", ["causal_forest", "medDML", "OLS"])
+def test_analytic_se_matches_bootstrap(scm, method):
+    data, args = scm
+    res, _ = fairness_cookbook(data, *args, method=method, inference="analytic", **dict(FAST, nboot1=1))
+    _, boot = fairness_cookbook(data, *args, method=method, **dict(FAST, nboot1=1, nboot2=400))
+    #the influence functions take the fits as given, like the inner bootstrap of one repetition
+    ratio = (res.set_index("measure")["se"] / boot[("value", "std")]).dropna()
+    assert len(ratio) == 8 and np.all(np.abs(ratio - 1) < 0.15), ratio
+
+
+def test_store_matches_frame(scm):
+    data, args = scm
+    res, summary = fairness_cookbook(data, *args, **FAST)
+    store, summary_store = fairness_cookbook(data, *args, return_store=True, **FAST)
+    assert store.to_frame().reset_index(drop=True).equals(res.reset_index(drop=True))
+    assert summary_store.equals(summary)
+
+
+def test_resume_matches_uninterrupted(scm, tmp_path):
+    data, args = scm
+    _, full = fairness_cookbook(data, *args, method="OLS", **FAST)
+    run_dir = str(tmp_path / "run")
+    fairness_cookbook(data, *args, method="OLS", run_dir=run_dir, **FAST)
+    #an interruption before the last repetition and the end of the run
+    os.remove(os.path.join(run_dir, "reps", "rep_000002.npz"))
+    os.remove(os.path.join(run_dir, "status.json"))
+    _, resumed = fairness_cookbook(data, *args, method="OLS", run_dir=run_dir, **FAST)
+    assert resumed.equals(full)
+    with pytest.raises(ValueError, match="other parameters"):
+        fairness_cookbook(data, *args, method="OLS", run_dir=run_dir, **dict(FAST, nboot2=20))
+
+
+def test_tolerance_stops_at_the_same_rep(scm):
+    data, args = scm
+    kwargs = dict(method="OLS", nboot1=40, nboot2=10, seed=7, tol=0.12, min_reps=5, cpu_budget=2)
+    _, serial = fairness_cookbook(data, *args, n_jobs=1, **kwargs)
+    _, parallel = fairness_cookbook(data, *args, n_jobs=2, **kwargs)
+    assert serial.attrs["stop_reason"] == "tolerance" and 5 < serial.attrs["n_reps"] < 40
+    assert parallel.attrs == serial.attrs
+    assert parallel.equals(serial)
+
+
+def test_tolerance_ignores_measures_without_error(scm):
+    data, args = scm
+    #expse_x1 is never estimated, its Monte-Carlo error is nan and never stops the repetitions
+    _, summary = fairness_cookbook(data, *args, method="OLS", nboot1=6, nboot2=10, seed=7, tol=1e6, tol_measures=["expse_x1"], min_reps=2)
+    assert summary.attrs["stop_reason"] == "max_reps" and summary.attrs["n_reps"] == 6
+    assert np.isnan(summary.attrs["mc_error"])
+
+
+def test_unknown_tol_measures(scm):
+    data, args = scm
+    with pytest.raises(ValueError, match="tol_measures"):
+        fairness_cookbook(data, *args, method="OLS", nboot2=10, tol=0.1, tol_measures=["te", "total"])
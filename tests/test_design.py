@@ -0,0 +1,71 @@
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from decompositions import fairness_cookbook
+from design import AuditData
+from encoders import DummyEncoder
+from helpers import auto_dummy, shared_dir
+
+
+def test_dummy_encoder_matches_auto_dummy(scm):
+    data, _ = scm
+    for cols in (["z_num", "z_cat"], ["w_num", "w_cat"]):
+        adjusted, columns = auto_dummy(data, np.array(cols))
+        encoder = DummyEncoder(np.array(cols))
+        encoded = encoder.fit_transform(data)
+        assert list(encoder.columns_) == list(columns)
+        np.testing.assert_array_equal(encoded, adjusted[columns].to_numpy(dtype=float))
+        #the fitted encoder gives the same layout on new rows
+        np.testing.assert_array_equal(encoder.transform(data.iloc[:50]), encoded[:50])
+
+
+def test_audit_data_encoding(scm):
+    data, (X, Z, W, Y, x0, _) = scm
+    audit = AuditData.from_frame(data, X, Z, W, Y, x0, encode=True)
+    _, z_cols = auto_dummy(data, np.array(Z))
+    assert audit.n_z == len(z_cols)
+    np.testing.assert_array_equal(audit.t, (data[X] != x0).to_numpy())
+
+
+def test_from_file_matches_from_frame(scm, tmp_path):
+    data, (X, Z, W, Y, x0, x1) = scm
+    path = str(tmp_path / "data.csv")
+    data.to_csv(path, index=False)
+    #the floats as parsed from the file
+    data = pd.read_csv(path)
+    frame = AuditData.from_frame(data, X, Z, W, Y, x0, encode=True)
+    #chunks smaller than the data, so that the levels and the rows are gathered over several of them
+    with AuditData.from_file(path, X, Z, W, Y, x0, chunk_size=150, encode=True) as audit:
+        assert list(audit.columns) == list(frame.columns) and audit.n_z == frame.n_z
+        for k in ("features", "t", "y"):
+            np.testing.assert_array_equal(getattr(audit, k), getattr(frame, k))
+    _, from_path = fairness_cookbook(path, X, Z, W, Y, x0, x1, method="OLS", nboot2=10, seed=1, chunk_size=150)
+    _, from_data = fairness_cookbook(data, X, Z, W, Y, x0, x1, method="OLS", nboot2=10, seed=1)
+    assert from_path.equals(from_data)
+
+
+def _published():
+    #directories of the arrays published by AuditData.share
+    parent = shared_dir(0) or tempfile.gettempdir()
+    return {name for name in os.listdir(parent) if name.startswith("audit_")}
+
+
+def test_shared_arrays_are_removed(scm):
+    data, args = scm
+    before = _published()
+    with AuditData.from_frame(data, *args[:5], encode=True).share() as shared:
+        assert os.path.basename(shared.path) in _published() - before
+    assert _published() == before
+    kwargs = dict(method="OLS", nboot1=3, nboot2=10, seed=1, n_jobs=2, cpu_budget=2)
+    fairness_cookbook(data, *args, **kwargs)
+    assert _published() == before
+    #a repetition failing in a worker (OLS rejects a missing outcome) still removes them
+    data = data.copy()
+    data.loc[5, "y"] = np.nan
+    with pytest.raises(ValueError, match="finite"):
+        fairness_cookbook(data, *args, **kwargs)
+    assert _published() == before
@@ -0,0 +1,24 @@
+import numpy as np
+import pandas as pd
+
+from encoders import CategoricalEncoder
+
+
+def test_target_encoding_is_out_of_fold():
+    rng = np.random.default_rng(0)
+    n = 2000
+    #a high-cardinality column and an outcome that does not depend on it
+    data = pd.DataFrame({"city": rng.integers(0, 400, n).astype(str).astype(object), "age": rng.normal(size=n)})
+    y = rng.normal(size=n)
+    encoder = CategoricalEncoder(["city", "age"], encoding={"city": "target"}, n_folds=5)
+    encoded = encoder.fit_transform(data, y=y)
+    assert list(encoder.columns_) == ["city", "age"]
+
+    #the feature of a row never uses its own outcome
+    for i in (0, 17, 1234):
+        y_i = y.copy()
+        y_i[i] += 100
+        np.testing.assert_allclose(CategoricalEncoder(["city", "age"], encoding={"city": "target"}, n_folds=5).fit_transform(data, y=y_i)[i], encoded[i], atol=1e-12)
+    #so it does not predict the noise, unlike the in-sample encoding of the same levels
+    assert abs(np.corrcoef(encoded[:, 0], y)[0, 1]) < 0.1
+    assert np.corrcoef(encoder.transform(data)[:, 0], y)[0, 1] > 0.3
@@ -0,0 +1,12 @@
+import numpy as np
+
+from decompositions import fairness_cookbook
+from simulate import simulate_scm
+
+
+def test_med_dml_recovers_the_effects():
+    data, truth = simulate_scm(2000, z_levels=4, w_levels=3, seed=0)
+    _, summary = fairness_cookbook(data, "x", ["z_num", "z_cat"], ["w_num", "w_cat"], "y", "x0", "x1", method="medDML", nboot2=200, seed=0)
+    measures = ["te", "ett", "nde", "nie", "ctfde", "ctfie", "ctfse"]
+    error = (summary[("value", "mean")] - truth)[measures]
+    assert np.all(np.abs(error) < 3 * summary[("value", "std")][measures]), error
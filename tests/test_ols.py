@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+import scipy.sparse as sp
+
+from OLS import _solve, wls_stats
+from decompositions import fairness_cookbook
+
+
+def test_batched_wls_matches_lstsq():
+    rng = np.random.default_rng(4)
+    n, p = 300, 4
+    design = np.column_stack([np.ones(n), rng.normal(size=(n, p - 1))])
+    t = (rng.random(n) < 0.5).astype(int)
+    y = design @ rng.normal(size=(p, 2)) + rng.normal(size=(n, 2))
+    counts = rng.multinomial(n, np.full(n, 1 / n), size=6).astype(float)
+    for c in (counts, sp.csr_matrix(counts)):
+        G, R = wls_stats(design, t, y, c)
+        beta = _solve(G, R)
+        for g in (0, 1):
+            for b in range(counts.shape[0]):
+                rows = t == g
+                sw = np.sqrt(counts[b, rows])
+                ref = np.linalg.lstsq(design[rows] * sw[:, None], y[rows] * sw[:, None], rcond=None)[0]
+                np.testing.assert_allclose(beta[g, b], ref, rtol=1e-8, atol=1e-10)
+
+
+def test_ols_rejects_missing_outcome(scm):
+    data, args = scm
+    data = data.copy()
+    data.loc[3, "y"] = np.nan
+    with pytest.raises(ValueError, match="finite"):
+        fairness_cookbook(data, *args, method="OLS", nboot2=5, seed=1)
@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+from results import MeasureStore, QuantileSketch, StreamSummary
+
+
+@pytest.mark.parametrize("between", [True, False, 0.25])
+def test_stream_summary_matches_store(between):
+    rng = np.random.default_rng(0)
+    values = rng.normal(size=(4, 50, 10)) + rng.normal(size=(4, 1, 10))
+    values[:, ::7, 3] = np.nan
+    store, stream = MeasureStore(4, 50, between=between), StreamSummary(4, between=between)
+    for r in range(4):
+        store.write(r, values[r])
+        stream.write(r, values[r])
+
+    expected, summary = store.summary(), stream.summary()
+    for col in ("mean", "std"):
+        np.testing.assert_allclose(summary[("value", col)], expected[("value", col)], rtol=1e-10)
+    np.testing.assert_allclose(stream.mc_error().to_numpy(), store.mc_error().to_numpy(), rtol=1e-10)
+    if between is True:
+        #fewer values than the capacity of the sketches: the quantiles are exact
+        quantiles = np.nanquantile(values.reshape(-1, 10), [0.025, 0.975], axis=0).T
+        np.testing.assert_allclose(summary[[("value", "ci_lower"), ("value", "ci_upper")]].to_numpy(), quantiles[np.argsort(store.measures)], rtol=1e-12)
+
+
+def test_merged_sketches_approximate_the_quantiles():
+    rng = np.random.default_rng(1)
+    x = rng.normal(size=20000)
+    sketch = QuantileSketch(k=128).update(x[:7000]).merge(QuantileSketch(k=128).update(x[7000:]))
+    assert sketch.n == len(x)
+    probs = np.array([0.025, 0.5, 0.975])
+    #error of the rank of each quantile
+    ranks = np.searchsorted(np.sort(x), sketch.quantile(probs)) / len(x)
+    assert np.all(np.abs(ranks - probs) < 0.02)
@@ -0,0 +1,18 @@
+import numpy as np
+
+from decompositions import fairness_cookbook
+from segments import segmented_cookbook
+
+
+def test_refitted_segments_match_separate_audits(scm):
+    data, args = scm
+    data = data.assign(region=np.random.default_rng(2).choice(["north", "south", "west"], len(data)))
+    kwargs = dict(method="OLS", nboot1=2, nboot2=10)
+    _, summary = segmented_cookbook(data, *args, by="region", refit=True, seed=3, **kwargs)
+    #the audits are "all" then the segments in order, each with its own seed spawned from seed
+    seeds = np.random.SeedSequence(3).spawn(4)
+    for name, seed in zip(["north", "south", "west"], seeds[1:]):
+        _, separate = fairness_cookbook(data[data["region"] == name], *args, seed=seed, **kwargs)
+        segment = summary.loc[("x", name)]
+        assert list(segment.index) == list(separate.index)
+        np.testing.assert_allclose(segment.to_numpy(), separate.to_numpy(), rtol=1e-10, atol=1e-12)
@@ -0,0 +1,23 @@
+import pytest
+
+from decompositions import fairness_cookbook
+from tuning import tune_crf
+
+
+def test_tune_crf_with_inference(scm):
+    data, args = scm
+    space = {"crf_min_samples_leaf": [2, 5, 20], "crf_max_samples": [0.35, 0.5]}
+    params, history = tune_crf(data, *args, space=space, n_candidates=4, eta=2, n_estimators=16, seed=3, crf_inference=True)
+    assert set(params) == {"crf_min_samples_leaf", "crf_max_samples", "crf_inference", "crf_n_estimators"}
+    assert params["crf_inference"] is True and params["crf_n_estimators"] == 16
+    assert list(history["round"].value_counts().sort_index()) == [4, 2]
+    assert history["loss"].notna().all()
+    #the result is passed as is to fairness_cookbook
+    _, summary = fairness_cookbook(data, *args, nboot1=1, nboot2=10, seed=3, **params)
+    assert summary[("value", "mean")][["te", "ett", "nde", "nie", "ctfde", "ctfie", "ctfse"]].notna().all()
+
+
+def test_tune_crf_rejects_other_parameters(scm):
+    data, args = scm
+    with pytest.raises(ValueError, match="crf_n_jobs"):
+        tune_crf(data, *args, n_estimators=16, crf_n_jobs=2)
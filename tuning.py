@@ -0,0 +1,150 @@
+"""
+Tuning of the crf_* parameters of the causal forests by successive halving: many candidate settings are scored on a small subsample with few trees,
+the best third is kept and scored again on three times the rows and the trees, and so on, so that the whole search costs about as much as a few fits at the final scale.
+
+The score of a setting is the R-loss of the out-of-bag predictions of its forests, mean((y - m(x) - (t - e(x)) * tau(x))**2),
+with cross-fitted outcome and propensity regressions m and e fitted once and shared by all the candidates (Nie and Wager, quasi-oracle estimation of heterogeneous treatment effects).
+
+    params, history = tune_crf(data, "sex", Z, W, "salary", "female", "male", seed = 1)
+    res, res_summary = fairness_cookbook(data, "sex", Z, W, "salary", "female", "male", **params)
+"""
+from decompositions import fairness_cookbook
+from design import AuditData
+from causal_forest import oob_predict
+from med_dml import _fit
+from profiling import as_profiler
+from concurrent.futures import ThreadPoolExecutor
+from sklearn.ensemble import HistGradientBoostingClassifier, HistGradientBoostingRegressor
+from sklearn.model_selection import KFold
+from econml.grf import CausalForest
+import inspect
+import itertools
+import pandas as pd
+import numpy as np
+
+#values searched by default, every candidate is one combination of them
+SPACE = {"crf_min_samples_leaf": [1, 2, 5, 10, 20, 50],
+         "crf_max_samples": [0.2, 0.35, 0.5],
+         "crf_max_features": ["sqrt", 0.33, 0.66, None],
+         "crf_min_balancedness_tol": [0.3, 0.45]}
+
+#crf_* parameters of fairness_cookbook and their defaults
+_CRF_DEFAULTS = {k: p.default for k, p in inspect.signature(fairness_cookbook).parameters.items()
+                 if k.startswith("crf_") and k not in ("crf_n_jobs", "crf_concurrent", "crf_oob_batch")}
+
+
+def tune_crf(data, X, Z, W, Y, x0, x1, space = None, n_candidates = 27, eta = 3, max_rows = None, min_rows = 200, n_estimators = 100, max_trees = None,
+             n_folds = 3, regressor = None, classifier = None, n_jobs = 1, seed = None, if_auto_dummy = True, encoding = "dummy", compact = False, profiler = None, **crf_params):
+    """
+    Search the parameters of the causal forests of fairness_cookbook (method "causal_forest") by successive halving on nested subsamples of the data.
+
+    Every round scores its candidates with the R-loss of the out-of-bag predictions of both forests (on Z for te, on Z and W for the direct effects), summed,
+    on the first outcome if Y is a list. The encoded data is shared by all the candidates, and the rows of a round are the first rows of one random permutation,
+    so that every round holds the rows of the previous ones and the nuisance regressions are fitted once.
+    The last round fits eta candidates on max_rows rows with max_trees trees; each earlier round has eta times more candidates, eta times fewer rows (at least min_rows) and eta times fewer trees (at least 8).
+    Every round costs about 1 / eta of the next one, and the last one eta / 16 of the fits of an outter repetition (both forests on all the rows with n_estimators trees) with the default max_rows and max_trees:
+    with eta = 3, the rounds cost about 0.3 outter repetition, plus the nuisance regressions, once the data is large enough for min_rows and the 8 trees not to bind.
+
+    :data:(dataframe or AuditData)
+    :X, Z, W, Y, x0, x1, if_auto_dummy, encoding, compact:(see fairness_cookbook)
+    :space:(dictionary or None) crf_* parameter of fairness_cookbook: list of the values searched. Default None, SPACE.
+    :n_candidates:(integer) number of settings of the first round, drawn at random without replacement among the combinations of space (all of them if there are fewer). Default 27.
+    :eta:(integer) reduction factor: every round keeps the best 1 / eta of its candidates, with eta times more rows and trees. Default 3.
+    :max_rows:(integer or None) number of rows of the last round. Default None, a quarter of the rows, at least min_rows and at most 100000.
+        The leaf sizes are tuned at that scale, forests on more rows may afford larger leaves.
+    :min_rows:(integer) smallest number of rows of a round. Default 200.
+    :n_estimators:(integer) number of trees of the forests of the audit, returned as crf_n_estimators. The out-of-bag loss keeps decreasing with the number of trees, so it is a budget rather than a tuned parameter.
+    :max_trees:(integer or None) number of trees of the last round. Default None, n_estimators // 4 (at least 8).
+    :n_folds:(integer) number of cross-fitting folds of the nuisance regressions. Default 3.
+    :regressor, classifier:(scikit-learn models or None) nuisance regressions of y and of the protected attribute. Default HistGradientBoostingRegressor and HistGradientBoostingClassifier with 50 iterations,
+        which only need to be good enough to rank the candidates.
+    :n_jobs:(integer) number of candidates fitted at the same time, in threads, every forest with one thread. Default 1.
+    :seed:(None, integer or SeedSequence) seed of the candidates, the subsamples, the folds and the forests. Default None.
+    :profiler:(None, profiling.Profiler or function) see fairness_cookbook, with stages encode, nuisance_fit and one stage round per round.
+    :crf_params:(dictionary) crf_* parameters of fairness_cookbook kept fixed, e.g. crf_honest, crf_criterion or crf_inference (the candidates are then fitted with it too). The others not in space take their default in fairness_cookbook.
+    :return1:(dictionary) the crf_* parameters of the best candidate of the last round, the fixed ones and crf_n_estimators, to be passed to fairness_cookbook as **params
+    :return2:(dataframe) every candidate of every round: round, candidate, rows, trees, loss and the value of each searched parameter
+    """
+    space = SPACE if space is None else space
+    unknown = [k for k in list(space) + list(crf_params) if k not in _CRF_DEFAULTS]
+    if len(unknown) > 0:
+        raise ValueError("not crf_* parameters of fairness_cookbook: %s" % (", ".join(unknown),))
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    rng = np.random.default_rng(seed)
+    profiler = as_profiler(profiler)
+
+    with profiler.stage("encode"):
+        audit = data if isinstance(data, AuditData) else AuditData.from_frame(data, X, Z, W, Y, x0, dtype = np.float32 if compact else np.float64, encode = if_auto_dummy, encoding = encoding)
+    if audit.n_z == 0 and audit.n_w == 0:
+        raise ValueError("the causal forests need Z or W")
+
+    #candidates and schedule of the rounds
+    grid = list(itertools.product(*space.values()))
+    picks = rng.choice(len(grid), min(n_candidates, len(grid)), replace = False)
+    candidates = [dict(zip(space, grid[i])) for i in picks]
+    n_rounds = max(int(np.ceil(np.log(len(candidates)) / np.log(eta) - 1e-9)), 1)
+    max_rows = min(audit.n, max(min(audit.n // 4, 100000), min_rows) if max_rows is None else max_rows)
+    max_trees = max(n_estimators // 4, 8) if max_trees is None else max_trees
+    rows = [max(int(max_rows / eta**(n_rounds - 1 - k)), min(min_rows, max_rows)) for k in range(n_rounds)]
+    trees = [max(int(max_trees / eta**(n_rounds - 1 - k)) // 4 * 4, 8) for k in range(n_rounds)]
+
+    #the rows of every round are the first rows of one permutation, and the nuisances are cross-fitted once on the rows of the last round
+    order = rng.choice(audit.n, max_rows, replace = False)
+    features = np.asarray(audit.features[order], dtype = np.float64)
+    t, y = audit.t[order].astype(np.float64), audit.y[order, 0]
+    views = []
+    if audit.n_z > 0:
+        views.append(("te", features[:, :audit.n_z]))
+    if audit.n_w > 0:
+        views.append(("med", features))
+    with profiler.stage("nuisance_fit"):
+        residuals = {name: _residuals(x, t, y, n_folds, regressor, classifier, int(rng.integers(2**31))) for name, x in views}
+
+    fixed = dict(_CRF_DEFAULTS, **crf_params)
+    history = []
+    for k in range(n_rounds):
+        forest_seed = int(rng.integers(2**31))
+        score = lambda candidate: _r_loss(dict(fixed, **candidate), views, t, y, residuals, rows[k], trees[k], forest_seed)
+        with profiler.stage("round", k):
+            if n_jobs == 1:
+                losses = [score(c) for c in candidates]
+            else:
+                with ThreadPoolExecutor(max_workers = n_jobs) as pool:
+                    losses = list(pool.map(score, candidates))
+        history += [dict(round = k, candidate = i, rows = rows[k], trees = trees[k], loss = loss, **c) for i, (c, loss) in enumerate(zip(candidates, losses))]
+        #nan losses (e.g. a setting the forest rejects) rank last
+        best = np.argsort(np.where(np.isnan(losses), np.inf, losses), kind = "stable")
+        candidates = [candidates[i] for i in best[:max(int(np.ceil(len(candidates) / eta)), 1)]]
+
+    params = dict(fixed, **candidates[0])
+    params.update(crf_n_estimators = n_estimators)
+    return {k: v for k, v in params.items() if k in space or k in crf_params or k == "crf_n_estimators"}, pd.DataFrame(history)
+
+
+def _residuals(x, t, y, n_folds, regressor, classifier, seed):
+    #cross-fitted residuals y - E[y|x] and t - P(x1|x)
+    regressor = HistGradientBoostingRegressor(max_iter = 50) if regressor is None else regressor
+    classifier = HistGradientBoostingClassifier(max_iter = 50) if classifier is None else classifier
+    y_res, t_res = np.empty(len(y)), np.empty(len(t))
+    for train, test in KFold(n_splits = n_folds, shuffle = True, random_state = seed).split(x):
+        y_res[test] = y[test] - _fit(regressor, x[train], y[train], None, seed).predict(x[test])
+        t_res[test] = t[test] - _fit(classifier, x[train], t[train], None, seed).predict_proba(x[test])[:, 1]
+    return y_res, t_res
+
+
+def _r_loss(params, views, t, y, residuals, n_rows, n_trees, seed):
+    #R-loss of the out-of-bag predictions of the forests of one candidate on the first n_rows rows, summed over the forests.
+    #The forests are fitted as in crf_predict (with crf_inference, on the half-samples of their subforests), on t and y, and only their predictions are scored on the residuals
+    forest_params = {k[4:]: v for k, v in params.items() if k != "crf_n_estimators"}
+    loss = 0.0
+    for name, x in views:
+        y_res, t_res = (r[:n_rows] for r in residuals[name])
+        forest = CausalForest(**forest_params, n_estimators = n_trees, n_jobs = 1, random_state = seed)
+        try:
+            forest.fit(X = x[:n_rows], T = t[:n_rows], y = y[:n_rows])
+        except ValueError:
+            return np.nan
+        tau = oob_predict(forest, x[:n_rows]).ravel()
+        loss += np.nanmean((y_res - t_res * tau)**2)
+    return loss